@@ -0,0 +1,313 @@
+# micro-benchmarks for the translator modules
+# usage: python bench_v2.py [benchmark name ...]   (all benchmarks are run without arguments)
+import sys
+import time
+import timeit
+import tracemalloc
+import importlib
+
+
+translators = ['generaltags_v2', 'locations_v2', 'scanner_ble_v2', 'twr_v2']   # translator modules (python files)
+BENCHMARKS = {}   # name -> benchmark function
+
+
+def benchmark(func):   # register a benchmark function
+    BENCHMARKS[func.__name__] = func
+    return func
+
+
+def sampleDatamap(i, now):   # synthetic BDCL datamap of a tag reporting every kind of data; i: sequence number, now: measurement time (usec)
+    return {
+        'status.battery.level': 3.7,
+        'status.battery.charging': i % 3,
+        'status.temperature': 21,
+        'status.lastaccel.ismoving': i % 2,
+        'status.lastaccel.acc_raw_packed': {
+            'status.lastaccel.databits': 12,
+            'status.lastaccel.acc_data_tsd': {'timestamp': {'absolute or relative': 'relative', 'unit': 'milliseconds'}, 'data': [{'timestamp': i * 1000 + k * 10, 'values': [k, 2 * k, 3 * k]} for k in range(20)]}
+        },
+        'status.distance_tsd': {'timestamp': {'absolute or relative': 'relative (reversed)', 'unit': 'milliseconds'}, 'data': [{'timestamp': 900 - k * 100, 'values': 1000 + k} for k in range(10)]},
+        'status.gps.gpsdata_ex_tsd': {'timestamp': {'absolute or relative': 'absolute', 'unit': 'microseconds'}, 'data': [{'timestamp': now - 5000 + k, 'values': [472804724, 190412345, (150 << 8) | 36]} for k in range(3)]},
+        'status.twr.inform_c': {'tagsettings.twr.target1': 7, 'status.twr.result1': 1500, 'tagsettings.twr.target2': 8, 'status.twr.result2': 2500},
+        'status.general.tick_count': 1000 * i,
+        'status.blescandata_tsd': {'timestamp': {'absolute or relative': 'relative', 'unit': 'milliseconds'}, 'data': [{'timestamp': i * 1000 + k * 50, 'values': [((-60 - k) & 0xFF) << 16 | 0xA1B2, 0xC3D4E5F6 - k, 4000 + k]} for k in range(8)]}
+    }
+
+
+def sampleBdclMessage(i, now, uniqId = 1):   # synthetic BDCL pub/sub message payload
+    return {'header': {'uniqId': uniqId, 'measTs': now, 'serverTs': now + 50}, 'data': sampleDatamap(i, now)}
+
+
+def sampleSclMessage(i, now, devId = 1, positionCount = 10):   # synthetic SCL pub/sub message payload
+    return {
+        'devId': devId,
+        'uuid': '0b5c4a2e-6d1f-4a8e-9d3b-2f7e1c9a4b60',
+        'timestamp': now,
+        'sensorsetbufferTime': now + 50,
+        'positions': [{'positionVector': [12.5 + 0.01 * k + i, 7.25 - 0.02 * k, 1.5], 'quality': 0.9} for k in range(positionCount)]
+    }
+
+
+def samplePatches(count, now):   # JSON patch operations as sent to DCM
+    return [
+        {'op': 'replace', 'path': '/tag.{}/accelerometerA'.format(k), 'value': [0.01 * k, -0.5, 9.81], 'times': {'measurement': now + k, 'sensorsetbuffer': now + k + 50}}
+        for k in range(count)
+    ]
+
+
+def report(name, func, number):   # run func number times, print time and transient memory peak per call
+    func()   # warm-up
+    seconds = min(timeit.repeat(func, number = number, repeat = 3)) / number
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+    func()
+    peak = tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+    print('{:<40} {:>10.2f} usec/call {:>10.1f} KiB peak/call'.format(name, seconds * 1e6, peak / 1024))
+
+
+def closureTranslatorFunc(module):   # translator_func of a module in the shape replaced by the dispatch index: the prepare hook, a closure for each handler and the switcher dict are run and built for each call, the switcher is scanned linearly
+    hook = getattr(module, 'translator_prepare', None)
+    handlers = list(module.lolanHandlers.items())
+
+    def translator_func(data, identifier, times):
+
+        def attrSetter(handler):
+            return lambda val, newTimes: handler(val, identifier, newTimes)
+
+        # TSD buffering process
+        if hook is not None:
+            hook(times, identifier)
+
+        # LoLaN variable translator definitions
+        switcher = {lolan : attrSetter(handler) for lolan, handler in handlers}
+
+        # translating procedure
+        for k, setterFunc in switcher.items():
+            if k in data:
+                yield setterFunc(data[k], times)
+
+    return translator_func
+
+
+def closureTranslate(translatorFuncs, datamap, identifier, times):   # dispatch as translator2 did before the dispatch index: every translator_func in turn
+    for translatorFunc in translatorFuncs:
+        for outList in translatorFunc(datamap, identifier, times):
+            if outList:
+                yield outList
+
+
+@benchmark
+def dispatch():   # LoLaN variable dispatch: a datamap with a single known variable and a datamap with every variable, per-call translator_func closures and the dispatch index
+    import dispatch_v2
+    modules = [importlib.import_module(module) for module in translators]
+    index = dispatch_v2.buildDispatchIndex(modules)
+    now = int(time.time() * 1e6)
+    single = {'status.battery.level': 3.7, 'status.temperature': 21}
+    full = sampleDatamap(0, now)
+    counter = iter(range(10 ** 9))
+    translatorFuncs = [closureTranslatorFunc(module) for module in modules]
+    paths = [
+        ('translator_func', lambda datamap, times: closureTranslate(translatorFuncs, datamap, 1, times)),
+        ('index', lambda datamap, times: dispatch_v2.translate(index, datamap, 1, times))
+    ]
+    for name, translate in paths:
+        def runSingle():
+            for outList in translate(single, {'measurement' : now, 'sensorsetbuffer' : now}):
+                pass
+        def runFull():
+            t = now + next(counter) * 1000
+            for outList in translate(full, {'measurement' : t, 'sensorsetbuffer' : t}):
+                pass
+        report('dispatch ({}), 2 variables'.format(name), runSingle, 20000)
+        report('dispatch ({}), every variable'.format(name), runFull, 500)
+
+
+@benchmark
+def modules():   # each translator module alone on the datamap of a tag reporting every kind of data, and the per-message work of tsdbuf_v2
+    import dispatch_v2
+    import tsdbuf_v2
+    now = int(time.time() * 1e6)
+    full = sampleDatamap(0, now)
+    for module in translators:
+        index = dispatch_v2.buildDispatchIndex([importlib.import_module(module)])
+        counter = iter(range(10 ** 9))
+        def run():
+            t = now + next(counter) * 1000
+            for outList in dispatch_v2.translate(index, full, 1, {'measurement' : t, 'sensorsetbuffer' : t}):
+                pass
+        report('{}, every variable'.format(module), run, 500)
+    counter = iter(range(10 ** 9))
+    def runPrepare():
+        i = next(counter)
+        tsdbuf_v2.tsdbufProcess({'measurement' : now + i * 1000, 'sensorsetbuffer' : now + i * 1000}, i % 1000)
+    report('tsdbuf_v2.tsdbufProcess, 1000 devices', runPrepare, 20000)
+    def runAddRecord():
+        i = next(counter)
+        tsdbuf_v2.tsdbufAddRecord((i % 1000, 'distanceM'), 1.5, {'measurement' : now - i, 'sensorsetbuffer' : now})
+    report('tsdbuf_v2.tsdbufAddRecord, 1000 devices', runAddRecord, 20000)
+
+
+@benchmark
+def codec():   # decoding of BDCL and SCL payloads and encoding of patch frames with every installed JSON codec
+    import codec_v2
+    now = int(time.time() * 1e6)
+    bdcl = codec_v2.CODECS['json'][1](sampleBdclMessage(0, now))
+    scl = codec_v2.CODECS['json'][1](sampleSclMessage(0, now))
+    patches = samplePatches(200, now)
+    for name, (loads, dumpb) in codec_v2.CODECS.items():
+        report('{}: loads BDCL ({} bytes)'.format(name, len(bdcl)), lambda: loads(bdcl), 2000)
+        report('{}: loads SCL ({} bytes)'.format(name, len(scl)), lambda: loads(scl), 20000)
+        report('{}: dumpb frame (200 patches)'.format(name), lambda: dumpb(patches), 2000)
+
+
+def sampleAccelTsd(i, sampleCount):   # large accelerometer TSD packet with relative timestamps
+    return {'timestamp': {'absolute or relative': 'relative', 'unit': 'milliseconds'}, 'data': [{'timestamp': i * sampleCount + k, 'values': [k % 2048, -k % 2048, 1024]} for k in range(sampleCount)]}
+
+
+@benchmark
+def tsd():   # TSD processing of large accelerometer packets (DCM update and buffering)
+    import tsdbuf_v2
+    import generaltags_v2
+    now = int(time.time() * 1e6)
+    tsdbuf_v2.tsdbufTimeSync({'measurement' : now})
+    transform = generaltags_v2.accelTransform(12)
+    for sampleCount in [50, 500]:
+        counter = iter(range(10 ** 9))
+        def run():
+            i = next(counter)
+            tsdbuf_v2.tsdProcess(sampleAccelTsd(i, sampleCount), {'measurement' : now - 3000000000 + i * sampleCount * 1000, 'sensorsetbuffer' : now}, generaltags_v2.accelerometerSetter, 1, 'accelerometerA', True, transform)
+        report('tsdProcess, {} samples'.format(sampleCount), run, 20000 // sampleCount)
+
+
+def sampleBleScanTsd(i, sampleCount):   # BLE scan TSD packet of a scanner gateway (address, RSSI and unique ID words)
+    return {'timestamp': {'absolute or relative': 'relative', 'unit': 'milliseconds'}, 'data': [{'timestamp': i * sampleCount + k, 'values': [((-40 - k % 60) & 0xFF) << 16 | (k & 0xFFFF), 0xC3D40000 + k, 4000 + k]} for k in range(sampleCount)]}
+
+
+@benchmark
+def blescan():   # BLE scan extraction of scanner gateway packets (decoding, DCM update and buffering)
+    import tsdbuf_v2
+    import scanner_ble_v2
+    now = int(time.time() * 1e6)
+    tsdbuf_v2.tsdbufTimeSync({'measurement' : now})
+    for sampleCount in [8, 100]:
+        counter = iter(range(10 ** 9))
+        def run():
+            i = next(counter)
+            scanner_ble_v2.bleScanExtract(sampleBleScanTsd(i, sampleCount), 1, {'measurement' : now - 3000000000 + i * sampleCount * 1000, 'sensorsetbuffer' : now})
+        report('bleScanExtract, {} samples'.format(sampleCount), run, 20000 // sampleCount)
+
+
+@benchmark
+def suppress():   # change filter on the translated data of a fleet of tags reporting every kind of data
+    import dispatch_v2
+    import suppress_v2
+    index = dispatch_v2.buildDispatchIndex([importlib.import_module(module) for module in translators])
+    now = int(time.time() * 1e6)
+    items = [do for i in range(200) for outList in dispatch_v2.translate(index, sampleDatamap(i, now + i * 1000000), i % 20, {'measurement' : now + i * 1000000, 'sensorsetbuffer' : now + i * 1000000}) for do in outList if do['coll'] != 'dummy']
+    changeFilter = suppress_v2.ChangeFilter(['generalTags', 'locations', 'pairings', 'extras'], 60.0)
+    passed = sum(changeFilter.accept(item) for item in items)
+    print('{} of {} items passed the change filter'.format(passed, len(items)))
+    def run():
+        for item in items:
+            changeFilter.accept(item)
+    report('ChangeFilter.accept, {} items'.format(len(items)), run, 20)
+
+
+@benchmark
+def outqueue():   # data out queue put and getBatch of the translated data of a fleet of tags: a single class, and the priority classes of translator2
+    import asyncio
+    import dispatch_v2
+    import metrics_v2
+    import outqueue_v2
+    import translator2
+    index = dispatch_v2.buildDispatchIndex([importlib.import_module(module) for module in translators])
+    now = int(time.time() * 1e6)
+    items = [do for i in range(200) for outList in dispatch_v2.translate(index, sampleDatamap(i, now + i * 1000000), i % 20, {'measurement' : now + i * 1000000, 'sensorsetbuffer' : now + i * 1000000}) for do in outList if do['coll'] != 'dummy']
+    classes = translator2.DCM_PRIORITY_CLASSES
+    variants = {
+        'single class' : {},
+        'priority classes' : {
+            'classOf' : translator2.priorityClassOf, 'deadlines' : [c['deadlineSec'] for c in classes], 'dropLate' : [c['dropLate'] for c in classes],
+            'lingers' : [c['lingerMs'] / 1000 if c['lingerMs'] is not None else None for c in classes],
+            'histograms' : [metrics_v2.histogram('bench_queue_latency_seconds', (('class', c['name']),)) for c in classes]
+        }
+    }
+    for name, kwargs in variants.items():
+        async def putAndGet():
+            queue = outqueue_v2.OutQueue(len(items), **kwargs)
+            for item in items:
+                await queue.put(item)
+            while len(queue):
+                await queue.getBatch(200, 0)
+        report('OutQueue {}, {} items'.format(name, len(items)), lambda: asyncio.run(putAndGet()), 20)
+
+
+@benchmark
+def scl():   # SCL message to websocket frame: former path (printing, decoding and re-encoding the message), decoding path and fast path on the raw message
+    import contextlib
+    import io
+    import codec_v2
+    import scl_v2
+    import translator2
+    now = int(time.time() * 1e6)
+    sink = io.StringIO()
+    def former(raw):
+        jsondata = codec_v2.loads(raw)
+        with contextlib.redirect_stdout(sink):
+            print(jsondata)
+        sink.seek(0)
+        sink.truncate()
+        return codec_v2.encodeFrame([translator2.patchFromItem(scl_v2.sclItem(jsondata))])
+    for positionCount in [1, 10, 100]:
+        raw = codec_v2.dumpb(sampleSclMessage(1, now, 7, positionCount))
+        assert codec_v2.loads(former(raw)) == codec_v2.loads(codec_v2.encodeFrame([translator2.patchFromItem(scl_v2.sclItemFast(raw))]))
+        report('former, {} positions ({} bytes)'.format(positionCount, len(raw)), lambda: former(raw), 5000)
+        report('decoding, {} positions'.format(positionCount), lambda: codec_v2.encodeFrame([translator2.patchFromItem(scl_v2.sclItem(codec_v2.loads(raw)))]), 5000)
+        report('fast path, {} positions'.format(positionCount), lambda: codec_v2.encodeFrame([translator2.patchFromItem(scl_v2.sclItemFast(raw))]), 5000)
+        report('sclItemFromRaw, {} positions'.format(positionCount), lambda: codec_v2.encodeFrame([translator2.patchFromItem(scl_v2.sclItemFromRaw(raw))]), 5000)
+
+
+@benchmark
+def chunkcodec():   # history chunk encoding in JSON and columnar layout (size and speed): a fleet of tags reporting every kind of data, noisy accelerometer data
+    import random
+    import dispatch_v2
+    import tsdbuf_v2
+    import chunkcodec_v2
+    import generaltags_v2
+    index = dispatch_v2.buildDispatchIndex([importlib.import_module(module) for module in translators])
+    now = int(time.time() * 1e6)
+    tsdbuf_v2.tsdbufTimeSync({'measurement' : now})
+    rand = random.Random(1)
+    datasets = {}
+    for name in ['fleet', 'noisy accelerometer']:
+        del tsdbuf_v2.tsdbufChunkBuffer[:]
+        for i in range(60):
+            for uniqId in range(20):
+                measTime = now - 60000000 + i * 1000000 + uniqId
+                times = {'measurement' : measTime, 'sensorsetbuffer' : measTime + 50}
+                if name == 'fleet':
+                    list(dispatch_v2.translate(index, sampleDatamap(i, measTime), uniqId, times))
+                else:
+                    vals = {'timestamp': {'absolute or relative': 'relative', 'unit': 'milliseconds'}, 'data': [{'timestamp': i * 1000 + k * 20, 'values': [rand.randrange(-200, 200), rand.randrange(-200, 200), 1024 + rand.randrange(-50, 50)]} for k in range(50)]}
+                    tsdbuf_v2.tsdProcess(vals, times, generaltags_v2.accelerometerSetter, uniqId, 'accelerometerA', True, generaltags_v2.accelTransform(12))
+        datasets[name] = list(tsdbuf_v2.tsdbufChunkBuffer)
+    del tsdbuf_v2.tsdbufChunkBuffer[:]
+    zlibLevel = chunkcodec_v2.CHUNKCODEC_ZLIB_LEVEL
+    for name, records in datasets.items():
+        for historyFormat, level in [('json', zlibLevel), ('columnar', 0), ('columnar', zlibLevel)]:
+            chunkcodec_v2.CHUNKCODEC_ZLIB_LEVEL = level
+            label = '{}, {}{}, {} records'.format(name, historyFormat, ' zlib {}'.format(level) if historyFormat == 'columnar' and level else '', len(records))
+            size = sum(len(data) for key, data, count in tsdbuf_v2.tsdbufChunkEncode(records, historyFormat))
+            print('{}: {} bytes ({:.1f} bytes/record)'.format(label, size, size / len(records)))
+            report('tsdbufChunkEncode ' + label, lambda: tsdbuf_v2.tsdbufChunkEncode(records, historyFormat), 5)
+        chunkcodec_v2.CHUNKCODEC_ZLIB_LEVEL = zlibLevel
+        chunks = tsdbuf_v2.tsdbufChunkEncode(records, 'columnar')
+        report('chunkcodec_v2.decodeChunk {}, {} records'.format(name, len(records)), lambda: [chunkcodec_v2.decodeChunk(data) for key, data, count in chunks], 5)
+
+
+if __name__ == '__main__':
+    for name in (sys.argv[1:] or BENCHMARKS.keys()):
+        print('## {} ##'.format(name))
+        BENCHMARKS[name]()
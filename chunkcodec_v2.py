@@ -0,0 +1,223 @@
+# columnar encoding of long-term history chunks
+#
+# A chunk holds the samples of one data field of many devices. Instead of one JSON object for each sample, the chunk is stored as columns
+# (device identifiers, sample counts, measurement times, sensorsetbuffer times and values) of the samples of every device one after the other:
+# - integers are stored as zigzag varints of their differences (delta-of-delta for timestamps, so regular sampling costs about a byte per sample),
+# - sensorsetbuffer times are stored as differences from the measurement times,
+# - floats are stored as float32 if that is exact, float64 otherwise, strings by a string table,
+# - lists of equal length are stored as a column for each element, anything else (e.g. mixed types) as a JSON column.
+# The encoded chunk is zlib-compressed if that makes it smaller. decodeChunk() returns the JSON layout of tsdbuf_v2.tsdbufChunkOutStructs().
+from itertools import accumulate
+import struct
+import zlib
+import codec_v2
+
+
+# encoding parameters
+CHUNKCODEC_MAGIC = b'TSC1'   # header of encoded chunks (format version 1)
+CHUNKCODEC_ZLIB_LEVEL = 1   # zlib compression level of encoded chunks (0: no compression)
+
+# flags after the header
+FLAG_ZLIB = 0x01   # payload is zlib-compressed
+
+# column kinds
+KIND_NONE = 0   # every value is None
+KIND_INT = 1   # integers: order byte (number of differencing passes), zigzag varints
+KIND_FLOAT32 = 2   # floats exactly representable as float32: little-endian float32 array
+KIND_FLOAT64 = 3   # floats: little-endian float64 array
+KIND_STR = 4   # strings: string table (count, length-prefixed UTF-8 strings), index varints
+KIND_LIST = 5   # lists of equal length: length varint, a column for each element
+KIND_JSON = 6   # anything else: length-prefixed JSON array
+
+# differencing order of integer columns
+ORDER_VALUE = 1   # deltas, for values
+ORDER_TIME = 2   # delta-of-deltas, for timestamps
+
+
+def putVarint(out, n):   # append an unsigned integer as varint to a bytearray
+    while n >= 0x80:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def getVarint(data, pos):   # read a varint; returns (value, position after it)
+    n = 0
+    shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        n |= (b & 0x7F) << shift
+        if b < 0x80:
+            return n, pos
+        shift += 7
+
+
+def differences(values, order):   # values[:order] followed by the order-th differences (order 2: first value, first delta, delta-of-deltas)
+    for k in range(order):
+        values = values[:k + 1] + [b - a for a, b in zip(values[k:], values[k + 1:])]
+    return values
+
+
+def undifferences(values, order):   # inverse of differences()
+    for k in reversed(range(order)):
+        values = values[:k] + list(accumulate(values[k:]))
+    return values
+
+
+def encodeInts(out, values, order):
+    out.append(order)
+    for n in differences(values, order):
+        n = n << 1 if n >= 0 else (-n << 1) - 1   # zigzag
+        while n >= 0x80:
+            out.append((n & 0x7F) | 0x80)
+            n >>= 7
+        out.append(n)
+
+
+def decodeInts(data, pos, count):
+    order = data[pos]
+    pos += 1
+    values = []
+    for _ in range(count):
+        n, pos = getVarint(data, pos)
+        values.append(n >> 1 if not n & 1 else -((n + 1) >> 1))
+    return undifferences(values, order), pos
+
+
+def encodeColumn(out, values, order = ORDER_VALUE):   # append a column of values (its length is known by the reader)
+# param[in] order:   differencing order if the values are integers
+
+    kinds = {type(value) for value in values}
+    if kinds <= {type(None)}:
+        out.append(KIND_NONE)
+    elif kinds == {int}:
+        out.append(KIND_INT)
+        encodeInts(out, values, order)
+    elif kinds == {float}:
+        try:
+            packed = struct.pack('<{}f'.format(len(values)), *values)
+        except OverflowError:   # out of float32 range
+            packed = None
+        if packed is not None and list(struct.unpack('<{}f'.format(len(values)), packed)) == values:   # exact (NaN is never equal: stored as float64)
+            out.append(KIND_FLOAT32)
+        else:
+            out.append(KIND_FLOAT64)
+            packed = struct.pack('<{}d'.format(len(values)), *values)
+        out += packed
+    elif kinds == {str}:
+        out.append(KIND_STR)
+        table = {}
+        for value in values:
+            table.setdefault(value, len(table))
+        putVarint(out, len(table))
+        for value in table:
+            encoded = value.encode()
+            putVarint(out, len(encoded))
+            out += encoded
+        encodeInts(out, [table[value] for value in values], 0)
+    elif kinds == {list} and len({len(value) for value in values}) == 1 and values[0]:
+        out.append(KIND_LIST)
+        putVarint(out, len(values[0]))
+        for column in zip(*values):
+            encodeColumn(out, list(column), order)
+    else:
+        out.append(KIND_JSON)
+        encoded = codec_v2.dumpb(values)
+        putVarint(out, len(encoded))
+        out += encoded
+
+
+def decodeColumn(data, pos, count):   # read a column of count values; returns (list of values, position after it)
+    kind = data[pos]
+    pos += 1
+    if kind == KIND_NONE:
+        return [None] * count, pos
+    if kind == KIND_INT:
+        return decodeInts(data, pos, count)
+    if kind == KIND_FLOAT32 or kind == KIND_FLOAT64:
+        fmt = '<{}{}'.format(count, 'f' if kind == KIND_FLOAT32 else 'd')
+        end = pos + struct.calcsize(fmt)
+        return list(struct.unpack(fmt, data[pos:end])), end
+    if kind == KIND_STR:
+        tableSize, pos = getVarint(data, pos)
+        table = []
+        for _ in range(tableSize):
+            length, pos = getVarint(data, pos)
+            table.append(bytes(data[pos:pos + length]).decode())
+            pos += length
+        indexes, pos = decodeInts(data, pos, count)
+        return [table[index] for index in indexes], pos
+    if kind == KIND_LIST:
+        length, pos = getVarint(data, pos)
+        columns = []
+        for _ in range(length):
+            column, pos = decodeColumn(data, pos, count)
+            columns.append(column)
+        return [list(value) for value in zip(*columns)], pos
+    if kind == KIND_JSON:
+        length, pos = getVarint(data, pos)
+        return codec_v2.loads(bytes(data[pos:pos + length])), pos + length
+    raise ValueError('unknown column kind {}'.format(kind))
+
+
+def encodeChunk(devices):   # encode the samples of a data field (bytes)
+# param[in] devices:   device identifier -> (list of measurement times, list of sensorsetbuffer times, list of values), in sample order
+
+    measTimes = []
+    ssbTimes = []
+    values = []
+    for deviceMeasTimes, deviceSsbTimes, deviceValues in devices.values():
+        measTimes.extend(deviceMeasTimes)
+        ssbTimes.extend(deviceSsbTimes)
+        values.extend(deviceValues)
+    out = bytearray()
+    putVarint(out, len(devices))
+    encodeColumn(out, list(devices.keys()))
+    encodeInts(out, [len(device[0]) for device in devices.values()], 0)
+    putVarint(out, len(measTimes))
+    encodeColumn(out, measTimes, ORDER_TIME)
+    if all(type(t) is int for t in ssbTimes) and all(type(t) is int for t in measTimes):   # sensorsetbuffer times relative to the measurement times
+        out.append(1)
+        encodeColumn(out, [s - m for s, m in zip(ssbTimes, measTimes)], ORDER_TIME)
+    else:
+        out.append(0)
+        encodeColumn(out, ssbTimes, ORDER_TIME)
+    encodeColumn(out, values)
+    if CHUNKCODEC_ZLIB_LEVEL:
+        compressed = zlib.compress(out, CHUNKCODEC_ZLIB_LEVEL)
+        if len(compressed) < len(out):
+            return CHUNKCODEC_MAGIC + bytes([FLAG_ZLIB]) + compressed
+    return CHUNKCODEC_MAGIC + b'\x00' + bytes(out)
+
+
+def decodeChunkColumns(data):   # decode an encoded chunk; returns device identifier -> (list of measurement times, list of sensorsetbuffer times, list of values)
+    if data[:len(CHUNKCODEC_MAGIC)] != CHUNKCODEC_MAGIC:
+        raise ValueError('not an encoded chunk')
+    flags = data[len(CHUNKCODEC_MAGIC)]
+    data = memoryview(data)[len(CHUNKCODEC_MAGIC) + 1:]
+    if flags & FLAG_ZLIB:
+        data = zlib.decompress(data)
+    deviceCount, pos = getVarint(data, 0)
+    identifiers, pos = decodeColumn(data, pos, deviceCount)
+    counts, pos = decodeInts(data, pos, deviceCount)
+    sampleCount, pos = getVarint(data, pos)
+    measTimes, pos = decodeColumn(data, pos, sampleCount)
+    relative = data[pos]
+    ssbTimes, pos = decodeColumn(data, pos + 1, sampleCount)
+    if relative:
+        ssbTimes = [s + m for s, m in zip(ssbTimes, measTimes)]
+    values, pos = decodeColumn(data, pos, sampleCount)
+    devices = {}
+    start = 0
+    for identifier, count in zip(identifiers, counts):
+        devices[identifier] = (measTimes[start:start + count], ssbTimes[start:start + count], values[start:start + count])
+        start += count
+    return devices
+
+
+def decodeChunk(data):   # decode an encoded chunk to the JSON layout: [{'id', 'changes': [{'dcmTime', 'measurementTime', 'sensorsetbufferTime', 'value'}]}]
+    return [
+        {'id' : identifier, 'changes' : [{'dcmTime' : m, 'measurementTime' : m, 'sensorsetbufferTime' : s, 'value' : v} for m, s, v in zip(*columns)]}
+        for identifier, columns in decodeChunkColumns(data).items()
+    ]
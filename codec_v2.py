@@ -0,0 +1,80 @@
+import os
+import json
+import logging
+
+
+# JSON codec selection: 'auto' picks the fastest installed codec (orjson, ujson, json)
+JSON_CODEC = os.environ.get('TRANSLATOR_JSON_CODEC', 'auto')
+
+
+def _jsonLoads(data):
+    return json.loads(data)
+
+def _jsonDumpb(obj):
+    return json.dumps(obj, separators = (',', ':')).encode()
+
+CODECS = {'json' : (_jsonLoads, _jsonDumpb)}   # available codecs: name -> (loads(bytes or str), dumpb(obj) -> bytes)
+
+try:
+    import ujson
+
+    def _ujsonDumpb(obj):
+        try:
+            return ujson.dumps(obj, ensure_ascii = False).encode()
+        except OverflowError:   # e.g. integers out of 64-bit range
+            return _jsonDumpb(obj)
+
+    CODECS['ujson'] = (ujson.loads, _ujsonDumpb)
+except ImportError:
+    pass
+
+try:
+    import orjson
+
+    def _orjsonDumpb(obj):
+        try:
+            return orjson.dumps(obj)
+        except TypeError:   # e.g. integers out of 64-bit range
+            return _jsonDumpb(obj)
+
+    CODECS['orjson'] = (orjson.loads, _orjsonDumpb)
+except ImportError:
+    pass
+
+
+def selectCodec(name):   # select the codec used by loads() and dumpb()
+    global codecName
+    global loads
+    global dumpb
+
+    if name == 'auto':
+        name = next(n for n in ['orjson', 'ujson', 'json'] if n in CODECS)
+    elif name not in CODECS:
+        logging.warning("JSON codec '%s' is not available, using 'json'.", name)
+        name = 'json'
+    codecName = name
+    loads, dumpb = CODECS[name]
+
+
+class RawJson(bytes):   # pre-encoded JSON value (e.g. spliced from a raw message), inserted into the encoded patches as is
+    __slots__ = ()
+
+
+def encodePatch(patch):   # encode a JSON patch operation (bytes), its value may be RawJson
+    value = patch['value']
+    if type(value) is RawJson:   # encoded with a null placeholder ('"value":null' cannot occur in an encoded string before it)
+        return dumpb(dict(patch, value = None)).replace(b'"value":null', b'"value":' + value, 1)
+    return dumpb(patch)
+
+
+def encodeFrame(patches):   # encode a list of JSON patch operations to one websocket frame (bytes)
+    for patch in patches:
+        if type(patch['value']) is RawJson:
+            return b'[' + b','.join([encodePatch(patch) for patch in patches]) + b']'
+    return dumpb(patches)
+
+
+codecName = 'json'   # name of the selected codec
+loads = _jsonLoads   # decode JSON from bytes or str
+dumpb = _jsonDumpb   # encode to JSON bytes
+selectCodec(JSON_CODEC)
@@ -0,0 +1,189 @@
+from collections import OrderedDict
+import glob
+import io
+import logging
+import os
+import pickle
+import sys
+import threading
+import time
+
+
+# device state parameters
+DEVSTATE_TTL_SEC = 24 * 3600   # state of devices without messages for this long is evicted (and not loaded from snapshots)
+DEVSTATE_MAX_DEVICES = 200000   # maximum number of devices, the least recently seen ones are evicted above it
+DEVSTATE_EVICT_INTERVAL_SEC = 60   # interval (sec) of evicting idle devices
+DEVSTATE_SNAPSHOT_INTERVAL_SEC = 60   # interval (sec) of writing snapshots
+DEVSTATE_DIR = os.environ.get('TRANSLATOR_STATE_DIR', '')   # directory of the snapshot files (devstate-<name>.pickle), no snapshots if empty
+DEVSTATE_SNAPSHOT_BATCH_SIZE = 1000   # number of devices pickled in one call when writing a snapshot (the pickling thread holds the GIL only for short times)
+DEVSTATE_SNAPSHOT_VERSION = 2   # 2: header and batches of devices, 1: one pickled object (still loaded)
+
+
+class DeviceState:   # state of a device kept by the translator modules
+    __slots__ = ['lastSeen', 'timesyncOffset', 'latestMeasTimes', 'tickCountFormer', 'tickCountLast']
+
+    def __init__(self, lastSeen, timesyncOffset = None, latestMeasTimes = None, tickCountFormer = None, tickCountLast = None):
+        self.lastSeen = lastSeen   # time (time.time) of the last message of the device
+        self.timesyncOffset = timesyncOffset   # clock offset estimate (usec), None if not estimated yet
+        self.latestMeasTimes = latestMeasTimes if latestMeasTimes is not None else {}   # data field -> measurement time of the latest TSD data
+        self.tickCountFormer = tickCountFormer   # (measurement time, tick count) before tickCountLast, None if not known
+        self.tickCountLast = tickCountLast   # latest (measurement time, tick count), None if not known
+
+    def asTuple(self):
+        return (self.lastSeen, self.timesyncOffset, dict(self.latestMeasTimes), self.tickCountFormer, self.tickCountLast)
+
+
+class DeviceStateStore:   # device identifier -> DeviceState, least recently seen first; the store is used by a single thread (the event loop or the translation worker), other threads only get copies
+# param[in] ttlSec:       devices without messages for this long are evicted
+# param[in] maxDevices:   maximum number of devices
+
+    def __init__(self, ttlSec, maxDevices):
+        self.ttlSec = ttlSec
+        self.maxDevices = maxDevices
+        self.devices = OrderedDict()
+        self.evictCount = 0   # number of evicted devices
+
+    def __len__(self):
+        return len(self.devices)
+
+    def values(self):   # list of the states (a copy, the states themselves are shared)
+        return list(self.devices.values())
+
+    def copy(self):   # (list of device identifiers, list of their states): C-level copies, cheap enough for the thread using the states, to dump them in another thread
+        return list(self.devices), list(self.devices.values())
+
+    def get(self, identifier):   # state of a device, None if it is not known
+        return self.devices.get(identifier)
+
+    def record(self, identifier):   # state of a device, created if it is not known
+        state = self.devices.get(identifier)
+        if state is None:
+            state = self.devices[identifier] = DeviceState(time.time())
+            if len(self.devices) > self.maxDevices:
+                self.devices.popitem(last = False)
+                self.evictCount += 1
+        return state
+
+    def touch(self, identifier):   # a message of a device arrived: mark it as the most recently seen one, returns its state
+        state = self.devices.get(identifier)
+        if state is None:
+            return self.record(identifier)
+        state.lastSeen = time.time()
+        self.devices.move_to_end(identifier)
+        return state
+
+    def evictIdle(self, now):   # evict the devices not seen for ttlSec
+        limit = now - self.ttlSec
+        while self.devices:
+            identifier, state = next(iter(self.devices.items()))
+            if state.lastSeen >= limit:
+                break
+            del self.devices[identifier]
+            self.evictCount += 1
+
+    def footprint(self):   # approximate memory footprint (bytes)
+        total = sys.getsizeof(self.devices)
+        for state in self.values():
+            total += sys.getsizeof(state) + sys.getsizeof(state.latestMeasTimes) + 2 * sys.getsizeof((0, 0)) + len(state.latestMeasTimes) * sys.getsizeof(2 ** 60)
+        return total
+
+    def dumps(self, copy = None):   # snapshot of the states (bytes): a header and the devices in batches
+# param[in] copy:   result of copy() in the thread using the states, to dump them in another thread, optional
+        identifiers, states = copy if copy is not None else self.copy()
+        parts = [pickle.dumps({'version' : DEVSTATE_SNAPSHOT_VERSION, 'devices' : len(identifiers)}, protocol = pickle.HIGHEST_PROTOCOL)]
+        for start in range(0, len(identifiers), DEVSTATE_SNAPSHOT_BATCH_SIZE):
+            end = start + DEVSTATE_SNAPSHOT_BATCH_SIZE
+            parts.append(pickle.dumps([(identifier, state.asTuple()) for identifier, state in zip(identifiers[start:end], states[start:end])], protocol = pickle.HIGHEST_PROTOCOL))
+        return b''.join(parts)
+
+    def loads(self, data, keep = None):   # merge a snapshot: devices not seen for ttlSec and those rejected by keep(identifier) are skipped, the more recent state wins; returns the number of loaded devices
+        stream = io.BytesIO(data)
+        header = pickle.load(stream)
+        if header.get('version') == 1:
+            batches = [header['devices']]
+        elif header.get('version') == DEVSTATE_SNAPSHOT_VERSION:
+            batches = []
+            while stream.tell() < len(data):
+                batches.append(pickle.load(stream))
+        else:
+            return 0
+        limit = time.time() - self.ttlSec
+        count = 0
+        for identifier, fields in (device for batch in batches for device in batch):
+            if fields[0] < limit or (keep is not None and not keep(identifier)):
+                continue
+            current = self.devices.get(identifier)
+            if current is None or current.lastSeen < fields[0]:
+                self.devices[identifier] = DeviceState(*fields)
+                count += 1
+        self.devices = OrderedDict(sorted(self.devices.items(), key = lambda item: item[1].lastSeen))
+        return count
+
+    def stats(self):   # store statistics
+        return {'devices' : len(self.devices), 'evicted' : self.evictCount, 'bytes' : self.footprint()}
+
+
+## variables ##
+deviceStates = DeviceStateStore(DEVSTATE_TTL_SEC, DEVSTATE_MAX_DEVICES)   # state of the devices handled by this process
+devstateSnapshotPath = None   # snapshot file of this process, None if snapshots are disabled
+devstateEvictLastTime = 0.0
+devstateSnapshotLastTime = 0.0
+devstateSnapshotWriting = False   # a snapshot is being written by a background thread
+
+
+def devstateStart(name, keep = None):   # load the snapshots of every process and enable snapshots of this process (devstate-<name>.pickle)
+# param[in] keep:   function(identifier) -> boolean, only the devices it accepts are loaded (e.g. the devices of a shard), optional
+    global devstateSnapshotPath
+    global devstateSnapshotLastTime
+
+    if not DEVSTATE_DIR:
+        return
+    devstateSnapshotPath = os.path.join(DEVSTATE_DIR, 'devstate-{}.pickle'.format(name))
+    devstateSnapshotLastTime = time.time()
+    for path in glob.glob(os.path.join(DEVSTATE_DIR, 'devstate-*.pickle')):   # devices may have been handled by another process before (e.g. other number of shards)
+        try:
+            with open(path, 'rb') as f:
+                count = deviceStates.loads(f.read(), keep)
+            logging.info("Device state of %u device(s) loaded from '%s'.", count, path)
+        except BaseException as e:
+            logging.warning("Cannot load device state snapshot '%s' (%s: %s).", path, type(e).__name__, str(e))
+
+
+def devstateWrite(path, copy):   # dump the copied states (DeviceStateStore.copy) and write the snapshot atomically
+    global devstateSnapshotWriting
+
+    try:
+        data = deviceStates.dumps(copy)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(path + '.tmp', path)
+    except OSError as e:
+        logging.warning("Cannot write device state snapshot '%s' (%s).", path, str(e))
+    finally:
+        devstateSnapshotWriting = False
+
+
+def devstateSnapshot(background = True):   # write a snapshot of the device states (the states are copied here, pickled and written in a background thread)
+    global devstateSnapshotWriting
+
+    if devstateSnapshotPath is None or devstateSnapshotWriting:
+        return
+    devstateSnapshotWriting = True
+    copy = deviceStates.copy()
+    if background:
+        threading.Thread(target = devstateWrite, args = (devstateSnapshotPath, copy), name = 'translator-devstate-snapshot', daemon = True).start()
+    else:
+        devstateWrite(devstateSnapshotPath, copy)
+
+
+def devstateMaintain():   # periodic eviction and snapshot, called by the thread using the states (e.g. once for each message)
+    global devstateEvictLastTime
+    global devstateSnapshotLastTime
+
+    now = time.time()
+    if now - devstateEvictLastTime >= DEVSTATE_EVICT_INTERVAL_SEC:
+        devstateEvictLastTime = now
+        deviceStates.evictIdle(now)
+    if devstateSnapshotPath is not None and now - devstateSnapshotLastTime >= DEVSTATE_SNAPSHOT_INTERVAL_SEC:
+        devstateSnapshotLastTime = now
+        devstateSnapshot()
@@ -0,0 +1,95 @@
+import logging
+import time
+import traceback
+import metrics_v2
+from collections import namedtuple
+
+
+# dispatch index built once at startup from the translator modules
+#   handlers:       LoLaN variable name -> list of dispatchEntryType
+#   prepareHooks:   functions(times, identifier) called once for each message before the handlers (translator_prepare of the modules, without duplicates)
+dispatchIndexType = namedtuple('dispatchIndexType', ['handlers', 'prepareHooks'])
+dispatchEntryType = namedtuple('dispatchEntryType', ['rank', 'lolan', 'module', 'handler', 'timing'])   # rank: position in module and handler definition order, timing: metrics_v2 histogram record of the module
+
+
+metrics_v2.describe('translator_handler_seconds', 'summary', 'Time spent in the LoLaN variable handlers of a translator module.')
+metrics_v2.describe('translator_handler_errors_total', 'counter', 'Exceptions raised by the LoLaN variable handlers and the prepare hook of a translator module.')
+
+
+def buildDispatchIndex(modules):   # build the dispatch index from translator modules (each module has a lolanHandlers dict and an optional translator_prepare function)
+    handlers = {}
+    prepareHooks = []
+    rank = 0
+    for module in modules:
+        hook = getattr(module, 'translator_prepare', None)
+        if hook is not None and hook not in prepareHooks:
+            prepareHooks.append(hook)
+        for lolan, handler in module.lolanHandlers.items():
+            handlers.setdefault(lolan, []).append(dispatchEntryType(rank, lolan, module.__name__, handler, metrics_v2.histogram('translator_handler_seconds', (('module', module.__name__),))))
+            rank += 1
+    return dispatchIndexType(handlers, prepareHooks)
+
+
+def moduleTasks(modules):   # background task functions (coroutine functions in translator_tasks) of translator modules, without duplicates
+    tasks = []
+    for module in modules:
+        for task in getattr(module, 'translator_tasks', []):
+            if task not in tasks:
+                tasks.append(task)
+    return tasks
+
+
+def translate(dispatchIndex, datamap, identifier, times):   # translate a datamap, yields the lists of data out items
+    for hook in dispatchIndex.prepareHooks:
+        try:
+            hook(times, identifier)
+        except BaseException as e:   # e.g. invalid times in the header: the rest of the hook (TSD buffering process) is skipped for this message, the handlers still run
+            metrics_v2.counterInc('translator_handler_errors_total', (('module', hook.__module__),))
+            logging.error(
+                "Exception '%s' with message '%s' in translator prepare hook '%s.%s'\n%s",
+                type(e).__name__, str(e), hook.__module__, hook.__name__, traceback.format_exc()
+            )
+    # look up the LoLaN variables present in the datamap, iterating over the smaller one
+    handlers = dispatchIndex.handlers
+    if len(datamap) <= len(handlers):
+        entries = [entry for lolan in datamap if lolan in handlers for entry in handlers[lolan]]
+    else:
+        entries = [entry for lolan, lolanEntries in handlers.items() if lolan in datamap for entry in lolanEntries]
+    if len(entries) > 1:
+        entries.sort()   # keep the definition order of the handlers (e.g. tick count data is stored after the scan time is computed)
+    # invoke handlers
+    for entry in entries:
+        start = time.perf_counter()
+        try:
+            outList = entry.handler(datamap[entry.lolan], identifier, times)
+        except BaseException as e:
+            metrics_v2.counterInc('translator_handler_errors_total', (('module', entry.module),))
+            logging.error(
+                "Exception '%s' with message '%s' in translator module '%s'\n%s",
+                type(e).__name__, str(e), entry.module, traceback.format_exc()
+            )
+            continue
+        finally:
+            metrics_v2.observe(entry.timing, time.perf_counter() - start)
+        if outList:
+            yield outList
+
+
+def translateMessage(dispatchIndex, jsondata):   # translate a decoded BDCL message, yields the lists of data out items
+    # extract data
+    datamap = jsondata.get('data', None)
+    header = jsondata.get('header', {})
+    unqId = header.get('uniqId', None)
+    measTime = header.get('measTs', None)
+    ssTime = header.get('serverTs', None)
+    # error check
+    if datamap is None or unqId is None:
+        return
+    # measurement time check
+    if measTime is None:
+        if ssTime is None:
+            logging.warning("Neither measurement time nor sensorSetBuffer time present for data from '%u'.", unqId)
+        else:
+            measTime = ssTime
+            logging.debug("No measurement time for this data from '%u', assuming that sensorSetBuffer time is also the measurement time.", unqId)
+    yield from translate(dispatchIndex, datamap, unqId, {'measurement' : measTime, 'sensorsetbuffer' : ssTime})   # FIXME
@@ -0,0 +1,205 @@
+import asyncio
+from collections import deque
+import itertools
+import logging
+import os
+import re
+import socket
+import metrics_v2
+import outqueue_v2
+import shard_v2
+
+
+# ingest modes
+INGEST_PUBSUB = 'pubsub'   # messages are read from the BDCL pub/sub channels (lost while the translator is not running)
+INGEST_STREAMS = 'streams'   # messages are read from partitioned Redis streams with a consumer group, acknowledged after they were sent
+INGEST_BRIDGE = 'bridge'   # messages of the pub/sub channels are added to the streams (no translation)
+INGEST_MODES = [INGEST_PUBSUB, INGEST_STREAMS, INGEST_BRIDGE]
+
+# stream parameters
+INGEST_STREAM_FORMAT = 'translator/ingest/{}'   # stream key of each partition
+INGEST_STREAM_PARTITIONS = int(os.environ.get('TRANSLATOR_STREAM_PARTITIONS', '16'))   # number of partitions, messages are partitioned by device (must be the same for the bridge and every instance)
+INGEST_STREAM_MAXLEN = 1000000   # approximate maximum length of each stream (the bridge trims the oldest entries above it)
+INGEST_GROUP = 'translator'   # consumer group of the translator instances
+INGEST_CONSUMER = os.environ.get('TRANSLATOR_CONSUMER', socket.gethostname())   # consumer name of this instance
+INGEST_INSTANCE = os.environ.get('TRANSLATOR_INSTANCE', '0/1')   # 'index/count': this instance reads the partitions p with p % count == index, the instances must not share partitions (device state stays in one instance)
+INGEST_READ_COUNT = 500   # maximum number of entries read from each stream in one XREADGROUP
+INGEST_READ_BLOCK_MS = 1000   # maximum wait (msec) of XREADGROUP for new entries
+INGEST_ACK_INTERVAL_SEC = 0.1   # interval (sec) of acknowledging the sent entries
+INGEST_MAX_PENDING = int(os.environ.get('TRANSLATOR_INGEST_MAX_PENDING', '20000'))   # no more entries are read while this many read entries are not acknowledged (e.g. DCM is not available), the backlog stays in the streams
+INGEST_RETRY_SEC = 1.0   # delay (sec) after a failed stream command
+INGEST_BRIDGE_BATCH_MAX_SIZE = 500   # maximum number of entries added to the streams in one pipelined round trip
+INGEST_BRIDGE_LINGER_MS = 5   # maximum time (msec) a message waits for others before they are added to the streams
+INGEST_BRIDGE_QUEUE_MAX_SIZE = 100000   # maximum number of messages waiting to be added to the streams (the oldest ones are dropped above it)
+
+INGEST_SCL_DEVID_PATTERN = re.compile(rb'"devId"\s*:\s*(\d+)')   # device identifier of a raw SCL message
+
+
+metrics_v2.describe('translator_ingest_entries_total', 'counter', 'Stream entries handled (read, acked, failed: left pending as data made of them was dropped, bridged, dropped by the bridge).')
+
+
+def partitionOf(channelName, raw, partitions, sclChannel):   # stream partition of a raw BDCL or SCL message, by device
+    if channelName == sclChannel:
+        match = INGEST_SCL_DEVID_PATTERN.search(raw)
+        key = int(match.group(1)) if match is not None else None
+    else:
+        key = shard_v2.shardKey(raw)
+    return shard_v2.shardOf(key, partitions)
+
+
+def ownedPartitions(instance, partitions):   # partitions read by an instance ('index/count')
+    index, count = (int(part) for part in instance.split('/'))
+    return [partition for partition in range(partitions) if partition % count == index]
+
+
+class IngestTracker:   # acknowledgement watermark of stream entries: an entry is acknowledged when it was translated and every data out item made of it was sent (or deliberately dropped), in read order for each stream; failed entries are not acknowledged (they stay pending and are read again after a restart)
+
+    def __init__(self):
+        self.entries = {}   # token -> [stream, entry ID, number of holders (the translation and each data out item), failed]
+        self.order = {}   # stream -> tokens in read order (deque)
+        self.sequence = itertools.count()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, stream, entryId):   # a read entry, held by its translation until release(); returns its token
+        token = next(self.sequence)
+        self.entries[token] = [stream, entryId, 1, False]
+        self.order.setdefault(stream, deque()).append(token)
+        return token
+
+    def hold(self, token):   # a data out item is made of the entry
+        self.entries[token][2] += 1
+
+    def release(self, token):   # the translation of the entry is done, or a data out item of it was sent (or dropped)
+        self.entries[token][2] -= 1
+
+    def fail(self, token):   # data made of the entry was lost (e.g. queue overflow): it is not acknowledged, still released by its holders
+        entry = self.entries[token]
+        if not entry[3]:
+            entry[3] = True
+            metrics_v2.counterInc('translator_ingest_entries_total', (('result', 'failed'),))
+
+    def ackable(self):   # remove the released entries and return those to acknowledge (the failed ones are skipped): stream -> list of entry IDs
+        result = {}
+        for stream, tokens in self.order.items():
+            while tokens and self.entries[tokens[0]][2] <= 0:
+                entry = self.entries.pop(tokens.popleft())
+                if not entry[3]:
+                    result.setdefault(stream, []).append(entry[1])
+        return result
+
+
+class StreamIngest:   # reader of the partitioned streams of an instance with a consumer group
+# param[in] redis:       Redis client (aioredis)
+# param[in] partitions:  partitions to read
+# param[in] group:       consumer group name
+# param[in] consumer:    consumer name
+
+    def __init__(self, redis, partitions, group = INGEST_GROUP, consumer = INGEST_CONSUMER):
+        self.redis = redis
+        self.streams = [INGEST_STREAM_FORMAT.format(partition) for partition in partitions]
+        self.group = group
+        self.consumer = consumer
+        self.tracker = IngestTracker()
+        self.recovering = {}   # stream -> last read ID of the pending entries of this consumer (read first after a restart)
+
+    async def start(self):   # create the consumer group, take over the pending entries of former consumers
+        for stream in self.streams:
+            try:
+                await self.redis.xgroup_create(stream, self.group, id = '0', mkstream = True)
+            except Exception as e:
+                if 'BUSYGROUP' not in str(e):   # exists
+                    raise
+            try:   # entries read by a former consumer of the partition (e.g. other host name) but not acknowledged
+                cursor = '0-0'
+                while True:
+                    reply = await self.redis.execute_command('XAUTOCLAIM', stream, self.group, self.consumer, 0, cursor, 'COUNT', INGEST_READ_COUNT, 'JUSTID')
+                    cursor = reply[0].decode() if isinstance(reply[0], bytes) else reply[0]
+                    if cursor == '0-0':
+                        break
+            except Exception as e:   # Redis before 6.2: only the pending entries of this consumer are read again
+                logging.warning("Cannot claim pending entries of stream '%s' (%s).", stream, str(e))
+            self.recovering[stream] = '0'
+        logging.info("Reading %u stream partition(s) as consumer '%s' of group '%s'.", len(self.streams), self.consumer, self.group)
+
+    async def read(self):   # read the next entries (pending entries of this consumer first), wait while INGEST_MAX_PENDING entries are not acknowledged; returns list of (token, channel name, raw message)
+        while len(self.tracker) >= INGEST_MAX_PENDING:
+            await asyncio.sleep(INGEST_ACK_INTERVAL_SEC)
+        if self.recovering:
+            reply = await self.redis.xreadgroup(self.group, self.consumer, dict(self.recovering), count = INGEST_READ_COUNT)
+            for stream, entries in reply:
+                stream = stream.decode() if isinstance(stream, bytes) else stream
+                if entries:
+                    self.recovering[stream] = entries[-1][0]
+                else:   # every pending entry is read
+                    del self.recovering[stream]
+            if not reply:
+                self.recovering.clear()
+        else:
+            reply = await self.redis.xreadgroup(self.group, self.consumer, {stream : '>' for stream in self.streams}, count = INGEST_READ_COUNT, block = INGEST_READ_BLOCK_MS)
+        messages = []
+        for stream, entries in reply:
+            stream = stream.decode() if isinstance(stream, bytes) else stream
+            for entryId, fields in entries:
+                token = self.tracker.add(stream, entryId)
+                if not fields or b'data' not in fields:   # trimmed meanwhile
+                    self.tracker.release(token)
+                    continue
+                messages.append((token, fields[b'channel'].decode('ascii'), fields[b'data']))
+        metrics_v2.counterInc('translator_ingest_entries_total', (('result', 'read'),), len(messages))
+        return messages
+
+    async def ack(self):   # acknowledge the sent entries
+        ackable = self.tracker.ackable()
+        if not ackable:
+            return
+        pipe = self.redis.pipeline(transaction = False)
+        for stream, entryIds in ackable.items():
+            pipe.xack(stream, self.group, *entryIds)
+        await pipe.execute()
+        metrics_v2.counterInc('translator_ingest_entries_total', (('result', 'acked'),), sum(len(entryIds) for entryIds in ackable.values()))
+
+    async def acker(self):   # task: acknowledge the sent entries periodically
+        while True:
+            await asyncio.sleep(INGEST_ACK_INTERVAL_SEC)
+            try:
+                await self.ack()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:   # the entries stay pending, they are read again after a restart
+                logging.warning("Cannot acknowledge stream entries (%s).", str(e))
+
+
+async def bridge(pubsub, redis, sclChannel, partitions = INGEST_STREAM_PARTITIONS):   # add the messages of the pub/sub channels to the partitioned streams, many entries in one pipelined round trip
+# param[in] pubsub:       subscribed pub/sub object of the BDCL and SCL channels (aioredis)
+# param[in] redis:        Redis client of the streams (aioredis)
+# param[in] sclChannel:   pub/sub channel of the SCL messages (partitioned by devId instead of uniqId)
+    pending = outqueue_v2.OutQueue(INGEST_BRIDGE_QUEUE_MAX_SIZE, outqueue_v2.OVERFLOW_DROP_OLDEST)
+
+    async def writer():
+        while True:
+            batch = await pending.getBatch(INGEST_BRIDGE_BATCH_MAX_SIZE, INGEST_BRIDGE_LINGER_MS / 1000)
+            while batch:
+                try:
+                    pipe = redis.pipeline(transaction = False)
+                    for channelName, raw in batch:
+                        pipe.xadd(INGEST_STREAM_FORMAT.format(partitionOf(channelName, raw, partitions, sclChannel)), {'channel' : channelName, 'data' : raw}, maxlen = INGEST_STREAM_MAXLEN, approximate = True)
+                    await pipe.execute()
+                    metrics_v2.counterInc('translator_ingest_entries_total', (('result', 'bridged'),), len(batch))
+                    batch = []
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logging.warning("Cannot add %u message(s) to the streams (%s), retry in %.1f sec.", len(batch), str(e), INGEST_RETRY_SEC)
+                    await asyncio.sleep(INGEST_RETRY_SEC)
+
+    writerTask = asyncio.create_task(writer())
+    logging.info('Bridging pub/sub messages to %u stream partition(s)...', partitions)
+    try:
+        async for message in pubsub.listen():
+            if message is not None and message['type'] == 'pmessage':
+                if not await pending.put((message['channel'].decode('ascii'), message['data'])):
+                    metrics_v2.counterInc('translator_ingest_entries_total', (('result', 'dropped'),))
+    finally:
+        writerTask.cancel()
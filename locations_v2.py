@@ -19,30 +19,32 @@ def gps_transform_ex(data):
     return [[degreesLat + minutesLat / 6000000, degreesLong + minutesLong / 6000000], quality, [velo / 3.6, 0, 0]]
 
 
-def translator_func(data, identifier, times):
-
-    def attrSetter(attr, transform = lambda e: e):
-        return lambda val, newTimes: ([{'coll' : 'locations', 'id' : 'tag.'+str(identifier), 'attr' : attr, 'data' : {'value': transform(val), 'times': newTimes}}])
-
-    def gpsDataExMultiSetter(val, newTimes):
-        return [
-            {'coll' : 'locations', 'id' : 'tag.'+str(identifier), 'attr' : 'gpsPosition', 'data' : {'value': val[0], 'times': newTimes}},
-            {'coll' : 'locations', 'id' : 'tag.'+str(identifier), 'attr' : 'quality', 'data' : {'value': val[1], 'times': newTimes}},
-            {'coll' : 'locations', 'id' : 'tag.'+str(identifier), 'attr' : 'velocity', 'data' : {'value': val[2], 'times': newTimes}}
-        ]
-
-    # TSD buffering process
-    tsdbuf_v2.tsdbufProcess(times)
-
-    # LoLaN variable translator definitions
-    switcher = {
-        'status.lastaccel.ismoving': attrSetter('isMoving', bool),
-        'status.gpsdata_tsd': tsdbuf_v2.tsdProcessor(attrSetter('gpsPosition'), (identifier, 'gpsPosition'), True, gps_transform),
-        'status.gps.gpsdata_tsd': tsdbuf_v2.tsdProcessor(attrSetter('gpsPosition'), (identifier, 'gpsPosition'), True, gps_transform),
-        'status.gps.gpsdata_ex_tsd': tsdbuf_v2.tsdProcessor(gpsDataExMultiSetter, (identifier, 'do not care'), False, gps_transform_ex)
-    }
-
-    # translating procedure
-    for k, setterFunc in switcher.items():
-        if k in data:
-            yield setterFunc(data[k], times)
+def attrSetter(attr, transform = lambda e: e):
+    return lambda val, identifier, newTimes: ([{'coll' : 'locations', 'id' : 'tag.'+str(identifier), 'attr' : attr, 'data' : {'value': transform(val), 'times': newTimes}}])
+
+def gpsDataExMultiSetter(val, identifier, newTimes):
+    tagId = 'tag.'+str(identifier)
+    return [
+        {'coll' : 'locations', 'id' : tagId, 'attr' : 'gpsPosition', 'data' : {'value': val[0], 'times': newTimes}},
+        {'coll' : 'locations', 'id' : tagId, 'attr' : 'quality', 'data' : {'value': val[1], 'times': newTimes}},
+        {'coll' : 'locations', 'id' : tagId, 'attr' : 'velocity', 'data' : {'value': val[2], 'times': newTimes}}
+    ]
+
+gpsPositionSetter = attrSetter('gpsPosition')
+def gpsDataProcessor(xData, identifier, xTimes):
+    return tsdbuf_v2.tsdProcess(xData, xTimes, gpsPositionSetter, identifier, 'gpsPosition', True, gps_transform)
+
+def gpsDataExProcessor(xData, identifier, xTimes):
+    return tsdbuf_v2.tsdProcess(xData, xTimes, gpsDataExMultiSetter, identifier, 'do not care', False, gps_transform_ex)
+
+
+# TSD buffering process, called once for each message before the handlers
+translator_prepare = tsdbuf_v2.tsdbufProcess
+
+# LoLaN variable translator definitions: handler(value, device identifier, times)
+lolanHandlers = {
+    'status.lastaccel.ismoving': attrSetter('isMoving', bool),
+    'status.gpsdata_tsd': gpsDataProcessor,
+    'status.gps.gpsdata_tsd': gpsDataProcessor,
+    'status.gps.gpsdata_ex_tsd': gpsDataExProcessor
+}
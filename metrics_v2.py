@@ -0,0 +1,189 @@
+import asyncio
+import bisect
+import logging
+
+
+# metrics parameters
+METRICS_HISTOGRAM_BOUNDS = [1e-6 * 2 ** k for k in range(24)]   # upper bounds (sec) of the histogram buckets: 1 usec ... 8 sec, the last bucket is unbounded
+METRICS_QUANTILES = [0.5, 0.99]   # quantiles reported for histograms
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'   # Prometheus text exposition format
+
+# pipeline stages
+STAGE_INGEST = 'ingest'   # reading messages from Redis
+STAGE_DECODE = 'decode'   # JSON decoding of BDCL messages
+STAGE_TRANSLATE = 'translate'   # translator modules
+STAGE_ENCODE = 'encode'   # encoding of websocket frames
+STAGE_SEND = 'send'   # sending websocket frames to DCM
+STAGES = [STAGE_INGEST, STAGE_DECODE, STAGE_TRANSLATE, STAGE_ENCODE, STAGE_SEND]
+
+
+## variables ##
+metricsHelp = {}   # metric name -> (type: 'counter', 'gauge' or 'summary', help text)
+metricsCounters = {}   # (name, labels) -> value; labels: tuple of (label name, label value) pairs
+metricsHistograms = {}   # (name, labels) -> [list of bucket counts, sum, count]
+metricsGauges = {}   # (name, labels) -> value, set by the owner of the value (e.g. merged from worker processes)
+metricsCollectors = []   # functions called at export time, each returns a list of (name, labels, value) gauges
+stageLabels = {stage : (('stage', stage),) for stage in STAGES}
+metricsReady = False   # readiness of the application (served on /ready)
+
+
+def describe(name, kind, text):   # set type and help text of a metric
+    metricsHelp[name] = (kind, text)
+
+
+def labels(**kwargs):   # label tuple of keyword arguments (use a prepared tuple on hot paths)
+    return tuple(sorted(kwargs.items()))
+
+
+def counterInc(name, labels = (), value = 1):   # increment a counter
+    key = (name, labels)
+    metricsCounters[key] = metricsCounters.get(key, 0) + value
+
+
+def histogram(name, labels = ()):   # histogram record of a metric (created if needed), it stays valid so hot paths can keep it
+    record = metricsHistograms.get((name, labels))
+    if record is None:
+        record = metricsHistograms[(name, labels)] = [[0] * (len(METRICS_HISTOGRAM_BOUNDS) + 1), 0.0, 0]
+    return record
+
+
+def observe(record, value):   # add an observation (e.g. a duration in sec) to a histogram record
+    record[0][bisect.bisect_left(METRICS_HISTOGRAM_BOUNDS, value)] += 1
+    record[1] += value
+    record[2] += 1
+
+
+def histogramObserve(name, labels, value):   # add an observation to a histogram
+    observe(histogram(name, labels), value)
+
+
+def stageDone(stage, seconds, count = 1):   # count items processed by a pipeline stage and the time spent on them
+    counterInc('translator_stage_items_total', stageLabels[stage], count)
+    counterInc('translator_stage_seconds_total', stageLabels[stage], seconds)
+
+
+describe('translator_stage_items_total', 'counter', 'Items processed by a pipeline stage (messages or frames).')
+describe('translator_stage_seconds_total', 'counter', 'Time spent in a pipeline stage.')
+
+
+def gaugeSet(name, labels, value):   # set a gauge
+    metricsGauges[(name, labels)] = value
+
+
+def setReady(ready):   # set the readiness of the application
+    global metricsReady
+    metricsReady = ready
+    gaugeSet('translator_ready', (), 1 if ready else 0)
+
+
+describe('translator_ready', 'gauge', 'The translator has started up and sends data to DCM (1) or not (0).')
+
+
+def histogramQuantile(histogram, q):   # estimate a quantile of a histogram by linear interpolation in its bucket, None if it is empty
+    counts, total, count = histogram
+    if not count:
+        return None
+    rank = q * count
+    cumulative = 0
+    for i, bucketCount in enumerate(counts):
+        if bucketCount and cumulative + bucketCount >= rank:
+            lower = METRICS_HISTOGRAM_BOUNDS[i - 1] if i > 0 else 0.0
+            if i == len(METRICS_HISTOGRAM_BOUNDS):   # unbounded bucket
+                return lower
+            return lower + (METRICS_HISTOGRAM_BOUNDS[i] - lower) * (rank - cumulative) / bucketCount
+        cumulative += bucketCount
+    return METRICS_HISTOGRAM_BOUNDS[-1]
+
+
+def exportState():   # counters, histograms and gauges accumulated since the last call (reset afterwards), to be merged in another process
+    global metricsCounters
+    global metricsGauges
+
+    histograms = {}
+    for key, record in metricsHistograms.items():   # histogram records are reset in place
+        if record[2]:
+            histograms[key] = (record[0], record[1], record[2])
+            record[:] = [[0] * len(record[0]), 0.0, 0]
+    state = {'counters' : metricsCounters, 'histograms' : histograms, 'gauges' : metricsGauges}
+    metricsCounters = {}
+    metricsGauges = {}
+    return state
+
+
+def mergeState(state):   # merge metrics exported by exportState() in another process (counters and histograms are added, gauges are replaced)
+    for key, value in state['counters'].items():
+        metricsCounters[key] = metricsCounters.get(key, 0) + value
+    for key, (counts, total, count) in state['histograms'].items():
+        histogram = metricsHistograms.get(key)
+        if histogram is None:
+            metricsHistograms[key] = [list(counts), total, count]
+        else:
+            histogram[0] = [a + b for a, b in zip(histogram[0], counts)]
+            histogram[1] += total
+            histogram[2] += count
+    metricsGauges.update(state['gauges'])
+
+
+def formatLabels(labels, extra = ()):
+    labels = labels + extra
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels) + '}'
+
+
+def exposition():   # every metric in Prometheus text format
+    samples = {}   # name -> list of lines
+    for (name, labels), value in metricsCounters.items():
+        samples.setdefault(name, []).append('{}{} {}'.format(name, formatLabels(labels), value))
+    gauges = list(metricsGauges.items())
+    for collector in metricsCollectors:
+        try:
+            gauges.extend(((name, labels), value) for name, labels, value in collector())
+        except BaseException as e:
+            logging.error("Exception '%s' with message '%s' in metrics collector '%s'", type(e).__name__, str(e), collector.__name__)
+    for (name, labels), value in gauges:
+        samples.setdefault(name, []).append('{}{} {}'.format(name, formatLabels(labels), value))
+    for (name, labels), histogram in metricsHistograms.items():
+        lines = samples.setdefault(name, [])
+        for q in METRICS_QUANTILES:
+            value = histogramQuantile(histogram, q)
+            lines.append('{}{} {}'.format(name, formatLabels(labels, (('quantile', q),)), 'NaN' if value is None else '{:.9f}'.format(value)))
+        lines.append('{}_sum{} {:.9f}'.format(name, formatLabels(labels), histogram[1]))
+        lines.append('{}_count{} {}'.format(name, formatLabels(labels), histogram[2]))
+    out = []
+    for name in sorted(samples):
+        if name in metricsHelp:
+            kind, text = metricsHelp[name]
+            out.append('# HELP {} {}'.format(name, text))
+            out.append('# TYPE {} {}'.format(name, kind))
+        out.extend(samples[name])
+    return '\n'.join(out) + '\n'
+
+
+async def metricsRequestHandler(reader, writer):   # minimal HTTP/1.0 handler: GET /metrics, GET /ready (200 if ready, 503 otherwise)
+    try:
+        request = await asyncio.wait_for(reader.readline(), 5.0)
+        while (await asyncio.wait_for(reader.readline(), 5.0)) not in [b'\r\n', b'\n', b'']:   # skip headers
+            pass
+        parts = request.decode('latin-1').split()
+        path = parts[1].split('?', 1)[0] if len(parts) >= 2 and parts[0] == 'GET' else None
+        if path == '/metrics':
+            status, contentType, body = '200 OK', METRICS_CONTENT_TYPE, exposition().encode()
+        elif path == '/ready':
+            status, contentType, body = ('200 OK', 'text/plain', b'ready\n') if metricsReady else ('503 Service Unavailable', 'text/plain', b'starting\n')
+        else:
+            status, contentType, body = '404 Not Found', 'text/plain', b'Not found\n'
+        writer.write('HTTP/1.0 {}\r\nContent-Type: {}\r\nContent-Length: {}\r\nConnection: close\r\n\r\n'.format(status, contentType, len(body)).encode() + body)
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def metricsServer(host, port):   # task serving the metrics on http://host:port/metrics
+    server = await asyncio.start_server(metricsRequestHandler, host, port)
+    logging.info("Metrics are served on http://%s:%u/metrics (readiness: /ready)", host, port)
+    async with server:
+        await server.serve_forever()
+
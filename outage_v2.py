@@ -0,0 +1,137 @@
+import itertools
+import logging
+import mmap
+from collections import deque, OrderedDict
+import codec_v2
+
+
+class SpillRing:   # ring of byte records in a memory-mapped file, the oldest records are dropped when it is full
+# param[in] path:   file path (created or truncated)
+# param[in] size:   file size (bytes)
+
+    def __init__(self, path, size):
+        self.size = size
+        self.file = open(path, 'w+b')
+        self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), size)
+        self.index = deque()   # stored records in ring order: (offset, length)
+        self.tail = 0   # offset after the newest record
+        self.bytes = 0   # size of the stored records
+
+    def __len__(self):
+        return len(self.index)
+
+    def _reserve(self, need):   # offset to write need bytes at, the oldest records are dropped to make space; returns (offset, number of dropped records)
+        dropped = 0
+        while self.index:
+            head = self.index[0][0]
+            if self.tail > head:   # records in [head, tail)
+                if self.size - self.tail >= need:
+                    return self.tail, dropped
+                if head >= need:   # wrap around, the end of the file is left unused
+                    return 0, dropped
+            elif head - self.tail >= need:   # records in [head, size) and [0, tail)
+                return self.tail, dropped
+            self.popleft()
+            dropped += 1
+        return 0, dropped
+
+    def append(self, data):   # store a record; returns the number of dropped records (including data itself if it is larger than the ring)
+        if len(data) > self.size:
+            return 1
+        offset, dropped = self._reserve(len(data))
+        self.map[offset:offset + len(data)] = data
+        self.index.append((offset, len(data)))
+        self.tail = offset + len(data)
+        self.bytes += len(data)
+        return dropped
+
+    def peek(self, count):   # the oldest count records (at most)
+        return [bytes(self.map[offset:offset + length]) for offset, length in itertools.islice(self.index, count)]
+
+    def popleft(self):   # remove the oldest record
+        offset, length = self.index.popleft()
+        self.bytes -= length
+        if not self.index:
+            self.tail = 0
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+class OutageBuffer:   # patches of a collection kept while its websocket is not available, replayed in order after reconnecting
+# param[in] maxPatches:   maximum number of patches in memory
+# param[in] maxBytes:     maximum size of the encoded patches in memory
+# param[in] conflate:     boolean, set True to replace a buffered patch in place by a newer patch with the same path
+# param[in] spillPath:    file of the spill ring for patches above the memory limits, None to drop the oldest patches instead
+# param[in] spillSize:    size of the spill ring file (bytes)
+
+    def __init__(self, maxPatches, maxBytes, conflate = False, spillPath = None, spillSize = 0):
+        self.maxPatches = maxPatches
+        self.maxBytes = maxBytes
+        self.conflate = conflate
+        self.items = OrderedDict()   # buffered patches in memory, in order: path (conflating) or sequence number -> encoded patch
+        self.bytes = 0   # size of the encoded patches in memory
+        self.sequence = itertools.count()
+        self.spill = None   # older patches than the ones in memory (SpillRing)
+        if spillPath and spillSize > 0:
+            try:
+                self.spill = SpillRing(spillPath, spillSize)
+            except OSError as e:
+                logging.error("Cannot create outage spill file '%s' (%s), patches above the memory limits are dropped.", spillPath, str(e))
+        # statistics
+        self.putCount = 0   # number of buffered patches
+        self.dropCount = 0   # number of patches dropped due to the limits
+        self.conflatedCount = 0   # number of buffered patches replaced by a newer one
+        self.replayCount = 0   # number of replayed patches
+
+    def __len__(self):
+        return len(self.items) + (len(self.spill) if self.spill is not None else 0)
+
+    def put(self, patches):   # buffer JSON patch operations
+        for patch in patches:
+            data = codec_v2.encodePatch(patch)
+            key = patch['path'] if self.conflate else next(self.sequence)
+            old = self.items.get(key)
+            if old is not None:   # superseded patch is replaced keeping its position
+                self.bytes -= len(old)
+                self.conflatedCount += 1
+            else:
+                self.putCount += 1
+            self.items[key] = data
+            self.bytes += len(data)
+        while len(self.items) > self.maxPatches or (self.bytes > self.maxBytes and len(self.items) > 1):   # the oldest patches go to the spill ring (or they are dropped)
+            data = self.items.popitem(last = False)[1]
+            self.bytes -= len(data)
+            if self.spill is not None:
+                self.dropCount += self.spill.append(data)
+            else:
+                self.dropCount += 1
+
+    def peek(self, count):   # the oldest count encoded patches (at most), removed by commit() after they were sent
+        batch = self.spill.peek(count) if self.spill is not None else []
+        batch.extend(itertools.islice(self.items.values(), count - len(batch)))
+        return batch
+
+    def commit(self, count):   # remove the oldest count patches
+        self.replayCount += count
+        while count and self.spill is not None and len(self.spill):
+            self.spill.popleft()
+            count -= 1
+        for _ in range(count):
+            self.bytes -= len(self.items.popitem(last = False)[1])
+
+    def stats(self):   # buffer statistics
+        return {
+            'patches' : len(self), 'bytes' : self.bytes + (self.spill.bytes if self.spill is not None else 0), 'spilled' : len(self.spill) if self.spill is not None else 0,
+            'buffered' : self.putCount, 'dropped' : self.dropCount, 'conflated' : self.conflatedCount, 'replayed' : self.replayCount
+        }
+
+    def close(self):
+        if self.spill is not None:
+            self.spill.close()
+
+
+def encodeFrameFromPatches(encodedPatches):   # websocket frame (bytes) of encoded JSON patch operations
+    return b'[' + b','.join(encodedPatches) + b']'
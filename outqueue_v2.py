@@ -0,0 +1,180 @@
+import asyncio
+from collections import deque, OrderedDict
+import time
+import metrics_v2
+
+
+# overflow policies
+OVERFLOW_BLOCK = 'block'   # put() waits for free space (backpressure to the reader)
+OVERFLOW_DROP_OLDEST = 'dropOldest'   # the oldest queued item is dropped to make space for the new one
+OVERFLOW_DROP_NEWEST = 'dropNewest'   # the new item is dropped
+OVERFLOW_POLICIES = [OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST]
+
+# reasons of discarded items (onDiscard)
+DISCARD_SUPERSEDED = 'superseded'   # replaced by a newer item with the same (id, attr)
+DISCARD_OVERFLOW = 'overflow'   # dropped by the overflow policy
+DISCARD_LATE = 'late'   # late item of a priority class with dropLate
+
+
+def conflationKey(item):   # items with the same key supersede each other in a conflating queue
+    return (item['id'], item['attr'])
+
+
+class OutQueue:   # bounded awaitable queue of data out items for one DCM collection (create it inside the running event loop)
+# param[in] maxSize:      maximum number of queued items
+# param[in] overflow:     overflow policy, one of OVERFLOW_POLICIES
+# param[in] conflate:     boolean, set True to replace a queued item in place by a newer item with the same (id, attr)
+# param[in] onDiscard:    function(item, reason) called for each item which leaves the queue without being returned by getBatch() (reason: DISCARD_SUPERSEDED, DISCARD_OVERFLOW or DISCARD_LATE), optional
+# param[in] classOf:      function(item) -> priority class index (0: highest), getBatch() returns the items of higher classes first, overflow drops the items of lower classes first; optional (a single class)
+# param[in] deadlines:    latency budget (sec) of each priority class (0: none), items queued for longer are late
+# param[in] dropLate:     boolean for each priority class, late items of the class are dropped (True) or returned and only counted (False)
+# param[in] lingers:      maximum linger time (sec) for the items of each priority class (None: the lingerSec of getBatch()), an item of a class with a shorter one shortens the running linger time
+# param[in] histograms:   metrics_v2 histogram record of the queueing latency of each priority class, optional
+
+    def __init__(self, maxSize, overflow = OVERFLOW_DROP_OLDEST, conflate = False, onDiscard = None, classOf = None, deadlines = (0.0,), dropLate = (False,), lingers = (None,), histograms = None):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy '{}'".format(overflow))
+        self.maxSize = maxSize
+        self.overflow = overflow
+        self.conflate = conflate
+        self.onDiscard = onDiscard
+        self.classOf = classOf
+        self.deadlines = list(deadlines)
+        self.dropLate = list(dropLate)
+        self.lingers = list(lingers)
+        self.histograms = histograms
+        self.queues = [OrderedDict() if conflate else deque() for _ in self.deadlines]   # (enqueue time, item) of each priority class in queue order; conflating queue: conflationKey -> (enqueue time, item)
+        self.count = 0   # number of queued items
+        self.wakeAt = 1   # number of queued items to wake up the waiting consumer at
+        self.lingerUntil = 0.0   # end (perf_counter) of the running linger time of getBatch()
+        self.itemsReady = asyncio.Event()   # set when at least wakeAt items are queued
+        self.spaceFree = asyncio.Event()   # set when there is free space in the queue
+        self.spaceFree.set()
+        self.batchClass = 0   # priority class of the first item returned by the last getBatch()
+        # statistics
+        self.putCount = 0   # number of accepted items
+        self.dropCount = 0   # number of items dropped due to overflow
+        self.conflatedCount = 0   # number of queued items replaced by a newer item
+        self.maxDepth = 0   # maximum queue depth since the last statistics reset
+        self.lateCounts = [0] * len(self.deadlines)   # number of late items of each priority class (sent or dropped)
+        self.lateDropCounts = [0] * len(self.deadlines)   # number of dropped late items of each priority class
+
+    def __len__(self):
+        return self.count
+
+    def waiting(self, priorityClass):   # number of queued items of a priority class
+        return len(self.queues[priorityClass])
+
+    def _popOldest(self, queue):
+        self.count -= 1
+        if self.conflate:
+            return queue.popitem(last = False)[1]
+        return queue.popleft()
+
+    def _replace(self, queue, key, item):   # the superseded item keeps its queue position, the latency is measured from the newer one
+        if self.onDiscard is not None:
+            self.onDiscard(queue[key][1], DISCARD_SUPERSEDED)
+        queue[key] = (time.perf_counter(), item)
+        self.conflatedCount += 1
+
+    async def put(self, item):   # add an item, apply the overflow policy if the queue is full; returns False if the item was dropped
+        priorityClass = self.classOf(item) if self.classOf is not None else 0
+        queue = self.queues[priorityClass]
+        if self.conflate:
+            key = conflationKey(item)
+            if key in queue:
+                self._replace(queue, key, item)
+                return True
+        while self.count >= self.maxSize:
+            lowest = max(c for c, q in enumerate(self.queues) if q)   # lowest priority class with queued items
+            if self.overflow == OVERFLOW_DROP_NEWEST or (self.overflow == OVERFLOW_DROP_OLDEST and priorityClass > lowest):   # the new item is the least important
+                self.dropCount += 1
+                if self.onDiscard is not None:
+                    self.onDiscard(item, DISCARD_OVERFLOW)
+                return False
+            elif self.overflow == OVERFLOW_DROP_OLDEST:
+                dropped = self._popOldest(self.queues[lowest])[1]
+                self.dropCount += 1
+                if self.onDiscard is not None:
+                    self.onDiscard(dropped, DISCARD_OVERFLOW)
+            else:   # block
+                self.spaceFree.clear()
+                await self.spaceFree.wait()
+                if self.conflate and key in queue:   # queued meanwhile
+                    self._replace(queue, key, item)
+                    return True
+        now = time.perf_counter()
+        if self.conflate:
+            queue[key] = (now, item)
+        else:
+            queue.append((now, item))
+        self.count += 1
+        self.putCount += 1
+        if self.count > self.maxDepth:
+            self.maxDepth = self.count
+        if self.count >= self.wakeAt:
+            self.itemsReady.set()
+        elif self.lingers[priorityClass] is not None and now + self.lingers[priorityClass] < self.lingerUntil:   # wake up the lingering consumer to shorten its linger time
+            self.lingerUntil = now + self.lingers[priorityClass]
+            self.itemsReady.set()
+        return True
+
+    async def getBatch(self, maxItems, lingerSec):   # wait for item(s), then wait at most lingerSec for the batch to fill up and return up to maxItems items, higher priority classes first (empty list if woken up by wakeUp() or every item was late and dropped)
+        if not self.count:
+            await self._waitFor(1, None)
+            if not self.count:
+                return []
+        target = min(maxItems, self.maxSize)   # a full queue cannot grow any more
+        if self.count < target and lingerSec > 0:
+            now = time.perf_counter()
+            self.lingerUntil = now + min([lingerSec] + [self.lingers[c] for c, q in enumerate(self.queues) if q and self.lingers[c] is not None])
+            while self.count < target and now < self.lingerUntil:
+                await self._waitFor(target, self.lingerUntil - now)
+                now = time.perf_counter()
+            self.lingerUntil = 0.0
+        batch = []
+        now = time.perf_counter()
+        for priorityClass, queue in enumerate(self.queues):
+            if not queue:
+                continue
+            if not batch:
+                self.batchClass = priorityClass
+            deadline = self.deadlines[priorityClass]
+            histogram = self.histograms[priorityClass] if self.histograms is not None else None
+            take = min(maxItems - len(batch), len(queue))   # late items dropped meanwhile make the batch smaller
+            self.count -= take
+            for _ in range(take):
+                enqueueTime, item = queue.popitem(last = False)[1] if self.conflate else queue.popleft()
+                if histogram is not None:
+                    metrics_v2.observe(histogram, now - enqueueTime)
+                if deadline and now - enqueueTime > deadline:
+                    self.lateCounts[priorityClass] += 1
+                    if self.dropLate[priorityClass]:
+                        self.lateDropCounts[priorityClass] += 1
+                        if self.onDiscard is not None:
+                            self.onDiscard(item, DISCARD_LATE)
+                        continue
+                batch.append(item)
+            if len(batch) >= maxItems:
+                break
+        self.spaceFree.set()
+        return batch
+
+    def wakeUp(self):   # make a waiting getBatch() return (e.g. the consumer has something else to do)
+        self.itemsReady.set()
+
+    async def _waitFor(self, count, timeout):   # wait until count items are queued or timeout (sec) is over
+        self.wakeAt = count
+        self.itemsReady.clear()
+        try:
+            await asyncio.wait_for(self.itemsReady.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self.wakeAt = 1
+
+    def stats(self, reset = True):   # queue depth statistics
+        ret = {'depth' : self.count, 'maxDepth' : self.maxDepth, 'accepted' : self.putCount, 'dropped' : self.dropCount, 'conflated' : self.conflatedCount, 'late' : sum(self.lateCounts), 'lateDropped' : sum(self.lateDropCounts)}
+        if reset:
+            self.maxDepth = self.count
+        return ret
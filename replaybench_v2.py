@@ -0,0 +1,294 @@
+# end-to-end benchmark of the translator: pub/sub messages (recorded or synthetic) are replayed through translator2 (redisReader -> translators -> senders)
+# to a local stand-in DCM patch websocket server, which timestamps the arriving patches
+# usage:
+#   python replaybench_v2.py record <file> [--seconds N]            record the BDCL and SCL pub/sub messages
+#   python replaybench_v2.py generate <file> [--tags N ...]         write a synthetic tag fleet recording
+#   python replaybench_v2.py replay <file> [--speed X]              replay a recording (speed: 1 = real time, N = N times faster, 0 = as fast as possible)
+#   python replaybench_v2.py replay --tags N [--seconds S ...]      replay a synthetic tag fleet generated with current measurement times
+# the translator settings come from the environment as for translator2.py (e.g. TRANSLATOR_WORKERS), per-module micro-benchmarks: python bench_v2.py modules
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import re
+import resource
+import statistics
+import time
+import aioredis
+import websockets
+import bench_v2
+import codec_v2
+import translator2
+
+
+# benchmark parameters
+REPLAY_DCM_HOST = '127.0.0.1'   # address of the stand-in DCM server
+REPLAY_DCM_PORT = 18765   # port of the stand-in DCM server
+REPLAY_DRAIN_TIMEOUT_SEC = 30.0   # maximum wait (sec) after the last replayed message for the patches to arrive
+REPLAY_DRAIN_IDLE_SEC = 1.0   # the replay is over when no patch arrived for this long after the last replayed message
+BDCL_CHANNEL = '451513e9-da18-4c35-863c-877bac283861'   # pub/sub channel of the synthetic BDCL messages
+
+# the replayed messages are stamped with their replay time (usec), it is passed through as the sensorsetbuffer time of the patches
+STAMP_PATTERNS = [re.compile(rb'"serverTs"\s*:\s*-?\d+'), re.compile(rb'"sensorsetbufferTime"\s*:\s*-?\d+')]
+STAMP_FORMATS = [b'"serverTs":%d', b'"sensorsetbufferTime":%d']
+
+
+def stamp(data, now):   # set the sensorsetbuffer time of a raw BDCL or SCL message
+    for pattern, fmt in zip(STAMP_PATTERNS, STAMP_FORMATS):
+        data, count = pattern.subn(fmt % now, data, 1)
+        if count:
+            break
+    return data
+
+
+def readRecording(path):   # recorded messages: list of (time offset in sec, channel, payload bytes)
+    messages = []
+    with open(path, 'r') as f:
+        for line in f:
+            record = json.loads(line)
+            messages.append((record['t'], record['channel'].encode(), record['data'].encode('utf-8', 'surrogateescape')))
+    return messages
+
+
+def writeRecording(path, messages):
+    with open(path, 'w') as f:
+        for t, channel, data in messages:
+            f.write(json.dumps({'t' : t, 'channel' : channel.decode(), 'data' : data.decode('utf-8', 'surrogateescape')}) + '\n')
+
+
+def fleetMessages(tags, seconds, rate, sclRate, positions, start):   # synthetic messages of a tag fleet: list of (time offset in sec, channel, payload bytes)
+# param[in] tags:        number of tags
+# param[in] seconds:     duration of the recording
+# param[in] rate:        messages/sec of each tag
+# param[in] sclRate:     SCL messages/sec of the whole fleet
+# param[in] positions:   number of positions in each SCL message
+# param[in] start:       measurement time (usec) of the first message
+
+    messages = []
+    for i in range(int(seconds * rate)):
+        for tag in range(tags):
+            t = (i + tag / tags) / rate   # messages of the tags are spread evenly
+            messages.append((t, BDCL_CHANNEL.encode(), codec_v2.dumpb(bench_v2.sampleBdclMessage(i, start + int(t * 1000000), tag + 1))))
+    for i in range(int(seconds * sclRate)):
+        t = i / sclRate
+        messages.append((t, translator2.sclChannel.encode(), codec_v2.dumpb(bench_v2.sampleSclMessage(i, start + int(t * 1000000), i % max(tags, 1) + 1, positions))))
+    messages.sort(key = lambda message: message[0])
+    return messages
+
+
+class ReplayPubSub:   # stand-in for the BDCL pub/sub: yields the messages at their (scaled) time
+# param[in] messages:   list of (time offset in sec, channel, payload bytes)
+# param[in] speed:      replay speed factor, 0: as fast as possible
+
+    def __init__(self, messages, speed):
+        self.messages = messages
+        self.speed = speed
+        self.startTime = None   # time (time.time) of the first replayed message
+        self.endTime = None   # time (time.time) after the last replayed message
+
+    async def psubscribe(self, *patterns):
+        pass
+
+    async def unsubscribe(self, *channels):
+        pass
+
+    async def close(self):
+        pass
+
+    async def listen(self):
+        self.startTime = time.time()
+        startTime = time.perf_counter()
+        for t, channel, data in self.messages:
+            if self.speed:
+                delay = startTime + t / self.speed - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            else:
+                await asyncio.sleep(0)   # like a socket read, let the other tasks run
+            yield {'type' : 'pmessage', 'pattern' : translator2.bdclChannelPattern.encode(), 'channel' : channel, 'data' : stamp(data, int(time.time() * 1000000))}
+        self.endTime = time.time()
+        while True:
+            await asyncio.sleep(3600)
+
+
+class ReplayRedis:
+    def __init__(self, pubsub):
+        self._pubsub = pubsub
+
+    def pubsub(self):
+        return self._pubsub
+
+
+def dcmServerMain(host, port, conn):   # process: stand-in DCM patch websocket server, its statistics are sent on conn when it gets anything on it
+    asyncio.run(dcmServer(host, port, conn))
+
+
+async def dcmServer(host, port, conn):
+    stats = {'frames' : 0, 'patches' : 0, 'bytes' : 0, 'firstTime' : None, 'lastTime' : None, 'latenciesUsec' : [], 'collections' : {}}
+
+    async def handler(ws, path = None):
+        path = path or getattr(ws, 'path', None) or ws.request.path   # path argument of older websockets versions
+        coll = path.strip('/').split('/')[1] if path.count('/') >= 2 else path
+        async for frame in ws:
+            now = time.time()
+            patches = codec_v2.loads(frame)
+            stats['frames'] += 1
+            stats['patches'] += len(patches)
+            stats['bytes'] += len(frame)
+            stats['collections'][coll] = stats['collections'].get(coll, 0) + len(patches)
+            if stats['firstTime'] is None:
+                stats['firstTime'] = now
+            stats['lastTime'] = now
+            nowUsec = now * 1000000
+            for patch in patches:
+                ssTime = patch.get('times', {}).get('sensorsetbuffer')
+                if type(ssTime) is int:
+                    stats['latenciesUsec'].append(nowUsec - ssTime)
+
+    async with websockets.serve(handler, host, port):
+        conn.send('ready')
+        await asyncio.get_running_loop().run_in_executor(None, conn.recv)
+        conn.send(stats)
+
+
+def quantile(values, q):
+    return statistics.quantiles(values, n = 1000, method = 'inclusive')[int(q * 1000) - 1] if len(values) > 1 else (values[0] if values else None)
+
+
+async def replay(messages, speed):   # replay messages through the translator; returns the results
+    pubsub = ReplayPubSub(messages, speed)
+    fromUrl = aioredis.from_url
+    aioredis.from_url = lambda url, **kwargs: ReplayRedis(pubsub) if url == translator2.bdclRedisUrl else fromUrl(url, **kwargs)   # other Redis connections (e.g. history) are real
+    translator2.dcmPatchWsUrl = 'ws://{}:{}/v2/{{}}/patchwebsocket'.format(REPLAY_DCM_HOST, REPLAY_DCM_PORT)
+    conn, serverConn = multiprocessing.Pipe()
+    server = multiprocessing.get_context('spawn').Process(target = dcmServerMain, args = (REPLAY_DCM_HOST, REPLAY_DCM_PORT, serverConn), name = 'replaybench-dcm', daemon = True)
+    server.start()
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, conn.recv)   # server is listening
+    mainTask = asyncio.create_task(translator2.main())
+    try:
+        while pubsub.endTime is None:   # replaying
+            if mainTask.done():
+                mainTask.result()
+                raise RuntimeError('translator stopped')
+            await asyncio.sleep(0.1)
+        sentPatches = -1
+        deadline = time.perf_counter() + REPLAY_DRAIN_TIMEOUT_SEC
+        while time.perf_counter() < deadline:   # wait for the queued data
+            await asyncio.sleep(REPLAY_DRAIN_IDLE_SEC)
+            patches = sum(stats['patches'] for stats in translator2.sendStats.values())
+            waiting = sum(len(queue) for queue in translator2.outQueues.values())
+            if translator2.shardPool is not None:
+                waiting += sum(stats['waiting'] for stats in translator2.shardPool.stats())
+            if patches == sentPatches and not waiting:
+                break
+            sentPatches = patches
+    finally:
+        mainTask.cancel()
+        try:
+            await mainTask
+        except BaseException:
+            pass
+        for ws in translator2.wsObjects.values():
+            await ws.close()
+        if translator2.shardPool is not None:
+            translator2.shardPool.stop()
+        aioredis.from_url = fromUrl
+    conn.send('stop')
+    stats = await loop.run_in_executor(None, conn.recv)
+    server.join(5)
+    return pubsub, stats
+
+
+def report(pubsub, stats, messageCount):
+    duration = max((stats['lastTime'] or pubsub.endTime) - pubsub.startTime, 1e-9)
+    latencies = stats['latenciesUsec']
+    selfRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss   # KiB on Linux
+    childRss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss   # largest child process (workers or the stand-in DCM server)
+    results = {
+        'messages' : messageCount,
+        'replaySec' : pubsub.endTime - pubsub.startTime,
+        'durationSec' : duration,
+        'messagesPerSec' : messageCount / duration,
+        'frames' : stats['frames'],
+        'patches' : stats['patches'],
+        'patchesPerSec' : stats['patches'] / duration,
+        'bytesPerSec' : stats['bytes'] / duration,
+        'latencyP50Ms' : quantile(latencies, 0.5) / 1000 if latencies else None,
+        'latencyP99Ms' : quantile(latencies, 0.99) / 1000 if latencies else None,
+        'latencyMaxMs' : max(latencies) / 1000 if latencies else None,
+        'peakRssKiB' : selfRss,
+        'peakRssChildKiB' : childRss,
+        'collections' : stats['collections']
+    }
+    return results
+
+
+async def record(path, seconds):   # record the BDCL and SCL pub/sub messages for some seconds
+    redis = aioredis.from_url(translator2.bdclRedisUrl)
+    pubsub = redis.pubsub()
+    await pubsub.psubscribe(translator2.bdclChannelPattern)
+    messages = []
+    startTime = time.time()
+
+    async def receive():
+        async for message in pubsub.listen():
+            if message is not None and message['type'] == 'pmessage':
+                messages.append((time.time() - startTime, message['channel'], message['data']))
+
+    try:
+        await asyncio.wait_for(receive(), seconds)
+    except asyncio.TimeoutError:
+        pass
+    await pubsub.close()
+    writeRecording(path, messages)
+    print('{} messages written to {}'.format(len(messages), path))
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Record and replay pub/sub messages through the translator.')
+    commands = parser.add_subparsers(dest = 'command', required = True)
+    recordParser = commands.add_parser('record', help = 'record the BDCL and SCL pub/sub messages')
+    recordParser.add_argument('file')
+    recordParser.add_argument('--seconds', type = float, default = 60.0, help = 'recording duration')
+    for name, text in [('generate', 'write a synthetic tag fleet recording'), ('replay', 'replay a recording or a synthetic tag fleet')]:
+        commandParser = commands.add_parser(name, help = text)
+        commandParser.add_argument('file', nargs = '?' if name == 'replay' else None)
+        commandParser.add_argument('--tags', type = int, default = 100, help = 'synthetic fleet: number of tags')
+        commandParser.add_argument('--seconds', type = float, default = 10.0, help = 'synthetic fleet: duration')
+        commandParser.add_argument('--rate', type = float, default = 1.0, help = 'synthetic fleet: messages/sec of each tag')
+        commandParser.add_argument('--scl-rate', type = float, default = 0.0, help = 'synthetic fleet: SCL messages/sec')
+        commandParser.add_argument('--positions', type = int, default = 10, help = 'synthetic fleet: positions in each SCL message')
+        if name == 'replay':
+            commandParser.add_argument('--speed', type = float, default = 1.0, help = 'replay speed: 1 = real time, N = N times faster, 0 = as fast as possible')
+            commandParser.add_argument('--json', action = 'store_true', help = 'print the results in JSON')
+    args = parser.parse_args()
+    logging.basicConfig(level = logging.WARNING)
+
+    if args.command == 'record':
+        asyncio.run(record(args.file, args.seconds))
+    elif args.command == 'generate':
+        messages = fleetMessages(args.tags, args.seconds, args.rate, args.scl_rate, args.positions, int(time.time() * 1000000))
+        writeRecording(args.file, messages)
+        print('{} messages written to {}'.format(len(messages), args.file))
+    else:
+        if args.file:
+            messages = readRecording(args.file)
+        else:
+            messages = fleetMessages(args.tags, args.seconds, args.rate, args.scl_rate, args.positions, int(time.time() * 1000000))
+        translator2.METRICS_PORT = 0
+        translator2.DCM_FRAME_LOG_SAMPLE = 0
+        translator2.DCM_STATS_LOG_INTERVAL_SEC = 3600
+        translator2.prepare()
+        pubsub, stats = asyncio.run(replay(messages, args.speed))
+        results = report(pubsub, stats, len(messages))
+        if args.json:
+            print(json.dumps(results))
+        else:
+            for name, value in results.items():
+                print('{:<20} {}'.format(name, '{:.3f}'.format(value) if type(value) is float else value))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,158 +1,241 @@
-import binascii
+from collections import namedtuple
+import asyncio
+import devstate_v2
 import tsdbuf_v2
 import copy
+import heapq
 import json
+import logging
+import os
 import time
-from shapely.geometry import Polygon
-from shapely.ops import unary_union
 
 
 dummyScanCounter = 0    # to generate scan counter value for BLE scan data
-deviceTickCountData = {}    # for tick count to measurement time conversion
 
 BLERTLS_CONFIG_FILE = '/data/shared_files/ble_rtls.conf'   # BLE RTLS config file
-BLERTLS_CONFIG_REREAD_INTERVAL = 5   # re-read interval for config file (sec)
+BLERTLS_CONFIG_REREAD_INTERVAL = 5   # check interval for config file changes (sec)
 BLERTLS_INRANGE_TIMEOUT = 3   # beacon is in range timeout (sec)
-bleRtlsConfigReadLastTime = 0    # last BLE RTLS config file read time
-bleRtlsConfig = {}
-bleTagsLastTimeInRange = {}
-
-
-def translator_func(data, identifier, times):
-
-    def attrSetter(attr):
-        return lambda val, newTimes: ([{'coll' : 'pairings', 'id' : 'tag.'+str(identifier), 'attr' : attr, 'data' : {'value': val, 'times': newTimes}}])
-
-    def attrSetterX(attr):
-        return lambda val, newTimes: ({'coll' : 'pairings', 'id' : 'tag.'+str(identifier), 'attr' : attr, 'data' : {'value': val, 'times': newTimes}})
-
-    # set "barCode" attribute and compute position
-    def attrSetterBleRtls():
-        def setattrWrapper(val, newTimes):
-            global bleRtlsConfig
-            global bleRtlsConfigReadLastTime
-            global bleTagsLastTimeInRange            
-            # set attribute
-            xxout = [{'coll' : 'pairings', 'id' : 'tag.'+str(identifier), 'attr' : 'barCode', 'data' : {'value': val, 'times': newTimes}}]
-            # read BLE RTLS config
-            if time.perf_counter() - bleRtlsConfigReadLastTime >= BLERTLS_CONFIG_REREAD_INTERVAL:   # re-read config
-                bleRtlsConfigReadLastTime = time.perf_counter()
-                bleRtlsConfig = {}
-                try:
-                    with open(BLERTLS_CONFIG_FILE, 'r') as f:
-                        bleRtlsConfig = json.load(f)
-                        f.close()
-                except:
-                    pass
-            # do RTLS
-            if identifier not in bleTagsLastTimeInRange:   # no data for this scanning device yet
-                bleTagsLastTimeInRange.update({identifier : {}})
-            if bleRtlsConfig and type(val) == str and len(val) >= 14 and val[12] == ':':
-                # extract BLE address and RSSI
-                x = val.split(':', 1)
-                addr = x[0]
-                rssi = int(x[1])
-                # check whether this device is in range
-                for bb in bleRtlsConfig['bleBeacons']:
-                    if addr.upper() == bb['bleAddress'].upper():
-                        if rssi >= bb['inRangeRssiLimit']:   # in range, store time
-                            bleTagsLastTimeInRange[identifier].update({bb['secondaryId'] : time.perf_counter()})
-                        break
-                # update position
-                for z in bleRtlsConfig['zones']:
-                    num = 0
-                    for el in z['elements']:
-                        if el in bleTagsLastTimeInRange[identifier]:
-                            if time.perf_counter() - bleTagsLastTimeInRange[identifier][el] <= BLERTLS_INRANGE_TIMEOUT:
-                                num = num + 1
-                    if num == len(z['elements']):  # all elements are in range
-                        # compute center   !FIXME! 2D only yet
-                        polys = []
-                        for el in z['elements']:
-                            for bb in bleRtlsConfig['bleBeacons']:
-                                if bb['secondaryId'] == el:
-                                    polys.append(Polygon(bb['rangeBaseArea']))
-                                    break
-                        if polys:
-                            uc = unary_union(polys).centroid
-                            output = [uc.x, uc.y, 0]
-                            xxout.append({'coll' : 'locations', 'id' : 'tag.'+str(identifier), 'attr' : 'position', 'data' : {'value': output, 'times': newTimes}})
-                        break
-            return xxout
-
-        return setattrWrapper
-
-    def bleScanExtract(tsdData, newTimes):   # extract BLE scan info from dummy format TSD data
-
-        global dummyScanCounter
-
-        # generate dummy TSD data
-        devUniqueDummyTsd = copy.deepcopy(tsdData)
-        bleAddrRssiDummyTsd = copy.deepcopy(tsdData)
-        dummyScanCounterDummyTsd = copy.deepcopy(tsdData)
-        for i, tsdElement in enumerate(tsdData['data']):   # for each TSD element
-            xdata = tsdElement['values']
-            devUniqueDummyTsd['data'][i]['values'] = xdata[2];   # obtain unique ID (only devices with firmware 1.7.0 or newer), and update dummy TSD
-            bleAddr25 = binascii.hexlify( bytearray([(xdata[1] >> s & 0xFF) for s in (24,16,8,0)]) )   # obtain Bluetooth address
-            bleAddr01 = binascii.hexlify( bytearray([(xdata[0] >> s & 0xFF) for s in (8,0)]) )
-            rssi = xdata[0] >> 16 & 0xFF   # obtain RSSI
-            if rssi > 127:
-                rssi -= 256
-            bleAddrRssiDummyTsd['data'][i]['values'] = bleAddr01.decode() + bleAddr25.decode() + ':' + str(rssi)    # update dummy TSD with Bluetooth address and RSSI
-            dummyScanCounter = (dummyScanCounter + 1) % 256   # generate dummy scan counter value
-            dummyScanCounterDummyTsd['data'][i]['values'] = dummyScanCounter
-
-        # call setter functions
-        xxout = []
-        xxout.extend(tsdbuf_v2.tsdProcessor(attrSetterBleRtls(), (identifier, 'barCode'), True)(bleAddrRssiDummyTsd, newTimes))   # Bluetooth address to DCM and history as 'barCode'
-        xxout.extend(tsdbuf_v2.tsdProcessor(attrSetter('pairingCode'), (identifier, 'pairingCode'), True)(devUniqueDummyTsd, newTimes))   # unique ID of scanned device to DCM and history as 'pairingCode'
-        xxout.extend(tsdbuf_v2.tsdProcessor(attrSetter('scanCounter'), (identifier, 'scanCounter'), False)(dummyScanCounterDummyTsd, newTimes))   # dummy scan counter only to DCM
-        return xxout
-
-    def tickCountDataAdd(tickCount, newTimes):   # store tick count data for a device
-
-        global deviceTickCountData
-
-        if 'measurement' in newTimes:    # measurement time exists (BDCL found RxPacket for that packet)
-            if identifier in deviceTickCountData:   # data stored yet
-                deviceTickCountData[identifier]['former'] = deviceTickCountData[identifier]['last']
-            else:
-                deviceTickCountData[identifier] = {}
-            deviceTickCountData[identifier]['last'] = {'measTime': newTimes['measurement'], 'tickCount': tickCount}
-        return [{'coll' : 'dummy'}]
-
-    def measTimeCompute(lolanData, newTimes):   # compute measurement time
-
-        global deviceTickCountData
-
-        if 'scanstatus.scannerapp.scan_time' in lolanData:    # scan time exists
-            newTimesCopy = copy.deepcopy(newTimes)
-            if identifier in deviceTickCountData and 'last' in deviceTickCountData[identifier] and 'former' in deviceTickCountData[identifier]:   # have enough time points
-                measTimeKnownInterval = deviceTickCountData[identifier]['last']['measTime'] - deviceTickCountData[identifier]['former']['measTime']
-                tickCountKnownInterval = deviceTickCountData[identifier]['last']['tickCount'] - deviceTickCountData[identifier]['former']['tickCount']
-                tickCountUnknownInterval = lolanData['scanstatus.scannerapp.scan_time'] - deviceTickCountData[identifier]['last']['tickCount']
-                newTimesCopy['measurement'] = deviceTickCountData[identifier]['last']['measTime'] + int(tickCountUnknownInterval / tickCountKnownInterval * measTimeKnownInterval)   # compute measurement time
-            else:   # not enough time data
-                if 'measurement' in newTimesCopy:
-                    del newTimesCopy['measurement']   # indicate unknown measurement time by deleting measurement time from record
-            return newTimesCopy
-        else:   # no scan time in container
-            return newTimes    # do not change the measurement time
-
-    # TSD buffering process
-    tsdbuf_v2.tsdbufProcess(times)
-
-    switcher = {
-        'data.scannerapp.scanout_c': lambda val, times:    # old ScannerTag firmware
-            [attrSetterX(attribute)(val[lolan], times) for attribute, lolan in [('barCode', 'data.scannerapp.scandata_single'), ('scanCounter', 'data.scannerapp.scan_cnt'), ('pairingCode', 'data.scannerapp.scan_associated_num')]],
-        'scanstatus.scannerapp.scanout_c': lambda val, times:    # new general nRF tag firmware
-            [attrSetterX(attribute)(val[lolan], measTimeCompute(val, times)) for attribute, lolan in [('barCode', 'scanstatus.scannerapp.scandata_single'), ('scanCounter', 'scanstatus.scannerapp.scan_cnt'), ('pairingCode', 'scanstatus.scannerapp.scan_associated_num')]],
-        'status.ibutton.out_c': lambda val, times:
-            [attrSetterX(attribute)(typeof(val[lolan]), times) for attribute, lolan, typeof in [('barCode', 'status.ibutton.serial', str), ('scanCounter', 'status.ibutton.seq', int)]],
-        'status.blescandata_tsd': bleScanExtract,
-        'status.general.tick_count': tickCountDataAdd
-    }
-
-    for k, setterFunc in switcher.items():
-        if k in data:
-            yield setterFunc(data[k], times)
+bleRtlsConfigCheckLastTime = 0    # last BLE RTLS config file check time
+bleRtlsConfigVersion = None   # (mtime, size) of the compiled config file, None if not read yet
+bleRtlsWatcherRunning = False   # config changes are checked by the watcher task (otherwise by the setter)
+
+# compiled BLE RTLS config, replaced at once on config change
+#   beacons:       normalized (upper case) BLE address -> (secondaryId, inRangeRssiLimit)
+#   zones:         list of (tuple of element secondaryIds, centroid [x, y, 0] of the union of their range base areas or None)
+#   beaconZones:   secondaryId -> list of indices of the zones it is an element of (once for each occurrence)
+#   emptyZone:     index of the first zone without elements (always satisfied), None if there is no such zone
+bleRtlsModelType = namedtuple('bleRtlsModelType', ['beacons', 'zones', 'beaconZones', 'emptyZone'])
+bleRtlsModel = None
+
+# incremental zone satisfaction state for bleRtlsModel
+bleRtlsStateModel = None   # model the state below belongs to
+bleRtlsScanners = {}   # scanning device identifier -> {'expiry': {secondaryId: in range expiry time}, 'counts': {zone index: number of in range elements}, 'satisfied': set of zone indices}
+bleRtlsExpiryHeap = []   # in range expiry schedule; elements: (expiry time, scanning device identifier, secondaryId), outdated elements are skipped
+
+
+def bleRtlsCompile(config):   # compile BLE RTLS config, None if it is empty
+    if not config:
+        return None
+    from shapely.geometry import Polygon   # imported only on sites with BLE RTLS config (slow import)
+    from shapely.ops import unary_union
+    beacons = {}
+    areas = {}
+    for bb in config['bleBeacons']:
+        beacons.setdefault(bb['bleAddress'].upper(), (bb['secondaryId'], bb['inRangeRssiLimit']))   # first beacon with the address is used
+        areas.setdefault(bb['secondaryId'], bb['rangeBaseArea'])
+    zones = []
+    for z in config['zones']:
+        # compute center   !FIXME! 2D only yet
+        polys = [Polygon(areas[el]) for el in z['elements'] if el in areas]
+        centroid = None
+        if polys:
+            uc = unary_union(polys).centroid
+            centroid = [uc.x, uc.y, 0]
+        zones.append((tuple(z['elements']), centroid))
+    beaconZones = {}
+    for i, (elements, centroid) in enumerate(zones):
+        for el in elements:
+            beaconZones.setdefault(el, []).append(i)
+    emptyZone = next((i for i, (elements, centroid) in enumerate(zones) if not elements), None)
+    return bleRtlsModelType(beacons, zones, beaconZones, emptyZone)
+
+def bleRtlsExpire(now):   # apply in range timeouts up to now: decrement the zone counters, forget scanning devices without beacons in range
+    while bleRtlsExpiryHeap and bleRtlsExpiryHeap[0][0] < now:
+        expiry, identifier, secondaryId = heapq.heappop(bleRtlsExpiryHeap)
+        scanner = bleRtlsScanners.get(identifier)
+        if scanner is None or scanner['expiry'].get(secondaryId) != expiry:   # outdated schedule element
+            continue
+        del scanner['expiry'][secondaryId]
+        for zoneIndex in bleRtlsStateModel.beaconZones.get(secondaryId, []):
+            scanner['counts'][zoneIndex] -= 1
+            scanner['satisfied'].discard(zoneIndex)
+        if not scanner['expiry']:
+            del bleRtlsScanners[identifier]
+
+def bleRtlsInRange(identifier, secondaryId, now):   # a beacon is in range of a scanning device: (re)start its timeout, update the zone counters
+    scanner = bleRtlsScanners.get(identifier)
+    if scanner is None:
+        scanner = bleRtlsScanners[identifier] = {'expiry' : {}, 'counts' : {}, 'satisfied' : set()}
+    expiry = now + BLERTLS_INRANGE_TIMEOUT
+    if secondaryId not in scanner['expiry']:   # came into range
+        counts = scanner['counts']
+        for zoneIndex in bleRtlsStateModel.beaconZones.get(secondaryId, []):
+            counts[zoneIndex] = counts.get(zoneIndex, 0) + 1
+            if counts[zoneIndex] == len(bleRtlsStateModel.zones[zoneIndex][0]):   # all elements are in range
+                scanner['satisfied'].add(zoneIndex)
+    scanner['expiry'][secondaryId] = expiry
+    heapq.heappush(bleRtlsExpiryHeap, (expiry, identifier, secondaryId))
+
+def bleRtlsMatchedZone(identifier):   # index of the first zone with all elements in range for a scanning device, None if there is no such zone
+    scanner = bleRtlsScanners.get(identifier)
+    matched = min(scanner['satisfied']) if scanner is not None and scanner['satisfied'] else None
+    emptyZone = bleRtlsStateModel.emptyZone
+    if emptyZone is not None and (matched is None or emptyZone < matched):
+        matched = emptyZone
+    return matched
+
+def bleRtlsConfigCheck():   # re-read and compile the config file if it has changed (mtime or size)
+    global bleRtlsModel
+    global bleRtlsConfigVersion
+    try:
+        st = os.stat(BLERTLS_CONFIG_FILE)
+        version = (st.st_mtime_ns, st.st_size)
+    except OSError:
+        version = None
+    if version == bleRtlsConfigVersion:
+        return
+    model = None
+    if version is not None:
+        try:
+            with open(BLERTLS_CONFIG_FILE, 'r') as f:
+                model = bleRtlsCompile(json.load(f))
+        except:
+            logging.warning("Cannot read BLE RTLS config file '%s'.", BLERTLS_CONFIG_FILE)
+    bleRtlsModel = model   # swap in the new model at once
+    bleRtlsConfigVersion = version
+
+async def bleRtlsConfigWatcher():   # task: check config file changes off the translation path
+    global bleRtlsWatcherRunning
+    bleRtlsWatcherRunning = True
+    loop = asyncio.get_running_loop()
+    while True:
+        await loop.run_in_executor(None, bleRtlsConfigCheck)
+        await asyncio.sleep(BLERTLS_CONFIG_REREAD_INTERVAL)
+
+
+def attrSetter(attr):
+    return lambda val, identifier, newTimes: ([{'coll' : 'pairings', 'id' : 'tag.'+str(identifier), 'attr' : attr, 'data' : {'value': val, 'times': newTimes}}])
+
+def attrSetterX(attr, identifier, val, newTimes):
+    return {'coll' : 'pairings', 'id' : 'tag.'+str(identifier), 'attr' : attr, 'data' : {'value': val, 'times': newTimes}}
+
+# set "barCode" attribute and compute position
+def bleRtlsSetter(val, identifier, newTimes):
+    global bleRtlsConfigCheckLastTime
+    global bleRtlsStateModel
+    # set attribute
+    xxout = [{'coll' : 'pairings', 'id' : 'tag.'+str(identifier), 'attr' : 'barCode', 'data' : {'value': val, 'times': newTimes}}]
+    # check BLE RTLS config if there is no watcher task
+    if not bleRtlsWatcherRunning and time.perf_counter() - bleRtlsConfigCheckLastTime >= BLERTLS_CONFIG_REREAD_INTERVAL:
+        bleRtlsConfigCheckLastTime = time.perf_counter()
+        bleRtlsConfigCheck()
+    # do RTLS
+    model = bleRtlsModel
+    if model is not bleRtlsStateModel:   # config changed: zone satisfaction starts from scratch
+        bleRtlsStateModel = model
+        bleRtlsScanners.clear()
+        bleRtlsExpiryHeap.clear()
+    if model is not None and type(val) == str and len(val) >= 14 and val[12] == ':':
+        # extract BLE address and RSSI
+        x = val.split(':', 1)
+        addr = x[0]
+        rssi = int(x[1])
+        now = time.perf_counter()
+        bleRtlsExpire(now)
+        # check whether this device is in range
+        beacon = model.beacons.get(addr.upper())
+        if beacon is not None and rssi >= beacon[1]:   # in range
+            bleRtlsInRange(identifier, beacon[0], now)
+        # update position
+        zoneIndex = bleRtlsMatchedZone(identifier)
+        if zoneIndex is not None:   # all elements of the zone are in range
+            centroid = model.zones[zoneIndex][1]
+            if centroid is not None:
+                xxout.append({'coll' : 'locations', 'id' : 'tag.'+str(identifier), 'attr' : 'position', 'data' : {'value': list(centroid), 'times': newTimes}})
+    return xxout
+
+pairingCodeSetter = attrSetter('pairingCode')
+scanCounterSetter = attrSetter('scanCounter')
+def bleScanDecode(samples):   # decode the words of BLE scan TSD samples in one pass; returns (list of 'address:RSSI' strings, list of unique IDs)
+    bleAddrRssi = ['%04x%08x:%d' % (w0 & 0xFFFF, w1 & 0xFFFFFFFF, ((w0 >> 16 & 0xFF) ^ 0x80) - 0x80) for w0, w1, *rest in (data['values'] for data in samples)]   # Bluetooth address and signed RSSI
+    devUnique = [data['values'][2] for data in samples]   # unique ID (only devices with firmware 1.7.0 or newer)
+    return bleAddrRssi, devUnique
+
+def bleScanExtract(tsdData, identifier, newTimes):   # extract BLE scan info from dummy format TSD data
+
+    global dummyScanCounter
+
+    # decode samples, the TSD data itself is shared by the setters with the decoded values
+    bleAddrRssi, devUnique = bleScanDecode(tsdData['data'])
+    scanCounters = [(dummyScanCounter + k) % 256 for k in range(1, len(bleAddrRssi) + 1)]   # generate dummy scan counter values
+    if scanCounters:
+        dummyScanCounter = scanCounters[-1]
+    measTimes = tsdbuf_v2.tsdMeasurementTimes(tsdData, newTimes)
+
+    # call setter functions
+    xxout = []
+    xxout.extend(tsdbuf_v2.tsdProcess(tsdData, newTimes, bleRtlsSetter, identifier, 'barCode', True, values = bleAddrRssi, measTimes = measTimes))   # Bluetooth address to DCM and history as 'barCode'
+    xxout.extend(tsdbuf_v2.tsdProcess(tsdData, newTimes, pairingCodeSetter, identifier, 'pairingCode', True, values = devUnique, measTimes = measTimes))   # unique ID of scanned device to DCM and history as 'pairingCode'
+    xxout.extend(tsdbuf_v2.tsdProcess(tsdData, newTimes, scanCounterSetter, identifier, 'scanCounter', False, values = scanCounters, measTimes = measTimes))   # dummy scan counter only to DCM
+    return xxout
+
+def tickCountDataAdd(tickCount, identifier, newTimes):   # store tick count data for a device (in its devstate_v2.DeviceState, for tick count to measurement time conversion)
+    if 'measurement' in newTimes:    # measurement time exists (BDCL found RxPacket for that packet)
+        state = devstate_v2.deviceStates.record(identifier)
+        if state.tickCountLast is not None:   # data stored yet
+            state.tickCountFormer = state.tickCountLast
+        state.tickCountLast = (newTimes['measurement'], tickCount)
+    return [{'coll' : 'dummy'}]
+
+def measTimeCompute(lolanData, identifier, newTimes):   # compute measurement time
+    if 'scanstatus.scannerapp.scan_time' in lolanData:    # scan time exists
+        newTimesCopy = copy.deepcopy(newTimes)
+        state = devstate_v2.deviceStates.get(identifier)
+        if state is not None and state.tickCountLast is not None and state.tickCountFormer is not None:   # have enough time points
+            lastMeasTime, lastTickCount = state.tickCountLast
+            formerMeasTime, formerTickCount = state.tickCountFormer
+            measTimeKnownInterval = lastMeasTime - formerMeasTime
+            tickCountKnownInterval = lastTickCount - formerTickCount
+            tickCountUnknownInterval = lolanData['scanstatus.scannerapp.scan_time'] - lastTickCount
+            newTimesCopy['measurement'] = lastMeasTime + int(tickCountUnknownInterval / tickCountKnownInterval * measTimeKnownInterval)   # compute measurement time
+        else:   # not enough time data
+            if 'measurement' in newTimesCopy:
+                del newTimesCopy['measurement']   # indicate unknown measurement time by deleting measurement time from record
+        return newTimesCopy
+    else:   # no scan time in container
+        return newTimes    # do not change the measurement time
+
+def scanoutOldProcessor(val, identifier, times):   # old ScannerTag firmware
+    return [attrSetterX(attribute, identifier, val[lolan], times) for attribute, lolan in [('barCode', 'data.scannerapp.scandata_single'), ('scanCounter', 'data.scannerapp.scan_cnt'), ('pairingCode', 'data.scannerapp.scan_associated_num')]]
+
+def scanoutProcessor(val, identifier, times):   # new general nRF tag firmware
+    return [attrSetterX(attribute, identifier, val[lolan], measTimeCompute(val, identifier, times)) for attribute, lolan in [('barCode', 'scanstatus.scannerapp.scandata_single'), ('scanCounter', 'scanstatus.scannerapp.scan_cnt'), ('pairingCode', 'scanstatus.scannerapp.scan_associated_num')]]
+
+def ibuttonProcessor(val, identifier, times):
+    return [attrSetterX(attribute, identifier, typeof(val[lolan]), times) for attribute, lolan, typeof in [('barCode', 'status.ibutton.serial', str), ('scanCounter', 'status.ibutton.seq', int)]]
+
+
+# TSD buffering process, called once for each message before the handlers
+translator_prepare = tsdbuf_v2.tsdbufProcess
+
+# background tasks of the module
+translator_tasks = [bleRtlsConfigWatcher]
+
+# LoLaN variable translator definitions: handler(value, device identifier, times)
+lolanHandlers = {
+    'data.scannerapp.scanout_c': scanoutOldProcessor,
+    'scanstatus.scannerapp.scanout_c': scanoutProcessor,
+    'status.ibutton.out_c': ibuttonProcessor,
+    'status.blescandata_tsd': bleScanExtract,
+    'status.general.tick_count': tickCountDataAdd
+}
@@ -0,0 +1,56 @@
+import re
+import codec_v2
+
+
+SCL_COLLECTION = 'sclpositions'   # DCM collection of the SCL positions
+SCL_FAST_PATH_MIN_BYTES = 512   # smaller messages are decoded if the codec is orjson (faster for them than the fast path)
+SCL_HEADER_PATTERN = re.compile(   # leading fields of a raw SCL message in the order the SCL sends them, up to the start of the positions
+    rb'\s*\{\s*"devId"\s*:\s*(-?\d+)\s*,\s*"uuid"\s*:\s*"([^"\\]*)"\s*,\s*"timestamp"\s*:\s*(-?\d+)\s*,\s*"sensorsetbufferTime"\s*:\s*(-?\d+)\s*,\s*"positions"\s*:\s*\['
+)
+SCL_POSITION_VECTOR_PATTERN = re.compile(rb'"positionVector"\s*:\s*(\[[-+0-9.eE,\s]*\])')   # position vector of numbers
+
+
+def sclItem(jsondata):   # data out item of a decoded SCL message, None if it is empty
+    if not jsondata:
+        return None
+    # extract data
+    unqId = jsondata.get('devId', 0)
+    uuid = jsondata.get('uuid', 'None')
+    measTime = jsondata.get('timestamp', None)
+    ssTime = jsondata.get('sensorsetbufferTime', None)
+    positions = jsondata.get('positions', None)
+    if positions is not None:
+        value = [pos['positionVector'] for pos in positions]
+    else:
+        value = [[0.0, 0.0, 0.0]]  # value is a list of position vectors
+    return {
+        'coll' : SCL_COLLECTION,
+        'id' : 'tag.' + str(unqId),
+        'attr' : 'sclProfiles/' + uuid + '/rawPositions',
+        'data' : {'value' : value, 'times' : {'measurement' : measTime, 'sensorsetbuffer' : ssTime}}
+    }
+
+
+def sclItemFast(raw):   # data out item of a raw SCL message without decoding it, the position vectors are spliced as codec_v2.RawJson; None if the message has an unusual layout
+    header = SCL_HEADER_PATTERN.match(raw)
+    if header is None:   # other field order, or a field which is not an integer (string)
+        return None
+    vectors = SCL_POSITION_VECTOR_PATTERN.findall(raw, header.end())
+    if len(vectors) != raw.count(b'"positionVector"'):   # a vector which is not a list of numbers
+        return None
+    devId, uuid, measTime, ssTime = header.groups()
+    return {
+        'coll' : SCL_COLLECTION,
+        'id' : 'tag.' + str(int(devId)),
+        'attr' : 'sclProfiles/' + uuid.decode() + '/rawPositions',
+        'data' : {'value' : codec_v2.RawJson(b'[' + b','.join(vectors) + b']'), 'times' : {'measurement' : int(measTime), 'sensorsetbuffer' : int(ssTime)}}
+    }
+
+
+def sclItemFromRaw(raw):   # data out item of a raw SCL message (fast path, or decoding it if it is small or its layout is unusual), None if it is empty
+    item = None
+    if len(raw) >= SCL_FAST_PATH_MIN_BYTES or codec_v2.codecName != 'orjson':
+        item = sclItemFast(raw)
+    if item is None:
+        item = sclItem(codec_v2.loads(raw))
+    return item
@@ -0,0 +1,192 @@
+import asyncio
+import importlib
+import logging
+import multiprocessing
+import queue
+import re
+import threading
+import time
+import codec_v2
+import devstate_v2
+import dispatch_v2
+import metrics_v2
+import outqueue_v2
+import tsdbuf_v2
+
+
+# sharding parameters
+SHARD_FEED_MAX_SIZE = 10000   # maximum number of messages waiting to be passed to a worker process
+SHARD_BATCH_MAX_SIZE = 100   # maximum number of messages passed to a worker process at once
+SHARD_BATCH_LINGER_MS = 5   # maximum time (msec) a message waits for other messages of the same shard before passing them to the worker
+SHARD_IPC_MAX_BATCHES = 16   # maximum number of batches in the inter-process queue of a worker
+SHARD_RESULT_MAX_BATCHES = 64   # maximum number of results waiting for the main process (workers block above it)
+SHARD_METRICS_INTERVAL_SEC = 1.0   # minimum interval (sec) of passing the metrics of a worker to the main process
+
+# worker modes
+SHARD_MODE_PROCESS = 'process'   # worker processes, messages are sharded by device
+SHARD_MODE_THREAD = 'thread'   # a single worker thread in the main process (translator module state is shared with the main process, so there is no sharding)
+SHARD_MODES = [SHARD_MODE_PROCESS, SHARD_MODE_THREAD]
+
+SHARD_UNIQID_PATTERN = re.compile(rb'"uniqId"\s*:\s*(\d+)')   # device identifier in the header of a raw BDCL message
+
+
+def shardKey(raw):   # device identifier of a raw BDCL message without decoding the whole message (None if not found)
+    match = SHARD_UNIQID_PATTERN.search(raw)
+    if match is not None:
+        return int(match.group(1))
+    try:
+        return codec_v2.loads(raw).get('header', {}).get('uniqId', None)
+    except:
+        return None
+
+
+def shardOf(key, workers):   # worker index of a device identifier
+    return key % workers if isinstance(key, int) else 0
+
+
+async def runTasks(tasks):   # run background task functions until they finish
+    await asyncio.gather(*[task() for task in tasks])
+
+
+def workerMain(shardIndex, workers, translators, collections, logLevel, history, inQueue, outQueue):   # worker process: decode and translate BDCL messages of its devices
+    logging.basicConfig(level = logLevel)
+    tsdbuf_v2.tsdbufHistoryEnabled = history   # closed history chunks are passed back to the main process, its history writer encodes and writes them
+    devstate_v2.devstateStart('shard{}'.format(shardIndex), lambda identifier: shardOf(identifier, workers) == shardIndex)
+    modules = [importlib.import_module(module) for module in translators]
+    dispatchIndex = dispatch_v2.buildDispatchIndex(modules)
+    # background tasks of the modules run in an event loop of their own
+    tasks = dispatch_v2.moduleTasks(modules)
+    if tasks:
+        threading.Thread(target = asyncio.run, args = (runTasks(tasks),), name = 'translator-shard-tasks', daemon = True).start()
+    workerLoop(shardIndex, dispatchIndex, collections, inQueue, outQueue, True)
+    devstate_v2.devstateSnapshot(background = False)
+
+
+def workerLoop(shardIndex, dispatchIndex, collections, inQueue, outQueue, ownProcess):   # decode and translate batches of raw BDCL messages until stopped
+# param[in] ownProcess:   boolean, True in a worker process: closed history chunks and metrics are passed back with the results (a worker thread shares them with the main thread)
+    collections = set(collections)
+    metricsLastTime = time.perf_counter()
+    while True:
+        try:
+            batch = inQueue.get(timeout = SHARD_METRICS_INTERVAL_SEC)
+        except queue.Empty:   # idle, metrics are passed anyway
+            batch = []
+        if batch is None:   # stop
+            break
+        items = []
+        tokens = []   # (ingest token, number of data out items) of the messages with a token, in the order of the items
+        for token, raw in batch:
+            itemCount = len(items)
+            startTime = time.perf_counter()
+            try:
+                jsondata = codec_v2.loads(raw)
+            except:
+                logging.warning('(shard %u) Not a valid json from BDCL.', shardIndex)
+                metrics_v2.counterInc('translator_decode_failures_total', (('source', 'bdcl'),))
+                jsondata = None
+            decodeTime = time.perf_counter()
+            metrics_v2.stageDone(metrics_v2.STAGE_DECODE, decodeTime - startTime)
+            if jsondata:
+                for outList in dispatch_v2.translateMessage(dispatchIndex, jsondata):
+                    items.extend(do for do in outList if do.get('coll') in collections)   # only data to be sent is passed back
+                metrics_v2.stageDone(metrics_v2.STAGE_TRANSLATE, time.perf_counter() - decodeTime)
+            if token is not None:
+                tokens.append((token, len(items) - itemCount))
+        chunks = []
+        metrics = None
+        now = time.perf_counter()
+        if ownProcess:
+            chunks = tsdbuf_v2.tsdbufHistoryTake()
+            if now - metricsLastTime >= SHARD_METRICS_INTERVAL_SEC:
+                metricsLastTime = now
+                for name, value in tsdbuf_v2.tsdbufSizes().items():
+                    metrics_v2.gaugeSet('translator_tsdbuf_size', (('buffer', name), ('shard', shardIndex)), value)
+                metrics = metrics_v2.exportState()
+        elif now - metricsLastTime >= SHARD_METRICS_INTERVAL_SEC:   # worker thread: the statistics of the buffers and states are published for the event loop
+            metricsLastTime = now
+            tsdbuf_v2.tsdbufStatsPublished = tsdbuf_v2.tsdbufStatsCollect()
+        if items or chunks or metrics or tokens:
+            outQueue.put((items, chunks, metrics, tokens))
+
+
+class ShardPool:   # translation workers, each device is handled by the same worker so its state stays consistent and its messages stay in order
+
+    def __init__(self, workers, translators, collections, history = False, mode = SHARD_MODE_PROCESS):
+        if mode not in SHARD_MODES:
+            raise ValueError("Unknown worker mode '{}'".format(mode))
+        if mode == SHARD_MODE_THREAD and workers > 1:
+            logging.warning('Translation runs in a single worker thread in thread mode (%u workers requested).', workers)
+            workers = 1
+        self.workers = workers
+        self.translators = translators
+        self.collections = collections
+        self.history = history   # workers keep closed long-term history chunks and pass them back
+        self.mode = mode
+        self.context = multiprocessing.get_context('spawn')
+        self.inQueues = []   # inter-process (or inter-thread) queue for each worker (batches of (ingest token, raw message))
+        self.outQueue = self.context.Queue(SHARD_RESULT_MAX_BATCHES) if mode == SHARD_MODE_PROCESS else queue.Queue(SHARD_RESULT_MAX_BATCHES)   # translated data out items and closed history chunks from every worker
+        self.processes = []   # worker processes or threads
+        self.feeds = []   # messages waiting to be passed to each worker (outqueue_v2.OutQueue)
+        self.results = None   # worker results in the event loop (asyncio.Queue)
+        self.submitCount = [0] * workers   # number of messages submitted to each worker
+
+    def start(self):   # start the workers
+        for i in range(self.workers):
+            if self.mode == SHARD_MODE_THREAD:   # the translator modules of the main process are used, their background tasks run in the main event loop
+                inQueue = queue.Queue(SHARD_IPC_MAX_BATCHES)
+                dispatchIndex = dispatch_v2.buildDispatchIndex([importlib.import_module(module) for module in self.translators])
+                process = threading.Thread(
+                    target = workerLoop, name = 'translator-shard-{}'.format(i), daemon = True,
+                    args = (i, dispatchIndex, self.collections, inQueue, self.outQueue, False)
+                )
+            else:
+                inQueue = self.context.Queue(SHARD_IPC_MAX_BATCHES)
+                process = self.context.Process(
+                    target = workerMain, name = 'translator-shard-{}'.format(i), daemon = True,
+                    args = (i, self.workers, self.translators, self.collections, logging.getLogger().getEffectiveLevel(), self.history, inQueue, self.outQueue)
+                )
+            process.start()
+            self.inQueues.append(inQueue)
+            self.processes.append(process)
+
+    def attach(self):   # attach to the running event loop: start feeder tasks and the result reader thread
+        loop = asyncio.get_running_loop()
+        self.results = asyncio.Queue(SHARD_RESULT_MAX_BATCHES)
+        for i in range(self.workers):
+            self.feeds.append(outqueue_v2.OutQueue(SHARD_FEED_MAX_SIZE, outqueue_v2.OVERFLOW_BLOCK))
+            asyncio.create_task(self._feeder(i))
+        threading.Thread(target = self._resultReader, args = (loop,), name = 'translator-shard-results', daemon = True).start()
+
+    async def submit(self, raw, token = None):   # pass a raw BDCL message to the worker of its device
+# param[in] token:   ingest token of the message (passed back with its data out items), optional
+        shard = shardOf(shardKey(raw), self.workers)
+        self.submitCount[shard] += 1
+        await self.feeds[shard].put((token, raw))
+
+    async def getResult(self):   # wait for a worker result: (list of translated data out items, list of closed history chunks, metrics_v2.exportState() of the worker or None, list of (ingest token, number of its data out items))
+        return await self.results.get()
+
+    async def _feeder(self, shard):   # pass messages to a worker in batches (blocking put runs in a thread to keep the event loop free)
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self.feeds[shard].getBatch(SHARD_BATCH_MAX_SIZE, SHARD_BATCH_LINGER_MS / 1000)
+            await loop.run_in_executor(None, self.inQueues[shard].put, batch)
+
+    def _resultReader(self, loop):   # thread: move worker results to the event loop, waits while the event loop is behind (backpressure to the workers)
+        while True:
+            result = self.outQueue.get()
+            asyncio.run_coroutine_threadsafe(self.results.put(result), loop).result()
+
+    def stats(self):   # number of submitted and waiting messages for each worker
+        return [{'submitted' : self.submitCount[i], 'waiting' : len(self.feeds[i]) if self.feeds else 0} for i in range(self.workers)]
+
+    def stop(self):   # stop the workers
+        for inQueue in self.inQueues:
+            try:
+                inQueue.put_nowait(None)
+            except:
+                pass
+        for process in self.processes:
+            process.join(1.0)
+            if self.mode == SHARD_MODE_PROCESS and process.is_alive():
+                process.terminate()
@@ -0,0 +1,82 @@
+from collections import OrderedDict
+import time
+
+
+class ChangeFilter:   # last sent value cache keyed by (coll, id, attr): data out items with unchanged values are not sent again
+# param[in] collections:    collections to filter, items of other collections always pass
+# param[in] heartbeatSec:   an unchanged value is sent again if it was last sent this long ago (0: never)
+# param[in] deadbands:      attribute name -> numeric deadband, a number value (or a list of numbers) within the deadband of the last sent one is unchanged
+# param[in] idleSec:        cache entries not updated for this long are evicted (e.g. devices switched off)
+
+    def __init__(self, collections, heartbeatSec, deadbands = None, idleSec = 600.0):
+        self.collections = set(collections)
+        self.heartbeatSec = heartbeatSec
+        self.deadbands = deadbands or {}
+        self.idleSec = idleSec
+        self.cache = OrderedDict()   # (coll, id, attr) -> [last sent value, time it was sent, time the attribute was last seen] (time.monotonic), least recently seen first
+        self.lastEvictTime = time.monotonic()
+        # statistics
+        self.passCount = 0   # number of items sent
+        self.suppressCount = 0   # number of items not sent
+        self.evictCount = 0   # number of evicted cache entries
+
+    def __len__(self):
+        return len(self.cache)
+
+    def unchanged(self, attr, old, new):   # compare a value to the last sent one
+        if type(old) is not type(new):   # e.g. 1 and True
+            return False
+        if old == new:
+            return True
+        deadband = self.deadbands.get(attr)
+        if deadband is None:
+            return False
+        if type(new) in [int, float]:
+            return abs(new - old) <= deadband
+        if type(new) is list and len(new) == len(old):
+            return all(type(a) in [int, float] and type(b) in [int, float] and abs(b - a) <= deadband for a, b in zip(old, new))
+        return False
+
+    def accept(self, item):   # returns True if the item is to be sent, the cache is updated
+        if item['coll'] not in self.collections:
+            return True
+        now = time.monotonic()
+        if now - self.lastEvictTime >= self.idleSec / 4:
+            self.evict(now)
+        key = (item['coll'], item['id'], item['attr'])
+        value = item['data']['value']
+        entry = self.cache.get(key)
+        if entry is None:
+            self.cache[key] = [value, now, now]
+        else:
+            entry[2] = now
+            self.cache.move_to_end(key)
+            if self.unchanged(item['attr'], entry[0], value) and (not self.heartbeatSec or now - entry[1] < self.heartbeatSec):
+                self.suppressCount += 1
+                return False
+            entry[0] = value
+            entry[1] = now
+        self.passCount += 1
+        return True
+
+    def discard(self, item):   # an accepted item was not sent (e.g. dropped from a full queue): its value is not the last sent one
+        key = (item['coll'], item['id'], item['attr'])
+        entry = self.cache.get(key)
+        if entry is not None and entry[0] is item['data']['value']:   # not superseded by a newer accepted value
+            del self.cache[key]
+
+    def evict(self, now):   # remove the entries not seen for idleSec (the least recently seen ones are at the front)
+        self.lastEvictTime = now
+        while self.cache:
+            key, entry = next(iter(self.cache.items()))
+            if now - entry[2] < self.idleSec:
+                break
+            del self.cache[key]
+            self.evictCount += 1
+
+    def forget(self, coll):   # forget the sent values of a collection (e.g. DCM may have lost them)
+        for key in [key for key in self.cache if key[0] == coll]:
+            del self.cache[key]
+
+    def stats(self):   # filter statistics
+        return {'entries' : len(self.cache), 'sent' : self.passCount, 'suppressed' : self.suppressCount, 'evicted' : self.evictCount}
@@ -0,0 +1,62 @@
+# unit tests of the columnar history chunk codec
+# usage: python -m unittest test_chunkcodec_v2   (or python -m pytest)
+import unittest
+import chunkcodec_v2
+import tsdbuf_v2
+
+
+def chunkColumns(values, start = 1700000000000000, period = 20000):   # columns of one device sampled regularly
+    measTimes = [start + k * period for k in range(len(values))]
+    return (measTimes, [t + 50 for t in measTimes], list(values))
+
+
+class ChunkCodecTest(unittest.TestCase):
+
+    def roundTrip(self, devices):
+        for level in [0, chunkcodec_v2.CHUNKCODEC_ZLIB_LEVEL]:
+            zlibLevel = chunkcodec_v2.CHUNKCODEC_ZLIB_LEVEL
+            chunkcodec_v2.CHUNKCODEC_ZLIB_LEVEL = level
+            try:
+                data = chunkcodec_v2.encodeChunk(devices)
+            finally:
+                chunkcodec_v2.CHUNKCODEC_ZLIB_LEVEL = zlibLevel
+            self.assertEqual(chunkcodec_v2.decodeChunkColumns(data), devices)
+
+    def testValueKinds(self):
+        self.roundTrip({1 : chunkColumns([3, -7, 0, 2 ** 40, -(2 ** 70)])})   # integers (zigzag varints, no 64-bit limit)
+        self.roundTrip({1 : chunkColumns([0.5, -1.25, 3.0])})   # float32 exact
+        self.roundTrip({1 : chunkColumns([0.1, 1e300, float('inf')])})   # float64
+        self.roundTrip({1 : chunkColumns(['on', 'off', 'on', 'ü'])})   # string table
+        self.roundTrip({1 : chunkColumns([[1, 0.5, 'a'], [2, 1.5, 'b']])})   # lists of equal length
+        self.roundTrip({1 : chunkColumns([None, None])})
+        self.roundTrip({1 : chunkColumns([1, 'a', None, [1, 2], {'k' : 1}, True])})   # mixed: JSON column
+        self.roundTrip({1 : chunkColumns([[1, 2], [3]])})   # lists of different length: JSON column
+
+    def testDevices(self):
+        devices = {7 : chunkColumns([1, 2, 3]), 'tag.8' : chunkColumns([4.5], start = 1700000000123456), 9 : chunkColumns([[1, 2, 3]] * 40, period = 1)}
+        self.roundTrip(devices)
+
+    def testIrregularTimes(self):
+        measTimes = [1700000000000000, 1699999999000000, 1700000005000001]
+        self.roundTrip({1 : (measTimes, [None, None, None], [1, 2, 3])})   # sensorsetbuffer times not relative to the measurement times
+        self.roundTrip({1 : (measTimes, [t - 10 ** 9 for t in measTimes], [1, 2, 3])})
+
+    def testEmpty(self):
+        self.roundTrip({})
+
+    def testJsonLayout(self):   # decodeChunk() returns the layout of the JSON history chunks
+        records = [
+            tsdbuf_v2.chunkBufferRecordType(k % 3, 'distanceM', 1000 + k, {'measurement' : 1700000000000000 + k, 'sensorsetbuffer' : 1700000000000100 + k})
+            for k in range(30)
+        ]
+        for field, outStruct, count in tsdbuf_v2.tsdbufChunkOutStructs(records):
+            devices = tsdbuf_v2.tsdbufChunkColumns(records)[field]
+            self.assertEqual(chunkcodec_v2.decodeChunk(chunkcodec_v2.encodeChunk(devices)), outStruct)
+
+    def testNotAChunk(self):
+        with self.assertRaises(ValueError):
+            chunkcodec_v2.decodeChunkColumns(b'[{"id": 1}]')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+# unit tests of the LoLaN variable dispatch
+# usage: python -m unittest test_dispatch_v2   (or python -m pytest)
+import unittest
+import dispatch_v2
+import generaltags_v2
+import metrics_v2
+import twr_v2
+
+
+def errorCount(module):   # translator_handler_errors_total of a module
+    return metrics_v2.metricsCounters.get(('translator_handler_errors_total', (('module', module),)), 0)
+
+
+class DispatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index = dispatch_v2.buildDispatchIndex([generaltags_v2, twr_v2])
+
+    def translate(self, header, datamap):
+        return [item for outList in dispatch_v2.translateMessage(self.index, {'header' : header, 'data' : datamap}) for item in outList]
+
+    def testDefinitionOrder(self):   # the handlers run in module and handler definition order, not in datamap order
+        items = self.translate({'uniqId' : 1, 'measTs' : 1700000000000000}, {'status.twr.inform_c' : {'tagsettings.twr.target1' : 7, 'status.twr.result1' : 1500}, 'status.temperature' : 21, 'status.battery.level' : 3.7})
+        self.assertEqual([item['attr'] for item in items], ['batteryVoltage', 'temperatureC', 'twrUniqueIdAndMeter'])
+
+    def testUnknownVariables(self):
+        self.assertEqual(self.translate({'uniqId' : 1, 'measTs' : 1700000000000000}, {'status.unknown' : 1}), [])
+
+    def testInvalidMeasurementTime(self):   # a failing prepare hook is logged and counted, the handlers still run
+        for measTime in ['abc', [1]]:
+            errors = errorCount('tsdbuf_v2')
+            with self.assertLogs(level = 'ERROR'):
+                items = self.translate({'uniqId' : 1, 'measTs' : measTime}, {'status.battery.level' : 3.7})
+            self.assertEqual([(item['attr'], item['data']['value']) for item in items], [('batteryVoltage', 3.7)])
+            self.assertEqual(errorCount('tsdbuf_v2'), errors + 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
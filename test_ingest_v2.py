@@ -0,0 +1,92 @@
+# unit tests of the stream ingest acknowledgement watermark and read-ahead limit
+# usage: python -m unittest test_ingest_v2   (or python -m pytest)
+import asyncio
+import unittest
+import ingest_v2
+
+
+class IngestTrackerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tracker = ingest_v2.IngestTracker()
+
+    def testPrefixWatermark(self):   # an entry is acknowledged after the earlier entries of its stream
+        first = self.tracker.add('a', b'1-0')
+        second = self.tracker.add('a', b'2-0')
+        self.tracker.release(second)
+        self.assertEqual(self.tracker.ackable(), {})
+        self.tracker.release(first)
+        self.assertEqual(self.tracker.ackable(), {'a' : [b'1-0', b'2-0']})
+        self.assertEqual(len(self.tracker), 0)
+        self.assertEqual(self.tracker.ackable(), {})
+
+    def testStreamsAreIndependent(self):
+        blocked = self.tracker.add('a', b'1-0')
+        other = self.tracker.add('b', b'1-0')
+        self.tracker.release(other)
+        self.assertEqual(self.tracker.ackable(), {'b' : [b'1-0']})
+        self.tracker.release(blocked)
+        self.assertEqual(self.tracker.ackable(), {'a' : [b'1-0']})
+
+    def testHeldByItems(self):   # the data out items made of an entry hold it until they are sent
+        token = self.tracker.add('a', b'1-0')
+        self.tracker.hold(token)
+        self.tracker.hold(token)
+        self.tracker.release(token)   # translated
+        self.tracker.release(token)   # first item sent
+        self.assertEqual(self.tracker.ackable(), {})
+        self.tracker.release(token)   # second item sent
+        self.assertEqual(self.tracker.ackable(), {'a' : [b'1-0']})
+
+    def testFailedEntryStaysPending(self):   # a failed entry is not acknowledged and does not block the later ones
+        tokens = [self.tracker.add('a', '{}-0'.format(i).encode()) for i in range(3)]
+        self.tracker.hold(tokens[1])
+        self.tracker.fail(tokens[1])
+        self.tracker.fail(tokens[1])
+        for token in tokens:
+            self.tracker.release(token)
+        self.assertEqual(self.tracker.ackable(), {'a' : [b'0-0']})   # the item of the failed entry is not released yet
+        self.tracker.release(tokens[1])
+        self.assertEqual(self.tracker.ackable(), {'a' : [b'2-0']})
+        self.assertEqual(len(self.tracker), 0)
+
+
+class FakeRedis:   # XREADGROUP returning count new entries of a stream for every call
+
+    def __init__(self):
+        self.reads = 0
+
+    async def xreadgroup(self, group, consumer, streams, count = None, block = None):
+        self.reads += 1
+        stream = next(iter(streams))
+        return [[stream.encode(), [('{}-{}'.format(self.reads, k).encode(), {b'channel' : b'bdcl', b'data' : b'{}'}) for k in range(count)]]]
+
+
+class StreamIngestTest(unittest.TestCase):
+
+    def testReadAheadLimit(self):   # no more entries are read while INGEST_MAX_PENDING entries are not acknowledged
+        async def run():
+            ingest = ingest_v2.StreamIngest(FakeRedis(), [0], 'group', 'consumer')
+            messages = []
+            while True:
+                try:
+                    messages.extend(await asyncio.wait_for(ingest.read(), 0.3))
+                except asyncio.TimeoutError:
+                    break
+            self.assertEqual(len(messages), maxPending)
+            self.assertEqual(ingest.redis.reads, maxPending // ingest_v2.INGEST_READ_COUNT)
+            for token, channelName, raw in messages[:ingest_v2.INGEST_READ_COUNT]:
+                ingest.tracker.release(token)
+            self.assertEqual(len(ingest.tracker.ackable()[ingest_v2.INGEST_STREAM_FORMAT.format(0)]), ingest_v2.INGEST_READ_COUNT)
+            self.assertEqual(len(await ingest.read()), ingest_v2.INGEST_READ_COUNT)
+
+        restore = ingest_v2.INGEST_MAX_PENDING
+        maxPending = ingest_v2.INGEST_MAX_PENDING = 4 * ingest_v2.INGEST_READ_COUNT
+        try:
+            asyncio.run(run())
+        finally:
+            ingest_v2.INGEST_MAX_PENDING = restore
+
+
+if __name__ == '__main__':
+    unittest.main()
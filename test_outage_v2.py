@@ -0,0 +1,103 @@
+# unit tests of the outage buffer and its spill ring
+# usage: python -m unittest test_outage_v2   (or python -m pytest)
+import os
+import tempfile
+import unittest
+import outage_v2
+
+
+def record(i, size = 10):   # distinguishable record of size bytes
+    return bytes([i % 256]) * size
+
+
+class SpillRingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.ring = outage_v2.SpillRing(os.path.join(self.directory.name, 'ring'), 100)
+
+    def tearDown(self):
+        self.ring.close()
+        self.directory.cleanup()
+
+    def testFifo(self):
+        for i in range(5):
+            self.assertEqual(self.ring.append(record(i)), 0)
+        self.assertEqual(len(self.ring), 5)
+        self.assertEqual(self.ring.bytes, 50)
+        self.assertEqual(self.ring.peek(2), [record(0), record(1)])
+        self.ring.popleft()
+        self.assertEqual(self.ring.peek(10), [record(i) for i in range(1, 5)])
+
+    def testWrapAround(self):   # a record not fitting at the end goes to the start, the end of the file is left unused
+        for i in range(9):
+            self.ring.append(record(i))
+        for _ in range(3):
+            self.ring.popleft()
+        self.assertEqual(self.ring.append(record(9, 15)), 0)
+        self.assertEqual(self.ring.index[-1], (0, 15))
+        self.assertEqual(self.ring.peek(10), [record(i) for i in range(3, 9)] + [record(9, 15)])
+
+    def testFullDropsOldest(self):
+        for i in range(10):
+            self.ring.append(record(i))
+        self.assertEqual(self.ring.append(record(10, 25)), 3)
+        self.assertEqual(self.ring.peek(10), [record(i) for i in range(3, 10)] + [record(10, 25)])
+        self.assertEqual(self.ring.bytes, 95)
+
+    def testOversizedRecord(self):
+        self.ring.append(record(0))
+        self.assertEqual(self.ring.append(record(1, 101)), 1)
+        self.assertEqual(self.ring.peek(10), [record(0)])
+
+    def testEmptyRingRestarts(self):   # the space is reused from the start after every record was removed
+        for i in range(7):
+            self.ring.append(record(i))
+        for _ in range(7):
+            self.ring.popleft()
+        self.assertEqual(self.ring.tail, 0)
+        self.assertEqual(self.ring.append(record(7, 100)), 0)
+        self.assertEqual(self.ring.peek(1), [record(7, 100)])
+
+
+class OutageBufferTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def patch(self, i, path = None):
+        return {'op' : 'replace', 'path' : path or '/tag.{}/x'.format(i), 'value' : i}
+
+    def testSpillAndReplayInOrder(self):
+        outage = outage_v2.OutageBuffer(3, 1 << 20, False, os.path.join(self.directory.name, 'ring'), 4096)
+        outage.put([self.patch(i) for i in range(8)])
+        self.assertEqual(len(outage), 8)
+        self.assertEqual(len(outage.spill), 5)
+        replayed = []
+        while len(outage):
+            batch = outage.peek(3)
+            replayed.extend(batch)
+            outage.commit(len(batch))
+        outage.close()
+        self.assertEqual(replayed, [outage_v2.codec_v2.encodePatch(self.patch(i)) for i in range(8)])
+        self.assertEqual(outage.stats()['replayed'], 8)
+        self.assertEqual(outage.stats()['bytes'], 0)
+
+    def testDropWithoutSpill(self):
+        outage = outage_v2.OutageBuffer(3, 1 << 20)
+        outage.put([self.patch(i) for i in range(5)])
+        self.assertEqual(outage.peek(10), [outage_v2.codec_v2.encodePatch(self.patch(i)) for i in range(2, 5)])
+        self.assertEqual(outage.stats()['dropped'], 2)
+
+    def testConflate(self):
+        outage = outage_v2.OutageBuffer(10, 1 << 20, True)
+        outage.put([self.patch(1, '/a'), self.patch(2, '/b'), self.patch(3, '/a')])
+        self.assertEqual(outage.peek(10), [outage_v2.codec_v2.encodePatch(self.patch(3, '/a')), outage_v2.codec_v2.encodePatch(self.patch(2, '/b'))])
+        self.assertEqual(outage.stats()['conflated'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+# unit tests of the out queue overflow, conflation and priority classes
+# usage: python -m unittest test_outqueue_v2   (or python -m pytest)
+import asyncio
+import time
+import unittest
+import outqueue_v2
+
+
+def item(i, attr = 'x', priorityClass = 0):   # data out item of a device
+    return {'id' : i, 'attr' : attr, 'class' : priorityClass}
+
+
+def classOf(item):
+    return item['class']
+
+
+class OutQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.discarded = []
+
+    def onDiscard(self, item, reason):
+        self.discarded.append((item['id'], reason))
+
+    def testPriorityOrder(self):   # the items of higher classes are returned first, in queue order within a class
+        async def run():
+            queue = outqueue_v2.OutQueue(10, classOf = classOf, deadlines = (0.0, 0.0), dropLate = (False, False), lingers = (None, None))
+            for i, priorityClass in [(1, 1), (2, 0), (3, 1), (4, 0)]:
+                await queue.put(item(i, priorityClass = priorityClass))
+            self.assertEqual([x['id'] for x in await queue.getBatch(3, 0)], [2, 4, 1])
+            self.assertEqual(queue.batchClass, 0)
+            self.assertEqual([x['id'] for x in await queue.getBatch(3, 0)], [3])
+            self.assertEqual(queue.batchClass, 1)
+        asyncio.run(run())
+
+    def testOverflowDropsLowestClass(self):
+        async def run():
+            queue = outqueue_v2.OutQueue(2, onDiscard = self.onDiscard, classOf = classOf, deadlines = (0.0, 0.0), dropLate = (False, False), lingers = (None, None))
+            await queue.put(item(1, priorityClass = 1))
+            await queue.put(item(2, priorityClass = 0))
+            self.assertTrue(await queue.put(item(3, priorityClass = 0)))   # drops the queued item of the lower class
+            self.assertFalse(await queue.put(item(4, priorityClass = 1)))   # the new item is the least important
+            self.assertEqual(self.discarded, [(1, outqueue_v2.DISCARD_OVERFLOW), (4, outqueue_v2.DISCARD_OVERFLOW)])
+            self.assertEqual([x['id'] for x in await queue.getBatch(10, 0)], [2, 3])
+            self.assertEqual(queue.stats()['dropped'], 2)
+        asyncio.run(run())
+
+    def testOverflowDropNewest(self):
+        async def run():
+            queue = outqueue_v2.OutQueue(2, outqueue_v2.OVERFLOW_DROP_NEWEST, onDiscard = self.onDiscard)
+            for i in range(3):
+                await queue.put(item(i))
+            self.assertEqual(self.discarded, [(2, outqueue_v2.DISCARD_OVERFLOW)])
+            self.assertEqual([x['id'] for x in await queue.getBatch(10, 0)], [0, 1])
+        asyncio.run(run())
+
+    def testConflate(self):   # a newer item replaces the queued one in place
+        async def run():
+            queue = outqueue_v2.OutQueue(10, conflate = True, onDiscard = self.onDiscard)
+            first = item(1)
+            await queue.put(first)
+            await queue.put(item(2))
+            newer = dict(item(1), value = 2)
+            await queue.put(newer)
+            self.assertEqual(self.discarded, [(1, outqueue_v2.DISCARD_SUPERSEDED)])
+            self.assertEqual(await queue.getBatch(10, 0), [newer, item(2)])
+            self.assertEqual(queue.stats()['conflated'], 1)
+        asyncio.run(run())
+
+    def testLateItems(self):   # late items of a class with dropLate are dropped, the others are returned, both are counted
+        async def run():
+            queue = outqueue_v2.OutQueue(10, onDiscard = self.onDiscard, classOf = classOf, deadlines = (0.01, 0.01), dropLate = (True, False), lingers = (None, None))
+            await queue.put(item(1, priorityClass = 0))
+            await queue.put(item(2, priorityClass = 1))
+            await asyncio.sleep(0.02)
+            await queue.put(item(3, priorityClass = 0))
+            self.assertEqual([x['id'] for x in await queue.getBatch(10, 0)], [3, 2])
+            self.assertEqual(self.discarded, [(1, outqueue_v2.DISCARD_LATE)])
+            self.assertEqual(queue.lateCounts, [1, 1])
+            self.assertEqual(queue.lateDropCounts, [1, 0])
+            self.assertEqual(queue.stats()['late'], 2)
+        asyncio.run(run())
+
+    def testLinger(self):   # getBatch() waits for the batch to fill up, at most lingerSec
+        async def run():
+            queue = outqueue_v2.OutQueue(10)
+            await queue.put(item(1))
+            start = time.perf_counter()
+            self.assertEqual(len(await queue.getBatch(10, 0.05)), 1)
+            self.assertGreaterEqual(time.perf_counter() - start, 0.04)
+            await queue.put(item(2))
+            async def fill():
+                await asyncio.sleep(0.01)
+                await queue.put(item(3))
+            filling = asyncio.ensure_future(fill())
+            start = time.perf_counter()
+            self.assertEqual(len(await queue.getBatch(2, 1.0)), 2)   # returns as soon as the batch is full
+            self.assertLess(time.perf_counter() - start, 0.5)
+            await filling
+        asyncio.run(run())
+
+    def testShorterLingerCutsLinger(self):   # an item of a class with a shorter linger time shortens the running linger
+        async def run():
+            queue = outqueue_v2.OutQueue(10, classOf = classOf, deadlines = (0.0, 0.0), dropLate = (False, False), lingers = (0.0, None))
+            await queue.put(item(1, priorityClass = 1))
+            async def urgent():
+                await asyncio.sleep(0.01)
+                await queue.put(item(2, priorityClass = 0))
+            putting = asyncio.ensure_future(urgent())
+            start = time.perf_counter()
+            self.assertEqual([x['id'] for x in await queue.getBatch(10, 1.0)], [2, 1])
+            self.assertLess(time.perf_counter() - start, 0.5)
+            await putting
+        asyncio.run(run())
+
+
+if __name__ == '__main__':
+    unittest.main()
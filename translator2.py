@@ -1,167 +1,630 @@
 import asyncio
+import os
+import random
 import aioredis
 import websockets
-import json
 import logging
 import importlib
-import traceback
-from collections import deque
+import time
+import outqueue_v2
+import outage_v2
+import scl_v2
+import suppress_v2
+import dispatch_v2
+import codec_v2
+import devstate_v2
+import metrics_v2
+import shard_v2
+import tsdbuf_v2
+import ingest_v2
 
 
 ## configuration ##
+bdclRedisUrl = 'redis://bdcl'   # Redis URL of the BDCL and SCL pub/sub channels
+bdclChannelPattern = '451513e9-da18-4c35-863c-877bac28386*'   # pub/sub channel pattern of the BDCL and SCL messages
+sclChannel = '451513e9-da18-4c35-863c-877bac283863'   # pub/sub channel of the SCL messages
 dcmPatchWsUrl = 'ws://dcm/v2/{}/patchwebsocket'   # DCM patch websockets' URL format (FIXME: ?force=true if websockets are left open)
 dcmCollections = ['generalTags', 'locations', 'pairings', 'extras', 'twr', 'sclpositions']   # available DCM collections
 translators = ['generaltags_v2', 'locations_v2', 'scanner_ble_v2', 'twr_v2']   # translator modules (python files)
+historyRedisUrl = os.environ.get('TRANSLATOR_HISTORY_REDIS_URL', '')   # Redis URL of the long-term history (TSD chunks), history is not written if empty
+TRANSLATOR_WORKERS = int(os.environ.get('TRANSLATOR_WORKERS', '0'))   # number of translation worker processes, BDCL messages are sharded by device (0: translate in the event loop)
+TRANSLATOR_INGEST = os.environ.get('TRANSLATOR_INGEST', ingest_v2.INGEST_PUBSUB)   # 'pubsub': read the pub/sub channels, 'streams': read the partitions of this instance (TRANSLATOR_INSTANCE) from Redis streams and acknowledge them after sending, 'bridge': only add the pub/sub messages to the streams
+TRANSLATOR_WORKER_MODE = os.environ.get('TRANSLATOR_WORKER_MODE', shard_v2.SHARD_MODE_PROCESS)   # translation workers: 'process' (TRANSLATOR_WORKERS processes) or 'thread' (a single thread off the event loop)
+DCM_WS_TEXT_FRAMES = True   # send patches in text frames (False: binary frames, no UTF-8 decoding of the encoded frames)
+DCM_ENCODE_OFFLOAD_MIN_PATCHES = int(os.environ.get('TRANSLATOR_ENCODE_OFFLOAD_MIN_PATCHES', '0'))   # frames of at least this many patches are encoded in a worker thread (0: every frame is encoded in the event loop)
+DCM_BATCH_MAX_SIZE = 200   # maximum number of patches sent in one websocket frame
+DCM_BATCH_LINGER_MS = 20   # maximum time (msec) a patch waits for other patches of the same collection before its frame is sent
+DCM_STATS_LOG_INTERVAL_SEC = 10   # interval (sec) for logging send statistics (frames/sec, patches/frame, queue depth)
+DCM_QUEUE_MAX_SIZE = 10000   # maximum number of items in the data out queue of a collection
+DCM_QUEUE_OVERFLOW_DEFAULT = outqueue_v2.OVERFLOW_DROP_OLDEST   # overflow policy of the data out queues (block, dropOldest, dropNewest)
+DCM_QUEUE_OVERFLOW = {}   # overflow policy overrides for collections, e.g. {'sclpositions' : outqueue_v2.OVERFLOW_BLOCK}
+DCM_QUEUE_CONFLATE = {'generalTags' : True, 'locations' : True}   # collections where a queued patch is replaced by a newer one for the same (id, attr); histories (e.g. sclpositions) and multi-valued attributes (e.g. twr) must not conflate
+DCM_PRIORITY_CLASSES = [   # priority classes of the data out items, highest first: name, maximum linger time (lingerMs, None: DCM_BATCH_LINGER_MS), latency budget (deadlineSec, 0: none), late items are dropped (True) or sent and counted (False)
+    {'name' : 'realtime', 'lingerMs' : 2, 'deadlineSec' : 0.5, 'dropLate' : False},
+    {'name' : 'normal', 'lingerMs' : None, 'deadlineSec' : 5.0, 'dropLate' : False},
+    {'name' : 'bulk', 'lingerMs' : None, 'deadlineSec' : 15.0, 'dropLate' : True}
+]
+DCM_PRIORITY_DEFAULT = 'normal'   # priority class of the collections and attributes not in DCM_PRIORITY
+DCM_PRIORITY = {   # priority class of collections and of attributes ('collection/attribute'), higher classes are sent first and dropped last
+    'locations' : 'realtime', 'twr' : 'realtime', 'sclpositions' : 'realtime', 'locations/isMoving' : 'normal',
+    'pairings' : 'bulk', 'generalTags/accelerometerA' : 'bulk'
+}
+DCM_SUPPRESS_COLLECTIONS = ['generalTags', 'locations', 'pairings', 'extras']   # collections where an unchanged value of an attribute is not sent again; histories (e.g. sclpositions) and multi-valued attributes (e.g. twr) must not be filtered
+DCM_SUPPRESS_HEARTBEAT_SEC = 60.0   # an unchanged value is sent again after this time (0: never)
+DCM_SUPPRESS_DEADBANDS = {}   # numeric deadbands for attributes, changes within them are not sent, e.g. {'batteryVoltage' : 0.01, 'temperatureC' : 0.5}
+DCM_SUPPRESS_IDLE_SEC = 600.0   # last sent values of attributes not updated for this time are forgotten
+DCM_OUTAGE_MAX_PATCHES = 100000   # maximum number of patches kept in memory for each collection while its websocket is not available (0: patches are dropped)
+DCM_OUTAGE_MAX_BYTES = 64 * 1024 * 1024   # maximum size of the encoded patches kept in memory for each collection while its websocket is not available
+DCM_OUTAGE_SPILL_DIR = os.environ.get('TRANSLATOR_OUTAGE_SPILL_DIR', '')   # directory of the memory-mapped spill ring files for patches above the memory limits (empty: they are dropped)
+DCM_OUTAGE_SPILL_FILE_SIZE = 256 * 1024 * 1024   # size of the spill ring file of each collection
+DCM_CONNECT_TIMEOUT_SEC = float(os.environ.get('TRANSLATOR_CONNECT_TIMEOUT_SEC', '3.0'))   # timeout of a websocket connect attempt (the collections are connected concurrently)
+DCM_RECONNECT_DELAY_MIN_SEC = 1.0   # delay before the first reconnect attempt, doubled after each failed attempt (half of the delay is random jitter)
+DCM_RECONNECT_DELAY_MAX_SEC = 30.0   # maximum delay between reconnect attempts
+DCM_FRAME_LOG_SAMPLE = int(os.environ.get('TRANSLATOR_FRAME_LOG_SAMPLE', '1'))   # sent frames are logged (info level) one in every N frames (0: not logged)
+METRICS_HOST = os.environ.get('TRANSLATOR_METRICS_HOST', '0.0.0.0')   # address of the metrics HTTP endpoint
+METRICS_PORT = int(os.environ.get('TRANSLATOR_METRICS_PORT', '9100'))   # port of the metrics HTTP endpoint (http://host:port/metrics), 0: no endpoint
 
 ## variables ##
-doq = deque()    # data out queue
+outQueues = {}    # data out queue for each collection (outqueue_v2.OutQueue)
 translatorsImp = []   # imported translator modules (returned by importlib)
+dispatchIndex = dispatch_v2.buildDispatchIndex([])   # LoLaN variable dispatch index of the translator modules
+shardPool = None   # translation workers (shard_v2.ShardPool), None if translating in the event loop
+streamIngest = None   # stream reader (ingest_v2.StreamIngest), None if reading the pub/sub channels
+outageTokens = {}   # ingest tokens of the patches in the outage buffer of each collection, released when it is drained: (drop count of the outage buffer at the first token, list of tokens)
 wsObjects = {}   # websocket object storage
+wsReconnecting = set()   # collections with a running reconnect task
+outageBuffers = {}   # patches waiting for the websocket of each collection (outage_v2.OutageBuffer)
+changeFilter = suppress_v2.ChangeFilter(DCM_SUPPRESS_COLLECTIONS, DCM_SUPPRESS_HEARTBEAT_SEC, DCM_SUPPRESS_DEADBANDS, DCM_SUPPRESS_IDLE_SEC)   # last sent values, unchanged ones are not sent
+sendStats = {}   # send statistics for each collection since the last stats log: {'frames': ..., 'patches': ...}
+sendStatsLastLogTime = 0.0   # last time (perf_counter) the send statistics were logged
+stageStatsLast = {}   # pipeline stage -> (items, seconds) at the last stats log
+frameLogCounter = 0   # number of sent frames for frame log sampling
+priorityClassNames = [priorityClass['name'] for priorityClass in DCM_PRIORITY_CLASSES]
+priorityClasses = {}   # (collection, attribute) -> priority class index
+startupStartTime = time.perf_counter()   # start of the startup phases
+startupPhases = {}   # startup phase -> duration (sec), in order
 
+## metrics ##
+metrics_v2.describe('translator_redis_messages_total', 'counter', 'Messages received from Redis (pub/sub channels or streams).')
+metrics_v2.describe('translator_decode_failures_total', 'counter', 'Messages which are not valid JSON.')
+metrics_v2.describe('translator_queue_depth', 'gauge', 'Number of items in the data out queue of a collection.')
+metrics_v2.describe('translator_queue_latency_seconds', 'summary', 'Time data out items of a priority class spent in the queue of a collection.')
+metrics_v2.describe('translator_queue_late_total', 'counter', 'Data out items queued for longer than the latency budget of their priority class (sent or dropped).')
+metrics_v2.describe('translator_queue_items_total', 'counter', 'Items handled by the data out queue of a collection (accepted, dropped, conflated).')
+metrics_v2.describe('translator_sent_frames_total', 'counter', 'Websocket frames sent to DCM.')
+metrics_v2.describe('translator_sent_patches_total', 'counter', 'JSON patch operations sent to DCM.')
+metrics_v2.describe('translator_sent_bytes_total', 'counter', 'Size of the websocket frames sent to DCM.')
+metrics_v2.describe('translator_send_seconds', 'summary', 'Duration of sending a websocket frame to DCM.')
+metrics_v2.describe('translator_send_failures_total', 'counter', 'Failed websocket sends to DCM.')
+metrics_v2.describe('translator_dropped_patches_total', 'counter', 'Patches dropped because the websocket of the collection was not connected.')
+metrics_v2.describe('translator_websocket_connected', 'gauge', 'Websocket of a collection is connected (1) or not (0).')
+metrics_v2.describe('translator_websocket_reconnects_total', 'counter', 'Websocket reconnect attempts (result: success, failure).')
+metrics_v2.describe('translator_suppress_items_total', 'counter', 'Data out items passed (sent) or suppressed (unchanged value) by the change filter.')
+metrics_v2.describe('translator_suppress_entries', 'gauge', 'Number of last sent values in the change filter.')
+metrics_v2.describe('translator_outage_patches', 'gauge', 'Patches buffered while the websocket of a collection is not available (including the spilled ones).')
+metrics_v2.describe('translator_outage_bytes', 'gauge', 'Size of the buffered patches of a collection.')
+metrics_v2.describe('translator_outage_items_total', 'counter', 'Patches handled by the outage buffer of a collection (buffered, dropped, conflated, replayed).')
+metrics_v2.describe('translator_tsdbuf_size', 'gauge', 'Number of elements in the TSD buffers.')
+metrics_v2.describe('translator_history_total', 'counter', 'Long-term history writer counters.')
+metrics_v2.describe('translator_startup_phase_seconds', 'gauge', 'Duration of the startup phases.')
+metrics_v2.describe('translator_ingest_pending', 'gauge', 'Stream entries read but not acknowledged yet.')
+metrics_v2.describe('translator_history_backlog_bytes', 'gauge', 'Size of the encoded history chunks waiting to be written.')
 
-# redis reader task
-async def redisReader(channel: aioredis.client.PubSub):
-    global doq
+
+def startupPhaseDone(phase, startTime):   # record the duration of a startup phase, returns its end time (the start of the next phase)
+    endTime = time.perf_counter()
+    startupPhases[phase] = endTime - startTime
+    metrics_v2.gaugeSet('translator_startup_phase_seconds', (('phase', phase),), startupPhases[phase])
+    return endTime
+
+
+# add an item to the data out queue of its collection
+async def enqueue(item, token = None):
+# param[in] token:   ingest token of the stream entry of the item (held until the item is sent or dropped), optional
+    queue = outQueues.get(item['coll'])
+    if queue is not None and changeFilter.accept(item):   # items of unknown collections (e.g. 'dummy') and unchanged values are not sent
+        if token is not None:
+            item = dict(item, ingestToken = token)
+            streamIngest.tracker.hold(token)
+        await queue.put(item)
+
+
+def priorityClassOf(item):   # priority class index of a data out item
+    key = (item['coll'], item['attr'])
+    priorityClass = priorityClasses.get(key)
+    if priorityClass is None:
+        name = DCM_PRIORITY.get(key[0] + '/' + key[1], DCM_PRIORITY.get(key[0], DCM_PRIORITY_DEFAULT))
+        priorityClass = priorityClasses[key] = priorityClassNames.index(name)
+    return priorityClass
+
+
+def higherPriorityWaiting(priorityClass):   # items of a higher priority class are waiting in any data out queue
+    return any(queue.waiting(c) for queue in outQueues.values() for c in range(priorityClass))
+
+
+def itemDiscarded(item, reason):   # a queued item was superseded or dropped: its value was not sent, its stream entry does not wait for it (it is not acknowledged if the item was lost in an overflow)
+    changeFilter.discard(item)
+    token = item.get('ingestToken')
+    if token is not None:
+        if reason == outqueue_v2.DISCARD_OVERFLOW:
+            streamIngest.tracker.fail(token)
+        streamIngest.tracker.release(token)
+
+
+def translatingInLoop():   # translator modules run in this process (their state and background tasks are here)
+    return shardPool is None or shardPool.mode == shard_v2.SHARD_MODE_THREAD
+
+
+def translatorStats():   # statistics of the TSD buffers, time sync and device states in this process (tsdbuf_v2.tsdbufStatsCollect), None if they are in the worker processes or not published yet
+    if shardPool is None:
+        return tsdbuf_v2.tsdbufStatsCollect()
+    if shardPool.mode == shard_v2.SHARD_MODE_THREAD:   # published by the worker thread, its buffers are not read here
+        return tsdbuf_v2.tsdbufStatsPublished
+    return None
+
+
+# ingest stage of a message: BDCL messages are passed to the translation workers or decoded and translated here
+async def ingestMessage(channelName, data, token = None):
+# param[in] token:   ingest token of the stream entry of the message (released when it is translated), optional
+    startTime = time.perf_counter()
     jsondata = {}
+    sclItem = None
+    isScl = False
+    try:
+        metrics_v2.counterInc('translator_redis_messages_total', (('channel', channelName),))
+        isScl = channelName == sclChannel
+        if shardPool is not None and not isScl:   # BDCL message, decoded and translated by the worker of the device
+            await shardPool.submit(data, token)
+            metrics_v2.stageDone(metrics_v2.STAGE_INGEST, time.perf_counter() - startTime)
+            return
+        metrics_v2.stageDone(metrics_v2.STAGE_INGEST, time.perf_counter() - startTime)
+        startTime = time.perf_counter()
+        if isScl:   # SCL message, the fields are extracted from the raw message
+            sclItem = scl_v2.sclItemFromRaw(data)
+        else:
+            jsondata = codec_v2.loads(data)
+    except:
+        logging.warning('(redisReader) Not a valid json from %s.', 'SCL' if isScl else 'BDCL')
+        metrics_v2.counterInc('translator_decode_failures_total', (('source', 'scl' if isScl else 'bdcl'),))
+    metrics_v2.stageDone(metrics_v2.STAGE_DECODE, time.perf_counter() - startTime)
+    if sclItem is not None:   # SCL message
+        await enqueue(sclItem, token)
+    elif jsondata:   # BDCL message
+        # invoke translators and add data to "data out queue"
+        startTime = time.perf_counter()
+        items = [do for outList in dispatch_v2.translateMessage(dispatchIndex, jsondata) for do in outList]
+        metrics_v2.stageDone(metrics_v2.STAGE_TRANSLATE, time.perf_counter() - startTime)
+        for do in items:
+            await enqueue(do, token)
+    if token is not None:
+        streamIngest.tracker.release(token)
+
+
+# redis reader task: messages of the pub/sub channels
+async def redisReader(channel: aioredis.client.PubSub):
     async for message in channel.listen():
-        if message is not None:
-            try:
-                if message['type'] != 'pmessage':   # filter for normal messages (not subscribe etc.)
-                    continue
-                jsondata = json.loads(message['data'])
-            except:
-                logging.warning('(redisReader) Not a valid json from BDCL.')
-                jsondata = {}
-            if jsondata:
-                if message['channel'].decode('ascii') == '451513e9-da18-4c35-863c-877bac283863':  # SCL message
-                    print(jsondata)
-                    # extract data
-                    unqId = jsondata.get('devId', 0)
-                    uuid = jsondata.get('uuid', 'None')
-                    measTime = jsondata.get('timestamp', None)
-                    ssTime = jsondata.get('sensorsetbufferTime', None)
-                    positions = jsondata.get('positions', None)
-                    # add to queue
-                    if positions is not None:
-                        value = [pos['positionVector'] for pos in jsondata['positions']]
-                    else:
-                        value = [[0.0, 0.0, 0.0]]  # value is a list of position vectors
-                    px = {
-                        'coll' : 'sclpositions',
-                        'id' : 'tag.' + str(unqId),
-                        'attr' : 'sclProfiles/' + uuid + '/rawPositions',
-                        'data' : {'value' : value, 'times' : {'measurement' : measTime, 'sensorsetbuffer' : ssTime}}
-                    }
-                    doq.append(px)
-                else:   # BDCL message
-                    # extract data
-                    datamap = jsondata.get('data', None)
-                    header = jsondata.get('header', {})
-                    unqId = header.get('uniqId', None)
-                    measTime = header.get('measTs', None)
-                    ssTime = header.get('serverTs', None)
-                    # error check
-                    if datamap is None or unqId is None:
-                        continue
-                    # measurement time check
-                    if measTime is None:
-                        if ssTime is None:
-                            logging.warning("Neither measurement time nor sensorSetBuffer time present for data from '%u'.", unqId)
-                        else:
-                            measTime = ssTime
-                            logging.debug("No measurement time for this data from '%u', assuming that sensorSetBuffer time is also the measurement time.", unqId)
-                    # invoke translator and add data to "data out queue"
-                    for module in translatorsImp:
-                        try:
-                            for outList in module.translator_func(datamap, unqId, {'measurement' : measTime, 'sensorsetbuffer' : ssTime}):   # FIXME
-                                for do in outList:
-                                    doq.append(do)
-                        except BaseException as e:
-                            logging.error(
-                                "Exception '%s' with message '%s' in translator module '%s'\n%s",
-                                type(e).__name__, str(e), module.__name__, traceback.format_exc()
-                            )
-
-
-# task to reconnect a websocket
-async def wsReconnectTask(coll):
-    global wsObjects
+        if message is not None and message['type'] == 'pmessage':   # filter for normal messages (not subscribe etc.)
+            await ingestMessage(message['channel'].decode('ascii'), message['data'])
 
+
+# stream reader task: entries of the stream partitions of this instance, many entries in one XREADGROUP
+async def streamReader():
+    while True:
+        try:
+            messages = await streamIngest.read()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.warning('(streamReader) Cannot read the streams (%s), retry in %.1f sec.', str(e), ingest_v2.INGEST_RETRY_SEC)
+            await asyncio.sleep(ingest_v2.INGEST_RETRY_SEC)
+            continue
+        for token, channelName, data in messages:
+            await ingestMessage(channelName, data, token)
+
+
+# task to add the data translated by the worker processes to the "data out queue" and their closed chunks to the history backlog
+async def shardResultReader():
+    while True:
+        items, chunks, metrics, tokens = await shardPool.getResult()
+        if metrics is not None:
+            metrics_v2.mergeState(metrics)
+        for chunk in chunks:
+            tsdbuf_v2.tsdbufHistoryEnqueue(chunk)
+        if tokens:   # stream entries: the items of each entry hold it, then its translation is done
+            start = 0
+            for token, count in tokens:
+                for do in items[start:start + count]:
+                    await enqueue(do, token)
+                streamIngest.tracker.release(token)
+                start += count
+        else:
+            for do in items:
+                await enqueue(do)
+
+
+# connect to the patch websocket of a collection
+async def wsConnect(coll):
+    return await asyncio.wait_for(websockets.connect(dcmPatchWsUrl.format(coll)), DCM_CONNECT_TIMEOUT_SEC)
+
+
+# connect to the patch websockets of every collection concurrently
+async def wsConnectAll():
+    results = await asyncio.gather(*[wsConnect(coll) for coll in dcmCollections], return_exceptions = True)
+    for coll, result in zip(dcmCollections, results):
+        if isinstance(result, BaseException):
+            logging.error("Cannot connect to websocket '%s' (%s)", dcmPatchWsUrl.format(coll), type(result).__name__)
+        else:
+            wsObjects.update({coll : result})
+
+
+# task to reconnect a websocket, with exponential backoff and jitter
+async def wsReconnectTask(coll):
     url = dcmPatchWsUrl.format(coll)
+    delay = DCM_RECONNECT_DELAY_MIN_SEC
     while coll not in wsObjects:
-        await asyncio.sleep(1.0)   # 1 sec
+        await asyncio.sleep(delay / 2 + random.uniform(0, delay / 2))
+        delay = min(delay * 2, DCM_RECONNECT_DELAY_MAX_SEC)
         logging.warning("Trying to reconnect to websocket '%s' ...", url)
         try:
-            ws = await websockets.connect(url)
+            ws = await wsConnect(coll)
             wsObjects.update({coll : ws})
-            logging.info("Successfully reconnected to websocket '%s'", url)
+            metrics_v2.counterInc('translator_websocket_reconnects_total', (('coll', coll), ('result', 'success')))
+            logging.info("Successfully reconnected to websocket '%s', %u buffered patch(es) to replay", url, len(outageBuffers[coll]))
+            changeFilter.forget(coll)   # values dropped during the outage are sent again
+            outQueues[coll].wakeUp()   # the sender replays the buffered patches even if there is no new data
         except:
+            metrics_v2.counterInc('translator_websocket_reconnects_total', (('coll', coll), ('result', 'failure')))
             logging.error("Cannot reconnect to websocket '%s'", url)
+    wsReconnecting.discard(coll)
+
+
+def wsLost(coll):   # the websocket of a collection is not available: remove it and start reconnecting
+    wsObjects.pop(coll, None)
+    if coll not in wsReconnecting:
+        wsReconnecting.add(coll)
+        asyncio.create_task(wsReconnectTask(coll))
+
+
+def patchFromItem(item):   # create a JSON patch operation from a data out queue item
+    return {
+        'op' : 'replace',
+        'path' : '/{}/{}'.format(item['id'], item['attr']),
+        'value' : item['data']['value'],
+        'times': item['data']['times']
+    }
+
+
+def bufferPatches(coll, patches):   # keep patches of a collection until its websocket is available again
+    if DCM_OUTAGE_MAX_PATCHES > 0:
+        outageBuffers[coll].put(patches)
+    else:
+        logging.warning("Websocket for collection '%s' is not available, %u patch(es) dropped.", coll, len(patches))
+        metrics_v2.counterInc('translator_dropped_patches_total', (('coll', coll),), len(patches))
+
+
+# send patches of a collection in one frame, returns False if they were buffered (or dropped) instead
+async def sendBatch(coll, patches):
+    if coll not in wsObjects or len(outageBuffers[coll]):   # not connected, or behind buffered patches
+        bufferPatches(coll, patches)
+        return False
+    startTime = time.perf_counter()
+    if DCM_ENCODE_OFFLOAD_MIN_PATCHES and len(patches) >= DCM_ENCODE_OFFLOAD_MIN_PATCHES:   # large frame, keep the event loop free
+        wsData = await asyncio.get_running_loop().run_in_executor(None, codec_v2.encodeFrame, patches)
+    else:
+        wsData = codec_v2.encodeFrame(patches)
+    frameSize = len(wsData)
+    if DCM_WS_TEXT_FRAMES:
+        wsData = wsData.decode()
+    metrics_v2.stageDone(metrics_v2.STAGE_ENCODE, time.perf_counter() - startTime)
+    if not await sendFrame(coll, wsData, frameSize, len(patches)):
+        bufferPatches(coll, patches)   # DCM may or may not have got the frame, replacing the values again is harmless
+        return False
+    return True
+
+
+# send the oldest buffered patches of a collection in one frame
+async def replayBuffered(coll):
+    outage = outageBuffers[coll]
+    encoded = outage.peek(DCM_BATCH_MAX_SIZE)
+    wsData = outage_v2.encodeFrameFromPatches(encoded)
+    frameSize = len(wsData)
+    if DCM_WS_TEXT_FRAMES:
+        wsData = wsData.decode()
+    if await sendFrame(coll, wsData, frameSize, len(encoded)):
+        outage.commit(len(encoded))
+        if not len(outage):
+            logging.info("Buffered patches of collection '%s' are replayed.", coll)
+            dropCount, tokens = outageTokens.pop(coll, (outage.dropCount, []))
+            for token in tokens:
+                if outage.dropCount > dropCount:   # some patches were dropped meanwhile, the entries are read again after a restart
+                    streamIngest.tracker.fail(token)
+                streamIngest.tracker.release(token)
+
+
+# send an encoded frame of patches to the websocket of a collection, returns False if it failed
+async def sendFrame(coll, wsData, frameSize, patchCount):
+    global frameLogCounter
+
+    collLabels = (('coll', coll),)
+    try:
+        startTime = time.perf_counter()
+        await wsObjects[coll].send(wsData)
+        sendTime = time.perf_counter() - startTime
+        metrics_v2.histogramObserve('translator_send_seconds', collLabels, sendTime)
+        metrics_v2.stageDone(metrics_v2.STAGE_SEND, sendTime)
+        metrics_v2.counterInc('translator_sent_frames_total', collLabels)
+        metrics_v2.counterInc('translator_sent_patches_total', collLabels, patchCount)
+        metrics_v2.counterInc('translator_sent_bytes_total', collLabels, frameSize)
+        stats = sendStats.setdefault(coll, {'frames' : 0, 'patches' : 0})
+        stats['frames'] += 1
+        stats['patches'] += patchCount
+        if DCM_FRAME_LOG_SAMPLE > 0:
+            frameLogCounter += 1
+            if frameLogCounter >= DCM_FRAME_LOG_SAMPLE:
+                frameLogCounter = 0
+                logging.info("Data sent to websocket '%s': %s", coll, wsData)
+        return True
+    except:
+        metrics_v2.counterInc('translator_send_failures_total', collLabels)
+        logging.error("Cannot send to websocket of collection '%s', will be removed from list now.", coll)
+        wsLost(coll)  # try to reconnect
+        return False
+
+
+# sender task of a collection: patches are gathered into one frame until the batch is full or its linger time is over (higher priority classes first), buffered patches are replayed first
+async def collectionSender(coll):
+    queue = outQueues[coll]
+    outage = outageBuffers[coll]
+    lingerSec = DCM_BATCH_LINGER_MS / 1000
+    while True:
+        if len(outage) and coll in wsObjects:
+            await replayBuffered(coll)
+            continue
+        items = await queue.getBatch(DCM_BATCH_MAX_SIZE, lingerSec)
+        if items:
+            if queue.batchClass and higherPriorityWaiting(queue.batchClass):   # let the senders of higher priority items go first
+                await asyncio.sleep(0)
+            sent = await sendBatch(coll, [patchFromItem(item) for item in items])
+            if streamIngest is not None:
+                itemsDone(coll, items, sent)
+
+
+def itemsDone(coll, items, sent):   # release the stream entries of sent items, those of buffered items wait until the outage buffer is drained (the entries of dropped items fail)
+    tokens = [item['ingestToken'] for item in items if 'ingestToken' in item]
+    outage = outageBuffers[coll]
+    if sent or not len(outage):
+        for token in tokens:
+            if not sent:   # dropped, no outage buffer
+                streamIngest.tracker.fail(token)
+            streamIngest.tracker.release(token)
+    else:
+        outageTokens.setdefault(coll, (outage.dropCount, []))[1].extend(tokens)
+
+
+def logSendStats():   # log frames/sec, patches/frame and queue depth for each collection
+    global sendStatsLastLogTime
+
+    now = time.perf_counter()
+    elapsed = now - sendStatsLastLogTime
+    for coll, queue in outQueues.items():
+        stats = sendStats.get(coll, {'frames' : 0, 'patches' : 0})
+        qstats = queue.stats()
+        if stats['frames'] or qstats['maxDepth'] or qstats['dropped']:
+            logging.info(
+                "Send statistics for collection '%s': %.1f frames/sec, %.1f patches/frame, queue depth %u (max %u), %u dropped, %u conflated, %u late (%u dropped)",
+                coll, stats['frames'] / elapsed, stats['patches'] / max(stats['frames'], 1), qstats['depth'], qstats['maxDepth'], qstats['dropped'], qstats['conflated'], qstats['late'], qstats['lateDropped']
+            )
+    logging.info("Change filter statistics: %s", changeFilter.stats())
+    for coll, outage in outageBuffers.items():
+        if len(outage):
+            logging.info("Outage buffer of collection '%s': %s", coll, outage.stats())
+    logStageStats(elapsed)
+    if shardPool is not None:
+        logging.info("Translation worker statistics: %s", shardPool.stats())
+    if historyRedisUrl:
+        logging.info("Long-term history statistics: %s", tsdbuf_v2.tsdbufHistoryStatsGet())
+    stats = translatorStats()
+    if stats is not None:
+        logging.info("TSD duplication avoidance buffer statistics: %s", stats['avoidDup'])
+        logging.info("TSD time sync statistics: %s", stats['timeSync'])
+        logging.info("Device state statistics: %s", stats['devices'])
+    sendStats.clear()
+    sendStatsLastLogTime = now
+
+
+def logStageStats(elapsed):   # log items/sec and busy ratio of each pipeline stage since the last stats log
+    parts = []
+    for stage in metrics_v2.STAGES:
+        items = metrics_v2.metricsCounters.get(('translator_stage_items_total', metrics_v2.stageLabels[stage]), 0)
+        seconds = metrics_v2.metricsCounters.get(('translator_stage_seconds_total', metrics_v2.stageLabels[stage]), 0.0)
+        lastItems, lastSeconds = stageStatsLast.get(stage, (0, 0.0))
+        stageStatsLast[stage] = (items, seconds)
+        parts.append('{} {:.1f}/sec ({:.1f}% busy)'.format(stage, (items - lastItems) / elapsed, 100 * (seconds - lastSeconds) / elapsed))
+    logging.info("Pipeline stage statistics: %s", ', '.join(parts))
+
+
+def metricsCollect():   # gauges and counters owned by other objects, evaluated at export time
+    out = []
+    for coll, queue in outQueues.items():
+        qstats = queue.stats(reset = False)
+        out.append(('translator_queue_depth', (('coll', coll),), qstats['depth']))
+        for result in ['accepted', 'dropped', 'conflated']:
+            out.append(('translator_queue_items_total', (('coll', coll), ('result', result)), qstats[result]))
+        for priorityClass, name in enumerate(priorityClassNames):
+            out.append(('translator_queue_late_total', (('class', name), ('coll', coll), ('result', 'sent')), queue.lateCounts[priorityClass] - queue.lateDropCounts[priorityClass]))
+            out.append(('translator_queue_late_total', (('class', name), ('coll', coll), ('result', 'dropped')), queue.lateDropCounts[priorityClass]))
+        out.append(('translator_websocket_connected', (('coll', coll),), int(coll in wsObjects)))
+    fstats = changeFilter.stats()
+    out.append(('translator_suppress_entries', (), fstats['entries']))
+    out.append(('translator_suppress_items_total', (('result', 'passed'),), fstats['sent']))
+    out.append(('translator_suppress_items_total', (('result', 'suppressed'),), fstats['suppressed']))
+    for coll, outage in outageBuffers.items():
+        ostats = outage.stats()
+        out.append(('translator_outage_patches', (('coll', coll),), ostats['patches']))
+        out.append(('translator_outage_bytes', (('coll', coll),), ostats['bytes']))
+        for result in ['buffered', 'dropped', 'conflated', 'replayed']:
+            out.append(('translator_outage_items_total', (('coll', coll), ('result', result)), ostats[result]))
+    stats = translatorStats()
+    if stats is not None:
+        for name, value in stats['sizes'].items():
+            out.append(('translator_tsdbuf_size', (('buffer', name),), value))
+    elif shardPool is not None and shardPool.mode == shard_v2.SHARD_MODE_PROCESS:   # the other buffers are in the worker processes
+        out.append(('translator_tsdbuf_size', (('buffer', 'historyBacklogChunks'),), len(tsdbuf_v2.tsdbufHistoryBacklog)))
+    if historyRedisUrl:
+        for name, value in tsdbuf_v2.tsdbufHistoryStatsGet().items():
+            if name in ['chunksWritten', 'recordsWritten', 'bytesWritten', 'recordsDropped', 'writeFailures']:
+                out.append(('translator_history_total', (('counter', name),), value))
+            elif name == 'backlogBytes':
+                out.append(('translator_history_backlog_bytes', (), value))
+    if streamIngest is not None:
+        out.append(('translator_ingest_pending', (), len(streamIngest.tracker)))
+    return out
 
 
 # MAIN
 async def main():
-    global doq
-    global wsObjects
+    global sendStatsLastLogTime
+    global streamIngest
+
+    phaseTime = time.perf_counter()
+    # create data out queues
+    for coll in dcmCollections:
+        outQueues[coll] = outqueue_v2.OutQueue(
+            DCM_QUEUE_MAX_SIZE, DCM_QUEUE_OVERFLOW.get(coll, DCM_QUEUE_OVERFLOW_DEFAULT), DCM_QUEUE_CONFLATE.get(coll, False),
+            itemDiscarded,
+            priorityClassOf, [priorityClass['deadlineSec'] for priorityClass in DCM_PRIORITY_CLASSES], [priorityClass['dropLate'] for priorityClass in DCM_PRIORITY_CLASSES],
+            [priorityClass['lingerMs'] / 1000 if priorityClass['lingerMs'] is not None else None for priorityClass in DCM_PRIORITY_CLASSES], [metrics_v2.histogram('translator_queue_latency_seconds', (('class', name), ('coll', coll))) for name in priorityClassNames]
+        )
+        spillPath = os.path.join(DCM_OUTAGE_SPILL_DIR, 'outage-{}.ring'.format(coll)) if DCM_OUTAGE_SPILL_DIR else None
+        outageBuffers[coll] = outage_v2.OutageBuffer(DCM_OUTAGE_MAX_PATCHES, DCM_OUTAGE_MAX_BYTES, DCM_QUEUE_CONFLATE.get(coll, False), spillPath, DCM_OUTAGE_SPILL_FILE_SIZE)
+
+    # metrics endpoint
+    metrics_v2.metricsCollectors.append(metricsCollect)
+    if METRICS_PORT:
+        metricsTask = asyncio.create_task(metrics_v2.metricsServer(METRICS_HOST, METRICS_PORT))
+
+    phaseTime = startupPhaseDone('queues', phaseTime)
 
     # initialize redis reader
-    redis = aioredis.from_url('redis://bdcl')
-    redisPubsub = redis.pubsub()
-    await redisPubsub.psubscribe('451513e9-da18-4c35-863c-877bac28386*')
-    redisTask = asyncio.create_task(redisReader(redisPubsub))
+    redis = aioredis.from_url(bdclRedisUrl)
+    if TRANSLATOR_INGEST == ingest_v2.INGEST_STREAMS:   # entries of the stream partitions of this instance
+        streamIngest = ingest_v2.StreamIngest(redis, ingest_v2.ownedPartitions(ingest_v2.INGEST_INSTANCE, ingest_v2.INGEST_STREAM_PARTITIONS))
+        await streamIngest.start()
+        redisTask = asyncio.create_task(streamReader())
+        ackTask = asyncio.create_task(streamIngest.acker())
+    else:
+        redisPubsub = redis.pubsub()
+        await redisPubsub.psubscribe(bdclChannelPattern)
+        redisTask = asyncio.create_task(redisReader(redisPubsub))
+    phaseTime = startupPhaseDone('redis', phaseTime)
+    if translatingInLoop():   # background tasks of the translator modules (they run in the worker processes in sharded mode)
+        moduleTasks = [asyncio.create_task(task()) for task in dispatch_v2.moduleTasks(translatorsImp)]
+    if historyRedisUrl:   # long-term history writer
+        historyTask = asyncio.create_task(tsdbuf_v2.tsdbufHistoryWriter(aioredis.from_url(historyRedisUrl)))
+    if shardPool is not None:
+        shardPool.attach()
+        shardTask = asyncio.create_task(shardResultReader())
 
     # connect to DCM patch websockets
-    for coll in dcmCollections:
-        url = dcmPatchWsUrl.format(coll)
-        try:
-            ws = await websockets.connect(url)
-            wsObjects.update({coll : ws})
-        except:
-            logging.error("Cannot connect to websocket '%s'", url)
+    await wsConnectAll()
+    phaseTime = startupPhaseDone('websockets', phaseTime)
 
-    logging.info('Loop starting...')
+    logging.info("Loop starting (JSON codec: '%s')...", codec_v2.codecName)
+    sendStatsLastLogTime = time.perf_counter()
+    senderTasks = [asyncio.create_task(collectionSender(coll)) for coll in dcmCollections]
 
-    # send loop
+    # statistics loop, runs while the senders work
     if wsObjects:   # successfully connected to at least one websocket
-        while wsObjects:
-            if not doq:   # queue is empty
-                await asyncio.sleep(0.1)
-            else:   # item(s) in queue
-                item = doq.popleft()
-                if item['coll'] in wsObjects:   # websocket for this collection is available
-                    ws = wsObjects[item['coll']]
-                    patch = {
-                        'op' : 'replace',
-                        'path' : '/{}/{}'.format(item['id'], item['attr']),
-                        'value' : item['data']['value'],
-                        'times': item['data']['times']
-                    }
-                    wsData = json.dumps([patch])
-                    try:
-                        await ws.send(wsData)
-                        logging.info("Data sent to websocket '%s': %s", item['coll'], wsData)
-                    except:
-                        logging.error("Cannot send to websocket of collection '%s', will be removed from list now.", item['coll'])
-                        wsObjects.pop(item['coll'])
-                        asyncio.create_task(wsReconnectTask(item['coll']))  # try to reconnect
-                else:
-                    logging.warning("Websocket for collection '%s' is not available.", item['coll'])
+        for coll in dcmCollections:
+            if coll not in wsObjects:
+                wsLost(coll)
+        startupPhases['total'] = phaseTime - startupStartTime
+        metrics_v2.gaugeSet('translator_startup_phase_seconds', (('phase', 'total'),), startupPhases['total'])
+        metrics_v2.setReady(True)
+        logging.info("Ready in %.3f sec (%s), %u of %u websocket(s) connected.", startupPhases['total'], ', '.join('{}: {:.3f}'.format(phase, seconds) for phase, seconds in startupPhases.items() if phase != 'total'), len(wsObjects), len(dcmCollections))
+        while wsObjects or wsReconnecting:
+            await asyncio.sleep(DCM_STATS_LOG_INTERVAL_SEC)
+            try:
+                logSendStats()
+            except Exception as e:   # statistics must not stop the translator
+                logging.error("Exception '%s' with message '%s' in logging the statistics", type(e).__name__, str(e))
     else:
         logging.critical('Cannot connect to any websockets at all.')
     
     # finalize FIXME make these run on termination
+    metrics_v2.setReady(False)
+    for task in senderTasks:
+        task.cancel()
     for coll, ws in wsObjects.items():
         await ws.close()
-    await redisPubsub.unsubscribe()
-    await redisPubsub.close()
-    await redisTask.cancel()
+    for outage in outageBuffers.values():
+        outage.close()
+    redisTask.cancel()
+    if streamIngest is not None:   # sent entries are acknowledged, the others are read again after a restart
+        ackTask.cancel()
+        await streamIngest.ack()
+    else:
+        await redisPubsub.unsubscribe()
+        await redisPubsub.close()
+    if translatingInLoop():
+        for task in moduleTasks:
+            task.cancel()
+        devstate_v2.devstateSnapshot(background = False)
+    if historyRedisUrl:
+        historyTask.cancel()
+    if METRICS_PORT:
+        metricsTask.cancel()
+    if shardPool is not None:
+        shardTask.cancel()
+        shardPool.stop()
 
 
-if __name__ == '__main__':    
-    # logging
-    logging.basicConfig(level = logging.INFO)
+def prepare():   # import the translator modules, load the device states and start the translation workers (before main)
+    global dispatchIndex
+    global shardPool
+
+    phaseTime = startupStartTime
     # import translator modules
     for module in translators:
         translatorsImp.append(importlib.import_module(module))
-    # asyncio
-    asyncio.run(main())
+    dispatchIndex = dispatch_v2.buildDispatchIndex(translatorsImp)
+    phaseTime = startupPhaseDone('modules', phaseTime)
+    # device states of the last run (translation in this process)
+    if TRANSLATOR_WORKERS == 0 or TRANSLATOR_WORKER_MODE == shard_v2.SHARD_MODE_THREAD:
+        devstate_v2.devstateStart('main')
+        phaseTime = startupPhaseDone('devstate', phaseTime)
+    # start translation worker processes
+    if TRANSLATOR_WORKERS > 0:
+        shardPool = shard_v2.ShardPool(TRANSLATOR_WORKERS, translators, dcmCollections, bool(historyRedisUrl), TRANSLATOR_WORKER_MODE)
+        shardPool.start()
+        phaseTime = startupPhaseDone('workers', phaseTime)
+
+
+async def bridgeMain():   # bridge mode: add the messages of the pub/sub channels to the stream partitions
+    redis = aioredis.from_url(bdclRedisUrl)
+    redisPubsub = redis.pubsub()
+    await redisPubsub.psubscribe(bdclChannelPattern)
+    if METRICS_PORT:
+        metricsTask = asyncio.create_task(metrics_v2.metricsServer(METRICS_HOST, METRICS_PORT))
+        metrics_v2.setReady(True)
+    try:
+        await ingest_v2.bridge(redisPubsub, redis, sclChannel)
+    finally:
+        await redisPubsub.unsubscribe()
+        await redisPubsub.close()
+        if METRICS_PORT:
+            metricsTask.cancel()
+
+
+if __name__ == '__main__':    
+    # logging
+    logging.basicConfig(level = logging.INFO)
+    if TRANSLATOR_INGEST not in ingest_v2.INGEST_MODES:
+        raise ValueError("Unknown ingest mode '{}'".format(TRANSLATOR_INGEST))
+    if TRANSLATOR_INGEST == ingest_v2.INGEST_BRIDGE:   # no translation
+        asyncio.run(bridgeMain())
+    else:
+        # translator modules and workers
+        prepare()
+        # asyncio
+        asyncio.run(main())
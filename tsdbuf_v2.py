@@ -1,13 +1,26 @@
-from collections import namedtuple
-from fractions import Fraction as frac
-import copy
+from collections import namedtuple, deque
+import asyncio
+import logging
+import os
+import statistics
+import sys
 import time
-import json
+import chunkcodec_v2
+import codec_v2
+import devstate_v2
 
 
 # general "constants"
 MEASUREMENT_TIME_PICOSEC = 1000000     # multiplier to convert measurement time to picosecond
-MEASUREMENT_TIME_SEC = frac(MEASUREMENT_TIME_PICOSEC, 1000000000000)     # multiplier to convert measurement time to seconds (floating-point)
+MEASUREMENT_TIME_USEC = 1     # multiplier to convert measurement time to microsecond (time sync uses integer microseconds)
+TSD_TIME_MULTIPLIERS = {   # multipliers to convert TSD timestamps to picosecond
+    'picoseconds':  1,
+    'nanoseconds':  1000,
+    'microseconds': 1000000,
+    'milliseconds': 1000000000,
+    'seconds':      1000000000000,
+    'minutes':      60000000000000
+}
 MEASUREMENT_TIME_TOONEW_LIMIT_SEC = 2.0    # tolerance for bad future timestamp detection: limit is current time plus this value to avoid false alerts due to unsynchronized clocks
 
 # buffering parameters
@@ -16,65 +29,144 @@ TSDBUF_CHUNK_SIZE_MIN = 10     # minimum target chunk size for long-term databas
 TSDBUF_CHUNK_CLOSE_TIMEOUT_NORMAL_SEC = 60    # chunk close timeout (seconds) when the data count is at least TSDBUF_CHUNK_SIZE_MIN
 TSDBUF_CHUNK_CLOSE_TIME_LIMIT_SEC = 600    # chunk close time limit (seconds), close chunk after this time even the data count is less than TSDBUF_CHUNK_SIZE_MIN
 
+# long-term history writer parameters
+TSDBUF_HISTORY_FORMAT = os.environ.get('TRANSLATOR_HISTORY_FORMAT', 'json')   # encoding of the history chunks: 'json' (list of sample objects) or 'columnar' (chunkcodec_v2)
+TSDBUF_HISTORY_KEY_FORMATS = {   # Redis list key of the long-term history chunks for each field, for each encoding
+    'json' : 'tsdbuf/history/{}',
+    'columnar' : 'tsdbuf/history-columnar/{}'
+}
+TSDBUF_HISTORY_BACKLOG_LIMIT = 200000   # maximum number of records in closed chunks waiting to be written (oldest chunks are dropped above this)
+TSDBUF_HISTORY_PIPELINE_MAX_CHUNKS = 500   # maximum number of field chunks written in one pipelined round trip
+TSDBUF_HISTORY_POLL_INTERVAL_SEC = 1.0   # check interval (seconds) for closed chunks
+TSDBUF_HISTORY_RETRY_MIN_SEC = 0.5   # first retry delay (seconds) after a failed write, doubled for every further failure
+TSDBUF_HISTORY_RETRY_MAX_SEC = 30.0   # maximum retry delay (seconds)
+
+# time sync parameters
+TIMESYNC_SMOOTHING_SHIFT = 4   # a larger clock offset (delayed message) moves the offset estimate by 1/2^shift of the difference, a smaller one is taken at once
+
 # misc parameters
 TSDBUF_AVOID_DUP_BUFFER_CLEANUP_INTERVAL_SEC = 60   # interval (seconds) for removing too old items from the duplication avoidance buffer
+TSDBUF_AVOID_DUP_BUCKET_WIDTH = 60 * 1000000   # measurement time range (microseconds) of one duplication avoidance buffer bucket, too old buckets are dropped at once
 
-# variables for dummy time sync: we save this two at the same time
-timesyncMeasurementTime = 0
-timesyncTickCount = 0.0
+# variables for time sync: clock offset estimates (local time minus measurement time, microseconds)
+timesyncGlobalOffset = None   # smoothed over every source, used for sources without estimate (the estimate of each source is in its devstate_v2.DeviceState)
 
 # variables for timing
 tsdbufAvoidDupBufferCleanupLastTime = 0.0
 tsdbufChunkCollectionStartTime = float('inf')
 
-# variables for DCM updating
-tsdLatestMeasTimeStorage = {}   # storage for the measurement time of latest TSD data for each device and LoLaN variable
-
 # variables for buffering
 chunkBufferRecordType = namedtuple('chunkBufferRecordType', ['id', 'field', 'values', 'times'])
 tsdbufChunkBuffer = []   # buffer for creating chunks for long-term database; elements: chunkBufferRecordType
-tsdbufAvoidDupBuffer = set()   # buffer to help avoid duplicates in output data; elements: (idCompound, measTime)
+tsdbufAvoidDupBuffer = {}   # buffer to help avoid duplicates in output data, bucketed by measurement time; measTime // TSDBUF_AVOID_DUP_BUCKET_WIDTH -> set of (idCompound, measTime)
+tsdbufAvoidDupBucketOffsets = {}   # largest clock offset (usec) of the sources with records in each bucket of tsdbufAvoidDupBuffer, the bucket is kept until it is older than the buffering window of each of them
+
+# variables for statistics
+tsdbufStatsPublished = None   # tsdbufStatsCollect() result published by a translation worker thread for the event loop (the buffers and states are not read by other threads), None if not published yet
 
+# variables for long-term history writing
+tsdbufHistoryEnabled = False   # closed chunks are kept for the history writer only if enabled
+tsdbufHistoryBacklog = deque()   # closed chunks waiting to be encoded and written by the history writer; elements: list of chunkBufferRecordType
+tsdbufHistoryBacklogRecords = 0   # number of records in tsdbufHistoryBacklog
+tsdbufHistoryBacklogBytes = 0   # size of the encoded chunks taken by the history writer and not written yet
+tsdbufHistoryStats = {   # long-term history writer metrics
+    'chunksWritten' : 0,   # number of written field chunks
+    'recordsWritten' : 0,   # number of written records
+    'bytesWritten' : 0,   # size of written field chunks
+    'recordsDropped' : 0,   # number of records dropped due to the backlog limit
+    'writeFailures' : 0,   # number of failed pipelined writes
+    'lastFlushLatencySec' : 0.0,   # duration of the last successful pipelined write
+    'maxFlushLatencySec' : 0.0   # maximum duration of pipelined writes
+}
 
-def tsdbufTimeSync(times):   # synchronize measurement time for TSD buffering
 
-    global timesyncTickCount
-    global timesyncMeasurementTime
+def localTimeUsec():   # local time in integer microseconds
+    return int(time.time() * 1000000)
+
+def smoothedOffset(current, offset):   # new offset estimate: the smallest offset has the least transfer delay, larger ones are followed slowly (clock drift)
+    if current is None or offset < current:
+        return offset
+    return current + ((offset - current) >> TIMESYNC_SMOOTHING_SHIFT)
+
+def tsdbufTimeSync(times, source = None):   # synchronize measurement time for TSD buffering
+# param[in] times:    times of the message
+# param[in] source:   device identifier of the message, optional
+
+    global timesyncGlobalOffset
 
     if 'measurement' in times and times['measurement']:
-            timesyncTickCount = time.time()
-            timesyncMeasurementTime = times['measurement']
+        offset = localTimeUsec() - int(times['measurement']) * MEASUREMENT_TIME_USEC
+        timesyncGlobalOffset = smoothedOffset(timesyncGlobalOffset, offset)
+        if source is not None:
+            state = devstate_v2.deviceStates.touch(source)
+            state.timesyncOffset = smoothedOffset(state.timesyncOffset, offset)
+    elif source is not None:
+        devstate_v2.deviceStates.touch(source)
+
+def timesyncOffset(source = None):   # clock offset estimate (usec) of a source, the global one if the source has no estimate yet
+    state = devstate_v2.deviceStates.get(source)
+    offset = state.timesyncOffset if state is not None else None
+    if offset is None:
+        offset = timesyncGlobalOffset
+    return offset if offset is not None else 0
 
-def measurementTimeToTickCount(measTime):   # convert measurement time to TickCount using the internal synchronization
-    return timesyncTickCount - (timesyncMeasurementTime - measTime) * MEASUREMENT_TIME_SEC
+def measurementTimeToTickCount(measTime, source = None):   # convert measurement time to TickCount (local time in seconds) using the internal synchronization
+    return (measTime * MEASUREMENT_TIME_USEC + timesyncOffset(source)) / 1000000
 
-def notTooOld(measTime):    # check whether the given measurement time is not too old to fit in the buffering window
-    t = measurementTimeToTickCount(measTime)
-    return t + TSDBUF_DATA_AGE_LIMIT_SEC >= time.time()
+def measurementTimeWindow(source = None):   # measurement time limits (oldest, newest) of a source for O(1) checks: notTooOld(t) is t >= oldest, notTooNew(t) is t < newest
+    localTime = localTimeUsec() - timesyncOffset(source)
+    return localTime - TSDBUF_DATA_AGE_LIMIT_SEC * 1000000, localTime + int(MEASUREMENT_TIME_TOONEW_LIMIT_SEC * 1000000)
 
-def notTooNew(measTime):    # check whether the given measurement time is not too new (is in future)
-    t = measurementTimeToTickCount(measTime)
-    return t < time.time() + MEASUREMENT_TIME_TOONEW_LIMIT_SEC
+def notTooOld(measTime, source = None):    # check whether the given measurement time is not too old to fit in the buffering window
+    return measTime >= measurementTimeWindow(source)[0]
+
+def notTooNew(measTime, source = None):    # check whether the given measurement time is not too new (is in future)
+    return measTime < measurementTimeWindow(source)[1]
+
+def tsdbufTimeSyncStats():   # clock offset estimates (usec)
+    offsets = [state.timesyncOffset for state in devstate_v2.deviceStates.values() if state.timesyncOffset is not None]
+    return {
+        'globalOffsetUsec' : timesyncGlobalOffset,
+        'sources' : len(offsets),
+        'minOffsetUsec' : min(offsets) if offsets else None,
+        'medianOffsetUsec' : statistics.median_low(offsets) if offsets else None,
+        'maxOffsetUsec' : max(offsets) if offsets else None
+    }
 
 def tsdLatestCheckUpdate(idCompound, measTime):    # check whether the TSD data with this time is the latest and update latest time if needed
-    if idCompound in tsdLatestMeasTimeStorage and tsdLatestMeasTimeStorage[idCompound] >= measTime:   # stored yet and the data to check is older
+    latestMeasTimes = devstate_v2.deviceStates.record(idCompound[0]).latestMeasTimes
+    if idCompound[1] in latestMeasTimes and latestMeasTimes[idCompound[1]] >= measTime:   # stored yet and the data to check is older
         return False
-    tsdLatestMeasTimeStorage[idCompound] = measTime   # does not exist yet, or newer
+    latestMeasTimes[idCompound[1]] = measTime   # does not exist yet, or newer
     return True
 
 def tsdbufAddRecord(idCompound, values, times):   # add record to the TSD buffer avoiding duplicates
 
+    if notTooOld(times['measurement'], idCompound[0]):
+        tsdbufAddRecordInWindow(idCompound, values, times)
+
+def tsdbufAddRecordInWindow(idCompound, values, times, offset = None):   # add record to the TSD buffer avoiding duplicates, the measurement time is checked to be in the buffering window yet
+# param[in] offset:   clock offset estimate of the source (timesyncOffset(idCompound[0])) if already known, optional
+
     global tsdbufChunkCollectionStartTime
     measTime = times['measurement']
     dupBufRecord = (idCompound, measTime)
 
-    if notTooOld(measTime):
-        if dupBufRecord not in tsdbufAvoidDupBuffer:   # this data is not buffered yet
-            tsdbufAvoidDupBuffer.add(dupBufRecord)   # add to duplicate avoidance buffer
-            if not tsdbufChunkBuffer:   # empty yet
-                tsdbufChunkCollectionStartTime = time.time()   # save time as chunk collection start time
-            record = chunkBufferRecordType(idCompound[0], idCompound[1], values, times)
-            tsdbufChunkBuffer.append(record)   # add to chunk buffer
+    bucketIndex = measTime // TSDBUF_AVOID_DUP_BUCKET_WIDTH
+    bucket = tsdbufAvoidDupBuffer.get(bucketIndex)
+    if bucket is None:
+        bucket = tsdbufAvoidDupBuffer[bucketIndex] = set()
+        tsdbufAvoidDupBucketOffsets[bucketIndex] = 0
+    if dupBufRecord not in bucket:   # this data is not buffered yet
+        bucket.add(dupBufRecord)   # add to duplicate avoidance buffer
+        if offset is None:
+            offset = timesyncOffset(idCompound[0])
+        if offset > tsdbufAvoidDupBucketOffsets[bucketIndex]:
+            tsdbufAvoidDupBucketOffsets[bucketIndex] = offset
+        if not tsdbufChunkBuffer:   # empty yet
+            tsdbufChunkCollectionStartTime = time.time()   # save time as chunk collection start time
+        record = chunkBufferRecordType(idCompound[0], idCompound[1], values, times)
+        tsdbufChunkBuffer.append(record)   # add to chunk buffer
 
 def tsdbufWriteHistory():   # write chunk(s) to the history
 
@@ -83,90 +175,224 @@ def tsdbufWriteHistory():   # write chunk(s) to the history
 
     if tsdbufChunkBuffer and time.time() >= tsdbufChunkCollectionStartTime + TSDBUF_CHUNK_CLOSE_TIMEOUT_NORMAL_SEC:   # some data exists and normal timeout
         if len(tsdbufChunkBuffer) >= TSDBUF_CHUNK_SIZE_MIN or time.time() >= tsdbufChunkCollectionStartTime + TSDBUF_CHUNK_CLOSE_TIME_LIMIT_SEC:   # enough data or time limit
-            # create and write chunks for each field
-            auxStruct = {}
-            for record in tsdbufChunkBuffer:   # create outStruct grouping by field name and device identifier
-                if record.field not in auxStruct:
-                    auxStruct[record.field] = {}
-                if record.id not in auxStruct[record.field]:
-                    auxStruct[record.field][record.id] = []
-                auxStruct[record.field][record.id].append( {'dcmTime' : record.times['measurement'], 'measurementTime' : record.times['measurement'], 'sensorsetbufferTime' : record.times['sensorsetbuffer'], 'value' : record.values} )
-            for field, fieldEntries in auxStruct.items():   # handle every field separately
-                outStruct = [{'id': identifier, 'changes': changes} for identifier, changes in fieldEntries.items()]
-                # FIXME redis.push(json.dumps(outStruct), field)   # write chunk
+            # close chunk, the history writer encodes it off the message path
+            if tsdbufHistoryEnabled:
+                tsdbufHistoryEnqueue(tsdbufChunkBuffer)
             # finalize
-            tsdbufChunkBuffer.clear()
+            tsdbufChunkBuffer = []
             tsdbufChunkCollectionStartTime = float('inf')   # reset start time
 
-def tsdbufAvoidDupBufferCleanUp():   # remove too old items
-    global tsdbufAvoidDupBuffer
+def tsdbufHistoryEnqueue(chunk):   # add a closed chunk (list of chunkBufferRecordType) to the history backlog, drop the oldest chunks above the backlog limit
+    global tsdbufHistoryBacklogRecords
+    tsdbufHistoryBacklog.append(chunk)
+    tsdbufHistoryBacklogRecords += len(chunk)
+    while tsdbufHistoryBacklogRecords > TSDBUF_HISTORY_BACKLOG_LIMIT and len(tsdbufHistoryBacklog) > 1:
+        dropped = tsdbufHistoryBacklogPop()
+        tsdbufHistoryStats['recordsDropped'] += len(dropped)
+
+def tsdbufHistoryBacklogPop():   # remove and return the oldest closed chunk of the backlog
+    global tsdbufHistoryBacklogRecords
+    chunk = tsdbufHistoryBacklog.popleft()
+    tsdbufHistoryBacklogRecords -= len(chunk)
+    return chunk
+
+def tsdbufHistoryTake():   # remove and return every closed chunk of the backlog (to pass them to another process, they are encoded there)
+    global tsdbufHistoryBacklogRecords
+    chunks = list(tsdbufHistoryBacklog)
+    tsdbufHistoryBacklog.clear()
+    tsdbufHistoryBacklogRecords = 0
+    return chunks
+
+def tsdbufChunkOutStructs(records):   # create outStruct for each field from a closed chunk; returns list of (field, outStruct, record count)
+    auxStruct = {}
+    for record in records:   # create outStruct grouping by field name and device identifier
+        if record.field not in auxStruct:
+            auxStruct[record.field] = {}
+        if record.id not in auxStruct[record.field]:
+            auxStruct[record.field][record.id] = []
+        auxStruct[record.field][record.id].append( {'dcmTime' : record.times['measurement'], 'measurementTime' : record.times['measurement'], 'sensorsetbufferTime' : record.times['sensorsetbuffer'], 'value' : record.values} )
+    return [
+        (field, [{'id': identifier, 'changes': changes} for identifier, changes in fieldEntries.items()], sum(len(changes) for changes in fieldEntries.values()))
+        for field, fieldEntries in auxStruct.items()
+    ]
+
+def tsdbufChunkColumns(records):   # columns of a closed chunk for each field and device; returns field -> device identifier -> (measurement times, sensorsetbuffer times, values)
+    columns = {}
+    for record in records:
+        fieldColumns = columns.get(record.field)
+        if fieldColumns is None:
+            fieldColumns = columns[record.field] = {}
+        deviceColumns = fieldColumns.get(record.id)
+        if deviceColumns is None:
+            deviceColumns = fieldColumns[record.id] = ([], [], [])
+        deviceColumns[0].append(record.times['measurement'])
+        deviceColumns[1].append(record.times['sensorsetbuffer'])
+        deviceColumns[2].append(record.values)
+    return columns
+
+def tsdbufChunkEncode(records, historyFormat = None):   # encode a closed chunk for each field; returns list of (Redis key, data, record count)
+# param[in] historyFormat:   'json' or 'columnar', TSDBUF_HISTORY_FORMAT if not given
+
+    historyFormat = historyFormat or TSDBUF_HISTORY_FORMAT
+    keyFormat = TSDBUF_HISTORY_KEY_FORMATS[historyFormat]
+    if historyFormat == 'columnar':
+        return [
+            (keyFormat.format(field), chunkcodec_v2.encodeChunk(devices), sum(len(columns[0]) for columns in devices.values()))
+            for field, devices in tsdbufChunkColumns(records).items()
+        ]
+    return [   # each device entry is encoded alone (short calls holding the GIL when encoding in a worker thread), same as encoding the list
+        (keyFormat.format(field), b'[' + b','.join([codec_v2.dumpb(entry) for entry in outStruct]) + b']', count)
+        for field, outStruct, count in tsdbufChunkOutStructs(records)
+    ]
+
+async def tsdbufHistoryWriter(redis):   # task: encode closed chunks in a worker thread and write them to the long-term history, many field chunks in one pipelined round trip
+    global tsdbufHistoryEnabled
+    global tsdbufHistoryBacklogBytes
+
+    tsdbufHistoryEnabled = True
+    loop = asyncio.get_running_loop()
+    inflight = []   # encoded field chunks being written; elements: (key, data, record count)
+    retryDelay = TSDBUF_HISTORY_RETRY_MIN_SEC
+    while True:
+        if not inflight:   # take and encode next chunks
+            if not tsdbufHistoryBacklog:
+                await asyncio.sleep(TSDBUF_HISTORY_POLL_INTERVAL_SEC)
+                continue
+            while tsdbufHistoryBacklog and len(inflight) < TSDBUF_HISTORY_PIPELINE_MAX_CHUNKS:
+                inflight.extend(await loop.run_in_executor(None, tsdbufChunkEncode, tsdbufHistoryBacklogPop()))
+            tsdbufHistoryBacklogBytes = sum(len(data) for key, data, count in inflight)
+        startTime = time.perf_counter()
+        try:
+            pipe = redis.pipeline(transaction = False)
+            for key, data, count in inflight:
+                pipe.rpush(key, data)
+            await pipe.execute()
+        except asyncio.CancelledError:
+            raise
+        except BaseException as e:
+            tsdbufHistoryStats['writeFailures'] += 1
+            logging.warning("Cannot write %u chunk(s) to the long-term history ('%s': %s), retry in %.1f sec.", len(inflight), type(e).__name__, str(e), retryDelay)
+            await asyncio.sleep(retryDelay)
+            retryDelay = min(retryDelay * 2, TSDBUF_HISTORY_RETRY_MAX_SEC)
+            continue
+        latency = time.perf_counter() - startTime
+        tsdbufHistoryStats['chunksWritten'] += len(inflight)
+        tsdbufHistoryStats['recordsWritten'] += sum(count for key, data, count in inflight)
+        tsdbufHistoryStats['bytesWritten'] += sum(len(data) for key, data, count in inflight)
+        tsdbufHistoryStats['lastFlushLatencySec'] = latency
+        tsdbufHistoryStats['maxFlushLatencySec'] = max(latency, tsdbufHistoryStats['maxFlushLatencySec'])
+        inflight = []
+        tsdbufHistoryBacklogBytes = 0
+        retryDelay = TSDBUF_HISTORY_RETRY_MIN_SEC
+
+def tsdbufHistoryStatsGet():   # long-term history writer metrics including the backlog size
+    return dict(tsdbufHistoryStats, backlogChunks = len(tsdbufHistoryBacklog), backlogRecords = tsdbufHistoryBacklogRecords, backlogBytes = tsdbufHistoryBacklogBytes)
+
+def tsdbufAvoidDupBufferCleanUp():   # remove too old items: buckets entirely older than the buffering window of each source with records in them are dropped
     global tsdbufAvoidDupBufferCleanupLastTime
     if time.time() - tsdbufAvoidDupBufferCleanupLastTime >= TSDBUF_AVOID_DUP_BUFFER_CLEANUP_INTERVAL_SEC:
-        tsdbufAvoidDupBuffer = set(filter(lambda item: notTooOld(item[1]), tsdbufAvoidDupBuffer))   # filter too old data from buffer
+        windowStart = localTimeUsec() - TSDBUF_DATA_AGE_LIMIT_SEC * 1000000   # start of the buffering window in local time
+        for bucketIndex in [bucketIndex for bucketIndex, offset in tsdbufAvoidDupBucketOffsets.items() if (bucketIndex + 1) * TSDBUF_AVOID_DUP_BUCKET_WIDTH <= windowStart - offset]:
+            del tsdbufAvoidDupBuffer[bucketIndex]
+            del tsdbufAvoidDupBucketOffsets[bucketIndex]
         tsdbufAvoidDupBufferCleanupLastTime = time.time()
 
+def tsdbufAvoidDupStats():   # duplication avoidance buffer statistics, memory footprint is approximate (buckets, records and their measurement times)
+    entries = sum(len(bucket) for bucket in tsdbufAvoidDupBuffer.values())
+    footprint = sys.getsizeof(tsdbufAvoidDupBuffer) + sys.getsizeof(tsdbufAvoidDupBucketOffsets) + sum(sys.getsizeof(bucket) for bucket in tsdbufAvoidDupBuffer.values()) + entries * (sys.getsizeof((0, 0)) + sys.getsizeof(2 ** 60))
+    return {'entries' : entries, 'buckets' : len(tsdbufAvoidDupBuffer), 'bytes' : footprint}
+
+def tsdbufSizes():   # number of elements in the TSD buffers
+    return {
+        'chunkBufferRecords' : len(tsdbufChunkBuffer),
+        'avoidDupEntries' : sum(len(bucket) for bucket in tsdbufAvoidDupBuffer.values()),
+        'historyBacklogChunks' : len(tsdbufHistoryBacklog),
+        'devices' : len(devstate_v2.deviceStates)
+    }
+
+def tsdbufStatsCollect():   # statistics of the TSD buffers, the time sync and the device states, called by the thread using them
+    return {
+        'avoidDup' : tsdbufAvoidDupStats(),
+        'timeSync' : tsdbufTimeSyncStats(),
+        'devices' : devstate_v2.deviceStates.stats(),
+        'sizes' : tsdbufSizes()
+    }
+
 def tsdAbsoluteTime2measurementTime(time):   # supply time in picoseconds!
     return time // MEASUREMENT_TIME_PICOSEC   # measurement time is UTC with epoch 1970.01.01. in microseconds, TSD absolute time should be also this type to avoid leap second calculcation
 
-def tsdProcessor(attrSetter, idCompound, buffering, transform = lambda x: x):   # processor function for TSD data
-# param[in] attrSetter:   function(data, times)
-# param[in] idCompound:   tuple(device identifier as a single number, data field name)
+def noTransform(x):
+    return x
+
+def tsdMeasurementTimes(vals, times):   # measurement times of every TSD sample computed in one pass, None if measurement time is not available
+    samples = vals['data']
+    measTimeExists = 'measurement' in times and type(times['measurement']) in [int, float]   # measurement time exists (BDCL found RxPacket for that packet)
+    if 'timestamp' not in vals:   # no timestamp definition: every sample has the measurement time of the message
+        return [times['measurement']] * len(samples) if measTimeExists else None
+    timestampRelative = vals['timestamp']['absolute or relative']
+    tsdTimeMultiplier = TSD_TIME_MULTIPLIERS[vals['timestamp']['unit']]
+    if timestampRelative == 'relative':    # relative timestamp (relative to a random time point, last is approx. measurementTime)
+        if not measTimeExists or not samples:
+            return None
+        firstTsPicosec = times['measurement'] * MEASUREMENT_TIME_PICOSEC - tsdTimeMultiplier * samples[-1]['timestamp']   # compute absolute time value of first relative timestamp (FIXME: modify to maximum search)
+        return [(firstTsPicosec + tsdTimeMultiplier * data['timestamp']) // MEASUREMENT_TIME_PICOSEC for data in samples]
+    elif timestampRelative == 'relative (reversed)':    # relative timestamp (backwards distance from measurementTime)
+        if not measTimeExists:
+            return None
+        measTimePicosec = times['measurement'] * MEASUREMENT_TIME_PICOSEC
+        return [(measTimePicosec - tsdTimeMultiplier * data['timestamp']) // MEASUREMENT_TIME_PICOSEC for data in samples]
+    else:    # absolute timestamp: measurement time will be the absolute time from TSD
+        return [tsdAbsoluteTime2measurementTime(tsdTimeMultiplier * data['timestamp']) for data in samples]
+
+def tsdProcess(vals, times, attrSetter, identifier, field, buffering, transform = noTransform, values = None, measTimes = None):   # process TSD data, returns the data out items
+# param[in] vals:         TSD data
+# param[in] times:        times of the message
+# param[in] attrSetter:   function(data, identifier, times)
+# param[in] identifier:   device identifier as a single number
+# param[in] field:        data field name
 # param[in] buffering:    boolean, set True to make buffering and history input for this data
 # param[in] transform:    function to transform data
+# param[in] values:       list of sample values to use instead of the values in vals (e.g. decoded from them), optional
+# param[in] measTimes:    measurement times of the samples as returned by tsdMeasurementTimes(vals, times) if already computed, optional
 
-    def internalFunc(vals, times):
-        xxout = [{'coll' : 'dummy'}]
-        timestampExists = 'timestamp' in vals   # timestamp definition exists (-> timestamp available for data)
-        measTimeExists = 'measurement' in times and type(times['measurement']) in [int, float]   # measurement time exists (BDCL found RxPacket for that packet)
-        if timestampExists:
-            timestampRelative = vals['timestamp']['absolute or relative']
-            tsdTimeMultiplier = {
-                'picoseconds':  1,
-                'nanoseconds':  1000,
-                'microseconds': 1000000,
-                'milliseconds': 1000000000,
-                'seconds':      1000000000000,
-                'minutes':      60000000000000
-            }[vals['timestamp']['unit']]
-            if measTimeExists:
-                measTimePicosec = times['measurement'] * MEASUREMENT_TIME_PICOSEC
-                if timestampRelative == 'relative':    # relative timestamp (relative to a random time point, last is approx. measurementTime)
-                    firstTsPicosec = measTimePicosec - tsdTimeMultiplier * vals['data'][-1]['timestamp']   # compute absolute time value of first relative timestamp (FIXME: modify to maximum search)
-        for data in vals['data']:
-            newtimes = copy.deepcopy(times)
-            newMeasTime = False
-            if timestampExists:
-                if timestampRelative == 'relative':    # relative timestamp (relative to a random time point, last is approx. measurementTime)
-                    if measTimeExists:   # measurement time exists
-                        newtimes['measurement'] = (firstTsPicosec + tsdTimeMultiplier * data['timestamp']) // MEASUREMENT_TIME_PICOSEC   # compute measurement time
-                        newMeasTime = True
-                elif timestampRelative == 'relative (reversed)':    # relative timestamp (backwards distance from measurementTime)
-                    if measTimeExists:   # measurement time exists
-                        newtimes['measurement'] = (measTimePicosec - tsdTimeMultiplier * data['timestamp']) // MEASUREMENT_TIME_PICOSEC   # compute measurement time
-                        newMeasTime = True
-                else:    # absolute timestamp
-                    newtimes['measurement'] = tsdAbsoluteTime2measurementTime(tsdTimeMultiplier * data['timestamp'])   # measurement time will be the absolute time from TSD
-                    newMeasTime = True
-            if measTimeExists or newMeasTime:   # measurement time is available from somewhere
-                newtimesMeasurement = newtimes['measurement']
-                if notTooNew(newtimesMeasurement):    # eliminate bad timestamps (pointing to future)
-                    if tsdLatestCheckUpdate(idCompound, newtimesMeasurement):   # is this data newer?
-                        xxout.extend(attrSetter(transform(data['values']), newtimes))    # newer, or does not exist yet, update DCM
-                    if buffering:
-                        tsdbufAddRecord(idCompound, transform(data['values']), newtimes)
-                else:   # bad timestamp
-                    print("Bad measurement time for {}, value: {}, in tickCount: {}, current tickCount: {}".format(idCompound, newtimesMeasurement, measurementTimeToTickCount(newtimesMeasurement), time.time()))
+    idCompound = (identifier, field)
+    xxout = []
+    if measTimes is None:
+        measTimes = tsdMeasurementTimes(vals, times)
+    if measTimes is None:   # measurement time is not available from anywhere
         return xxout
+    if values is None:
+        values = [data['values'] for data in vals['data']]
+    oldestMeasTime, newestMeasTime = measurementTimeWindow(identifier)
+    offset = timesyncOffset(identifier)
+    latestMeasTimes = devstate_v2.deviceStates.record(identifier).latestMeasTimes
+    latestMeasTime = latestMeasTimes.get(field)
+    for value, measTime in zip(values, measTimes):
+        if measTime >= newestMeasTime:   # bad timestamp (pointing to future)
+            print("Bad measurement time for {}, value: {}, in tickCount: {}, current tickCount: {}".format(idCompound, measTime, measurementTimeToTickCount(measTime, identifier), time.time()))
+            continue
+        value = transform(value)
+        newtimes = dict(times)
+        newtimes['measurement'] = measTime
+        if latestMeasTime is None or measTime > latestMeasTime:   # newer, or does not exist yet, update DCM
+            latestMeasTime = measTime
+            xxout.extend(attrSetter(value, identifier, newtimes))
+        if buffering and measTime >= oldestMeasTime:
+            tsdbufAddRecordInWindow(idCompound, value, newtimes, offset)
+    if latestMeasTime is not None:
+        latestMeasTimes[field] = latestMeasTime
+    return xxout
 
-    return internalFunc
-
-def tsdbufProcess(times):   # process for TSD buffering, call in the redis_translator function in the translators where this module is used
+def tsdbufProcess(times, identifier = None):   # process for TSD buffering, translators using this module call it once for each message (translator_prepare)
 
     # time sync procedure
-    tsdbufTimeSync(times)
+    tsdbufTimeSync(times, identifier)
 
     # duplicate buffer clean-up
     tsdbufAvoidDupBufferCleanUp()
 
+    # device state eviction and snapshot
+    devstate_v2.devstateMaintain()
+
     # history write process
     tsdbufWriteHistory()
@@ -1,21 +1,16 @@
-def translator_func(data, identifier, times):
+TWR_RESULT_LOLAN_KEYS = [(f'tagsettings.twr.target{i}', f'status.twr.result{i}') for i in range(1, 10)]   # (target, result) LoLaN variable pairs
 
-    def attrSetterTwrRtls():
-        def setattrWrapper(val, newTimes):
-            ret = []
-            for i in range(1, 10):
-                if f'tagsettings.twr.target{i}' in val and f'status.twr.result{i}' in val:
-                    ret.append({'coll' : 'twr', 'id' : 'tag.'+str(identifier), 'attr' : 'twrUniqueIdAndMeter', 'data' : {'value': [val[f'tagsettings.twr.target{i}'], val[f'status.twr.result{i}'] / 1000.0], 'times': newTimes}})
-                    # Note: no unique ID resolution (there is LoLaN ID in patch)
-            return ret
-        return setattrWrapper
 
-    # LoLaN variable translator definitions
-    switcher = {
-        'status.twr.inform_c': attrSetterTwrRtls()
-    }
+def twrRtlsSetter(val, identifier, newTimes):
+    ret = []
+    for targetKey, resultKey in TWR_RESULT_LOLAN_KEYS:
+        if targetKey in val and resultKey in val:
+            ret.append({'coll' : 'twr', 'id' : 'tag.'+str(identifier), 'attr' : 'twrUniqueIdAndMeter', 'data' : {'value': [val[targetKey], val[resultKey] / 1000.0], 'times': newTimes}})
+            # Note: no unique ID resolution (there is LoLaN ID in patch)
+    return ret
 
-    # translating procedure
-    for k, setterFunc in switcher.items():
-        if k in data:
-            yield setterFunc(data[k], times)
\ No newline at end of file
+
+# LoLaN variable translator definitions: handler(value, device identifier, times)
+lolanHandlers = {
+    'status.twr.inform_c': twrRtlsSetter
+}